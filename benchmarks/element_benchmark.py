@@ -0,0 +1,183 @@
+"""
+End to end benchmark for milestonexprotectsrc against the local mock site in mock_xprotect.py.
+
+Runs 1 to N concurrent elements (doubling each round) into fakesinks, and reports per round:
+startup latency (PLAYING to first buffer), frames/s, bytes/s, CPU time per frame and memory (RSS) per stream.
+The mock runs in a separate process, so the CPU and memory figures are the element's alone.
+
+  python3 benchmarks/element_benchmark.py [--streams N] [--duration S] [--fps F] [--frame-size BYTES]
+                                          [--codec h264|h265|jpeg] [--property name=value ...]
+
+e.g. --fps 0 sends frames as fast as possible to measure maximum throughput, and
+--property reader-thread=true or --property shared-ingest=true benchmarks those paths.
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+Gst.init(None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gst", "milestonexprotect"))
+from milestonexprotect import MilestoneXprotectSrc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mock_xprotect
+
+if Gst.ElementFactory.find("milestonexprotectsrc") is None:
+  Gst.Element.register(None, "milestonexprotectsrc", Gst.Rank.NONE, MilestoneXprotectSrc)
+
+
+def run_mock(connection, cameras, fps, frame_size, codec, gop):
+  site = mock_xprotect.MockSite(cameras, fps, frame_size, codec, gop)
+  connection.send((site.management_address, site.cameras))
+  # Serve until the benchmark closes its end
+  try:
+    connection.recv()
+  except EOFError:
+    pass
+  site.close()
+
+
+def rss_bytes() -> int:
+  with open("/proc/self/statm") as statm:
+    return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class Stream:
+  """
+  One milestonexprotectsrc ! fakesink pipeline, counting buffers and bytes with a probe on the sink
+  """
+  def __init__(self, management_server: str, camera_id: str, hardware_id: str, properties: dict):
+    self.pipeline = Gst.Pipeline.new()
+    src = Gst.ElementFactory.make("milestonexprotectsrc")
+    src.set_property("management-server", management_server)
+    src.set_property("user-domain", "BASIC")
+    src.set_property("user-id", "user")
+    src.set_property("user-pw", "password")
+    src.set_property("camera-id", camera_id)
+    src.set_property("hardware-id", hardware_id)
+    for name, value in properties.items():
+      Gst.util_set_object_arg(src, name, value)
+    sink = Gst.ElementFactory.make("fakesink")
+    sink.set_property("sync", False)
+    self.pipeline.add(src)
+    self.pipeline.add(sink)
+    src.link(sink)
+
+    self.frames = 0
+    self.bytes = 0
+    self.started = None
+    self.first_buffer = None
+    self._lock = threading.Lock()
+    sink.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self._probe)
+
+  def _probe(self, pad, info):
+    buf = info.get_buffer()
+    with self._lock:
+      if self.first_buffer is None:
+        self.first_buffer = time.monotonic()
+      self.frames += 1
+      self.bytes += buf.get_size()
+    return Gst.PadProbeReturn.OK
+
+  def counts(self):
+    with self._lock:
+      return self.frames, self.bytes
+
+  def start(self):
+    self.started = time.monotonic()
+    self.pipeline.set_state(Gst.State.PLAYING)
+
+  def stop(self):
+    self.pipeline.set_state(Gst.State.NULL)
+
+  def error(self):
+    message = self.pipeline.get_bus().pop_filtered(Gst.MessageType.ERROR)
+    return message.parse_error()[0].message if message is not None else None
+
+
+def run_round(count: int, management_server: str, cameras, properties: dict, duration: float):
+  rss_before = rss_bytes()
+  streams = [Stream(management_server, camera, hardware, properties) for camera, hardware in cameras[:count]]
+  for stream in streams:
+    stream.start()
+
+  # Wait for every stream to get its first frame before measuring throughput
+  deadline = time.monotonic() + 30
+  while any(stream.first_buffer is None for stream in streams) and time.monotonic() < deadline:
+    for stream in streams:
+      error = stream.error()
+      if error is not None:
+        raise RuntimeError(error)
+    time.sleep(0.01)
+  if any(stream.first_buffer is None for stream in streams):
+    raise RuntimeError("Timed out waiting for the first frame")
+
+  start_counts = [stream.counts() for stream in streams]
+  cpu_start = time.process_time()
+  wall_start = time.monotonic()
+  time.sleep(duration)
+  cpu = time.process_time() - cpu_start
+  wall = time.monotonic() - wall_start
+  end_counts = [stream.counts() for stream in streams]
+  rss_after = rss_bytes()
+
+  for stream in streams:
+    stream.stop()
+
+  frames = sum(end[0] - begin[0] for begin, end in zip(start_counts, end_counts))
+  data = sum(end[1] - begin[1] for begin, end in zip(start_counts, end_counts))
+  startup = [(stream.first_buffer - stream.started) * 1000 for stream in streams]
+  return {
+    "streams": count,
+    "startup_median_ms": statistics.median(startup),
+    "startup_max_ms": max(startup),
+    "fps": frames / wall,
+    "mbps": data / wall / 1e6,
+    "cpu_us_per_frame": cpu / frames * 1e6 if frames > 0 else float("nan"),
+    "rss_mib_per_stream": (rss_after - rss_before) / count / (1024 * 1024),
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--streams", type=int, default=8, help="Maximum number of concurrent streams (default 8)")
+  parser.add_argument("--duration", type=float, default=5.0, help="Seconds to measure each round for (default 5)")
+  parser.add_argument("--fps", type=float, default=25, help="Frames per second per camera from the mock (0 for as fast as possible)")
+  parser.add_argument("--frame-size", type=int, default=50000, help="Frame size in bytes (default 50000)")
+  parser.add_argument("--codec", choices=sorted(mock_xprotect.CODECS), default="h264")
+  parser.add_argument("--gop", type=int, default=25, help="Frames per keyframe (default 25)")
+  parser.add_argument("--property", action="append", default=[], metavar="NAME=VALUE", help="Extra element property, may be repeated")
+  args = parser.parse_args()
+
+  properties = dict(prop.split("=", 1) for prop in args.property)
+
+  connection, mock_connection = multiprocessing.Pipe()
+  mock = multiprocessing.Process(target=run_mock, args=(mock_connection, args.streams, args.fps, args.frame_size, args.codec, args.gop), daemon=True)
+  mock.start()
+  management_server, cameras = connection.recv()
+
+  print("%8s %14s %14s %12s %10s %14s %14s" % ("streams", "startup med ms", "startup max ms", "frames/s", "MB/s", "CPU us/frame", "RSS MiB/stream"))
+  count = 1
+  try:
+    while True:
+      result = run_round(count, management_server, cameras, properties, args.duration)
+      print("%8d %14.1f %14.1f %12.1f %10.2f %14.1f %14.2f" % (result["streams"], result["startup_median_ms"], result["startup_max_ms"],
+                                                             result["fps"], result["mbps"], result["cpu_us_per_frame"], result["rss_mib_per_stream"]))
+      if count == args.streams:
+        break
+      count = min(count * 2, args.streams)
+  finally:
+    connection.close()
+    mock.join(5)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,65 @@
+"""
+Startup benchmark for milestonexprotectsrc - how long importing the plugin module takes, which gst-python
+pays on every registry scan and plugin load (gst-inspect-1.0, gst-launch-1.0, ...).
+
+Each run is a fresh interpreter, timing the module import alone after gi / Gst.init, and checking the SOAP / HTTP
+stack wasn't imported with it. Exits non-zero if the median is over --max-ms, or a heavy module was imported.
+
+  python3 benchmarks/import_benchmark.py [--runs N] [--max-ms MS]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gst", "milestonexprotect")
+
+# Modules that should only be imported once the element starts
+LAZY_MODULES = ("zeep", "requests", "requests_ntlm", "urllib3", "asyncio", "xml.etree.ElementTree")
+
+CHILD = """
+import json, sys, time
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+Gst.init(None)
+sys.path.insert(0, sys.argv[1])
+before = set(sys.modules)
+start = time.perf_counter()
+import milestonexprotect
+elapsed = time.perf_counter() - start
+# Only count modules the plugin pulled in, not ones gi had already loaded
+print(json.dumps({"ms": elapsed * 1000, "loaded": [name for name in json.loads(sys.argv[2]) if name in sys.modules and name not in before]}))
+"""
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--runs", type=int, default=10)
+  parser.add_argument("--max-ms", type=float, default=0, help="Fail if the median import time is over this (0 to only report)")
+  args = parser.parse_args()
+
+  times = []
+  loaded = set()
+  for i in range(args.runs):
+    output = subprocess.run([sys.executable, "-c", CHILD, PLUGIN_DIR, json.dumps(LAZY_MODULES)], check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    times.append(result["ms"])
+    loaded.update(result["loaded"])
+
+  median = statistics.median(times)
+  print("module import: median %.1f ms   min %.1f ms   max %.1f ms   (%d runs)" % (median, min(times), max(times), args.runs))
+  failed = False
+  if len(loaded) > 0:
+    print("imported at module load, should be lazy: %s" % ", ".join(sorted(loaded)))
+    failed = True
+  if args.max_ms > 0 and median > args.max_ms:
+    print("median import time over the %.1f ms limit" % args.max_ms)
+    failed = True
+  sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+  main()
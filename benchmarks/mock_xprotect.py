@@ -0,0 +1,368 @@
+"""
+Local mock of a Milestone XProtect site for benchmarking milestonexprotectsrc without a real install.
+
+  * Management server (HTTPS, self-signed) - openid-configuration and token endpoint for OAuth, the
+    ServerCommandService WSDL, and Login / GetConfiguration / GetConfigurationHardware / QueryRecorderInfo
+  * ImageServer (TCP) - answers connect / connectupdate, streams GenericByteData frames on live at a
+    configurable rate, size and codec, and serves goto / next for playback
+
+  python3 benchmarks/mock_xprotect.py [--cameras N] [--fps F] [--frame-size BYTES] [--codec h264|h265|jpeg]
+
+Prints the management-server address and the camera / hardware IDs, then serves until interrupted.
+Needs the openssl command to generate the certificate.
+"""
+import argparse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import re
+import socketserver
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+
+NAMESPACE = "http://videoos.net/2/XProtectCSServerCommand"
+
+CODECS = {"jpeg": 0x0001, "h264": 0x000A, "h265": 0x000E}
+
+GBD_HEADER = struct.Struct(">HIHHHQQ")
+GBD_DATATYPE_VIDEO = 0x0010
+GBD_FLAG_SYNC = 0x0001
+
+TOKEN_TTL_US = 4 * 3600 * 1000000
+
+WSDL = """<?xml version="1.0" encoding="utf-8"?>
+<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+  xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:tns="{ns}" targetNamespace="{ns}">
+<wsdl:types>
+<xs:schema targetNamespace="{ns}" elementFormDefault="qualified">
+  <xs:complexType name="TimeDuration"><xs:sequence>
+    <xs:element name="MicroSeconds" type="xs:long"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="LoginInfo"><xs:sequence>
+    <xs:element name="RegistrationTime" type="xs:dateTime"/>
+    <xs:element name="TimeToLive" type="tns:TimeDuration"/>
+    <xs:element name="Token" type="xs:string"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="ArrayOfGuid"><xs:sequence>
+    <xs:element name="guid" type="xs:string" minOccurs="0" maxOccurs="unbounded"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="CameraInfo"><xs:sequence>
+    <xs:element name="DeviceId" type="xs:string"/>
+    <xs:element name="HardwareId" type="xs:string"/>
+    <xs:element name="Name" type="xs:string"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="ArrayOfCameraInfo"><xs:sequence>
+    <xs:element name="CameraInfo" type="tns:CameraInfo" minOccurs="0" maxOccurs="unbounded"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="RecorderInfo"><xs:sequence>
+    <xs:element name="RecorderId" type="xs:string"/>
+    <xs:element name="WebServerUri" type="xs:string"/>
+    <xs:element name="Cameras" type="tns:ArrayOfCameraInfo" minOccurs="0"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="ArrayOfRecorderInfo"><xs:sequence>
+    <xs:element name="RecorderInfo" type="tns:RecorderInfo" minOccurs="0" maxOccurs="unbounded"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="ConfigurationInfo"><xs:sequence>
+    <xs:element name="Recorders" type="tns:ArrayOfRecorderInfo"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="HardwareInfo"><xs:sequence>
+    <xs:element name="HardwareId" type="xs:string"/>
+    <xs:element name="RecorderId" type="xs:string"/>
+    <xs:element name="DeviceIds" type="tns:ArrayOfGuid"/>
+  </xs:sequence></xs:complexType>
+  <xs:complexType name="ArrayOfHardwareInfo"><xs:sequence>
+    <xs:element name="HardwareInfo" type="tns:HardwareInfo" minOccurs="0" maxOccurs="unbounded"/>
+  </xs:sequence></xs:complexType>
+  <xs:element name="Login"><xs:complexType><xs:sequence>
+    <xs:element name="instanceId" type="xs:string"/>
+    <xs:element name="currentToken" type="xs:string" minOccurs="0"/>
+  </xs:sequence></xs:complexType></xs:element>
+  <xs:element name="LoginResponse"><xs:complexType><xs:sequence>
+    <xs:element name="LoginResult" type="tns:LoginInfo"/>
+  </xs:sequence></xs:complexType></xs:element>
+  <xs:element name="GetConfiguration"><xs:complexType><xs:sequence>
+    <xs:element name="token" type="xs:string"/>
+  </xs:sequence></xs:complexType></xs:element>
+  <xs:element name="GetConfigurationResponse"><xs:complexType><xs:sequence>
+    <xs:element name="GetConfigurationResult" type="tns:ConfigurationInfo"/>
+  </xs:sequence></xs:complexType></xs:element>
+  <xs:element name="GetConfigurationHardware"><xs:complexType><xs:sequence>
+    <xs:element name="token" type="xs:string"/>
+    <xs:element name="hardwareIds" type="tns:ArrayOfGuid"/>
+  </xs:sequence></xs:complexType></xs:element>
+  <xs:element name="GetConfigurationHardwareResponse"><xs:complexType><xs:sequence>
+    <xs:element name="GetConfigurationHardwareResult" type="tns:ArrayOfHardwareInfo"/>
+  </xs:sequence></xs:complexType></xs:element>
+  <xs:element name="QueryRecorderInfo"><xs:complexType><xs:sequence>
+    <xs:element name="token" type="xs:string"/>
+    <xs:element name="recorderId" type="xs:string"/>
+  </xs:sequence></xs:complexType></xs:element>
+  <xs:element name="QueryRecorderInfoResponse"><xs:complexType><xs:sequence>
+    <xs:element name="QueryRecorderInfoResult" type="tns:RecorderInfo"/>
+  </xs:sequence></xs:complexType></xs:element>
+</xs:schema>
+</wsdl:types>
+{messages}
+<wsdl:portType name="ServerCommandServiceSoap">{port_operations}</wsdl:portType>
+<wsdl:binding name="ServerCommandServiceSoap" type="tns:ServerCommandServiceSoap">
+<soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+{binding_operations}
+</wsdl:binding>
+<wsdl:service name="ServerCommandService">
+<wsdl:port name="ServerCommandServiceSoap" binding="tns:ServerCommandServiceSoap"><soap:address location="{address}"/></wsdl:port>
+</wsdl:service>
+</wsdl:definitions>"""
+
+OPERATIONS = ("Login", "GetConfiguration", "GetConfigurationHardware", "QueryRecorderInfo")
+
+
+def wsdl(address: str) -> bytes:
+  messages = "".join('<wsdl:message name="{op}In"><wsdl:part name="parameters" element="tns:{op}"/></wsdl:message>'
+                     '<wsdl:message name="{op}Out"><wsdl:part name="parameters" element="tns:{op}Response"/></wsdl:message>'.format(op=op)
+                     for op in OPERATIONS)
+  port_operations = "".join('<wsdl:operation name="{op}"><wsdl:input message="tns:{op}In"/><wsdl:output message="tns:{op}Out"/></wsdl:operation>'.format(op=op)
+                            for op in OPERATIONS)
+  binding_operations = "".join('<wsdl:operation name="{op}"><soap:operation soapAction="{ns}/{op}" style="document"/>'
+                               '<wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>'.format(op=op, ns=NAMESPACE)
+                               for op in OPERATIONS)
+  return WSDL.format(ns=NAMESPACE, messages=messages, port_operations=port_operations, binding_operations=binding_operations, address=address).encode()
+
+
+def soap_envelope(operation: str, result: str) -> bytes:
+  return ('<?xml version="1.0" encoding="utf-8"?><soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+          '<{op}Response xmlns="{ns}"><{op}Result>{result}</{op}Result></{op}Response></soap:Body></soap:Envelope>'
+          ).format(op=operation, ns=NAMESPACE, result=result).encode()
+
+
+class Site:
+  """
+  The cameras on the mock site - one hardware (and one camera) per camera, all on a single recorder
+  """
+  def __init__(self, cameras: int, recorder_uri: str):
+    self.recorder_id = str(uuid.uuid4())
+    self.recorder_uri = recorder_uri
+    self.cameras = [(str(uuid.uuid4()), str(uuid.uuid4())) for i in range(cameras)] # (camera id, hardware id)
+
+  def camera_xml(self):
+    return "".join("<CameraInfo><DeviceId>%s</DeviceId><HardwareId>%s</HardwareId><Name>Camera %d</Name></CameraInfo>" % (camera, hardware, i)
+                   for i, (camera, hardware) in enumerate(self.cameras))
+
+  def recorder_xml(self):
+    return "<RecorderId>%s</RecorderId><WebServerUri>%s</WebServerUri><Cameras>%s</Cameras>" % (self.recorder_id, self.recorder_uri, self.camera_xml())
+
+
+class ManagementHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  site: Site = None
+
+  def log_message(self, format, *args):
+    pass
+
+  def _reply(self, body: bytes, content_type: str, status: int = 200):
+    self.send_response(status)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    host = self.headers.get("Host")
+    if self.path == "/idp/.well-known/openid-configuration":
+      self._reply(json.dumps({"server_version": "23.2.0", "token_endpoint": "https://%s/idp/connect/token" % host}).encode(), "application/json")
+    elif self.path.endswith("?wsdl") or self.path.endswith("?singleWsdl"):
+      self._reply(wsdl("https://%s%s" % (host, self.path.split("?")[0])), "text/xml")
+    else:
+      self._reply(b"", "text/plain", 404)
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    if self.path == "/idp/connect/token":
+      self._reply(json.dumps({"access_token": "mock-access-token", "token_type": "Bearer", "expires_in": 3600}).encode(), "application/json")
+      return
+
+    request = ET.fromstring(body).find("{http://schemas.xmlsoap.org/soap/envelope/}Body")[0]
+    operation = request.tag.split("}")[-1]
+    site = self.site
+    if operation == "Login":
+      now = datetime.now(timezone.utc).isoformat()
+      result = "<RegistrationTime>%s</RegistrationTime><TimeToLive><MicroSeconds>%d</MicroSeconds></TimeToLive><Token>TOKEN#%s</Token>" % (now, TOKEN_TTL_US, uuid.uuid4())
+    elif operation == "GetConfiguration":
+      result = "<Recorders><RecorderInfo>%s</RecorderInfo></Recorders>" % site.recorder_xml()
+    elif operation == "GetConfigurationHardware":
+      wanted = {element.text.lower() for element in request.iter("{%s}guid" % NAMESPACE)}
+      result = "".join("<HardwareInfo><HardwareId>%s</HardwareId><RecorderId>%s</RecorderId><DeviceIds><guid>%s</guid></DeviceIds></HardwareInfo>" % (hardware, site.recorder_id, camera)
+                       for camera, hardware in site.cameras if hardware in wanted)
+    elif operation == "QueryRecorderInfo":
+      result = site.recorder_xml()
+    else:
+      self._reply(b"", "text/plain", 500)
+      return
+    self._reply(soap_envelope(operation, result), "text/xml; charset=utf-8")
+
+
+def self_signed_context(directory: str) -> ssl.SSLContext:
+  cert = os.path.join(directory, "cert.pem")
+  key = os.path.join(directory, "key.pem")
+  subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost", "-days", "1",
+                  "-keyout", key, "-out", cert], check=True, capture_output=True)
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  context.load_cert_chain(cert, key)
+  return context
+
+
+class ImageServerHandler(socketserver.BaseRequestHandler):
+  """
+  One ImageServer connection - method calls are read on this thread, and live frames are sent from another
+  """
+  server: "MockImageServer"
+
+  def setup(self):
+    self._send_lock = threading.Lock()
+    self._live = None
+    self._stopped = threading.Event()
+    self._playback_time = 0
+
+  def _send(self, data: bytes):
+    with self._send_lock:
+      self.request.sendall(data)
+
+  def _method_response(self, request_id: str, method: str):
+    self._send(('<?xml version="1.0" encoding="UTF-8"?><methodresponse><requestid>%s</requestid><methodname>%s</methodname>'
+                '<connected>yes</connected></methodresponse>\r\n\r\n' % (request_id, method)).encode())
+
+  def _frame(self, request_id: str, sequence: int, timestamp_ms: int) -> bytes:
+    server = self.server
+    flags = GBD_FLAG_SYNC if server.codec == CODECS["jpeg"] or sequence % server.gop == 0 else 0
+    body = GBD_HEADER.pack(GBD_DATATYPE_VIDEO, server.frame_size, server.codec, sequence & 0xFFFF, flags, timestamp_ms, timestamp_ms) + server.payload
+    header = ("ImageResponse\r\nRequestId: %s\r\nContent-type: application/x-genericbytedata-octet-stream\r\n"
+              "Content-length: %d\r\nCurrent: %d\r\n\r\n" % (request_id, len(body), timestamp_ms)).encode()
+    return header + body + b"\r\n\r\n"
+
+  def _stream_live(self, request_id: str):
+    interval = 1.0 / self.server.fps if self.server.fps > 0 else 0.0
+    sequence = 0
+    next_time = time.monotonic()
+    while not self._stopped.is_set():
+      try:
+        self._send(self._frame(request_id, sequence, int(time.time() * 1000)))
+      except OSError:
+        return
+      sequence += 1
+      if interval > 0:
+        next_time += interval
+        delay = next_time - time.monotonic()
+        if delay > 0:
+          time.sleep(delay)
+
+  def _playback_frame(self, request_id: str):
+    # Recordings are a frame every 1 / fps from the epoch, so goto snaps back to the previous frame
+    interval_ms = max(1, int(1000 / self.server.fps)) if self.server.fps > 0 else 40
+    sequence = self._playback_time // interval_ms
+    self._send(self._frame(request_id, sequence, sequence * interval_ms))
+    self._playback_time = (sequence + 1) * interval_ms
+
+  def handle(self):
+    data = b""
+    try:
+      while True:
+        received = self.request.recv(65536)
+        if not received:
+          return
+        data += received
+        while b"\r\n\r\n" in data:
+          message, data = data.split(b"\r\n\r\n", 1)
+          method = re.search(rb"<methodname>(\w+)</methodname>", message)
+          request_id = re.search(rb"<requestid>(\d+)</requestid>", message)
+          if method is None or request_id is None:
+            continue
+          method = method.group(1).decode()
+          request_id = request_id.group(1).decode()
+          if method in ("connect", "connectupdate"):
+            self._method_response(request_id, method)
+          elif method == "live" and self._live is None:
+            self._live = threading.Thread(target=self._stream_live, args=(request_id,), daemon=True)
+            self._live.start()
+          elif method == "goto":
+            self._playback_time = int(re.search(rb"<time>(\d+)</time>", message).group(1))
+            self._playback_frame(request_id)
+          elif method == "next":
+            self._playback_frame(request_id)
+    except OSError:
+      pass
+    finally:
+      self._stopped.set()
+
+
+class MockImageServer(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, fps: float, frame_size: int, codec: str, gop: int):
+    super().__init__(address, ImageServerHandler)
+    self.fps = fps
+    self.frame_size = frame_size
+    self.codec = CODECS[codec]
+    self.gop = gop
+    self.payload = os.urandom(max(0, frame_size - GBD_HEADER.size))
+
+
+class MockSite:
+  """
+  Starts the mock management server and ImageServer on localhost (on ephemeral ports) in background threads
+  """
+  def __init__(self, cameras: int = 1, fps: float = 25, frame_size: int = 50000, codec: str = "h264", gop: int = 25):
+    self._directory = tempfile.TemporaryDirectory()
+    self.image_server = MockImageServer(("127.0.0.1", 0), fps, frame_size, codec, gop)
+    self.site = Site(cameras, "http://127.0.0.1:%d/" % self.image_server.server_address[1])
+
+    handler = type("Handler", (ManagementHandler,), {"site": self.site})
+    self.management_server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    self.management_server.daemon_threads = True
+    self.management_server.socket = self_signed_context(self._directory.name).wrap_socket(self.management_server.socket, server_side=True)
+
+    for server in (self.image_server, self.management_server):
+      threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  @property
+  def management_address(self) -> str:
+    return "127.0.0.1:%d" % self.management_server.server_address[1]
+
+  @property
+  def cameras(self):
+    return self.site.cameras
+
+  def close(self):
+    for server in (self.image_server, self.management_server):
+      server.shutdown()
+      server.server_close()
+    self._directory.cleanup()
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--cameras", type=int, default=1)
+  parser.add_argument("--fps", type=float, default=25, help="Live frames per second per camera (0 sends as fast as possible)")
+  parser.add_argument("--frame-size", type=int, default=50000, help="Frame size in bytes, including the GenericByteData header")
+  parser.add_argument("--codec", choices=sorted(CODECS), default="h264")
+  parser.add_argument("--gop", type=int, default=25, help="Frames per keyframe")
+  args = parser.parse_args()
+
+  site = MockSite(args.cameras, args.fps, args.frame_size, args.codec, args.gop)
+  print("management-server=%s user-domain=BASIC user-id=user user-pw=password" % site.management_address)
+  for camera, hardware in site.cameras:
+    print("camera-id=%s hardware-id=%s" % (camera, hardware))
+  try:
+    threading.Event().wait()
+  except KeyboardInterrupt:
+    site.close()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark for the per-message ImageServer parsing in milestonexprotectsrc.
+
+Compares the byte-level parser (classify_message / content_length / current_timestamp) against the
+previous approach of decoding each header to a str, splitting it into a dict, and running every XML
+message through ElementTree.
+
+  python3 benchmarks/parser_benchmark.py [--iterations N]
+"""
+import argparse
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gst", "milestonexprotect"))
+from xprotectlib import imageserver
+
+IMAGE_RESPONSE = (b"ImageResponse\r\n"
+                  b"RequestId: 3\r\n"
+                  b"Content-type: application/x-genericbytedata-octet-stream\r\n"
+                  b"Content-length: 2097184\r\n"
+                  b"Current: 1700000000123\r\n"
+                  b"Next: 1700000000163\r\n"
+                  b"Prev: 1700000000083")
+
+LIVEPACKAGE = (b'<?xml version="1.0" encoding="UTF-8"?><livepackage><status>'
+               b'<statustime>1700000000123</statustime><statusitem id="1" value="live"/>'
+               b'<statusitem id="2" value="recording"/></status></livepackage>')
+
+
+def legacy_image(message: bytes):
+  response = message.decode().strip()
+  if response.startswith("ImageResponse"):
+    lines = response.splitlines()
+    headers = {}
+    for i in range(1, len(lines)):
+      key, val = lines[i].split(": ")
+      headers[key.lower()] = val
+    return int(headers["content-length"]), int(headers["current"])
+
+
+def legacy_livepackage(message: bytes):
+  response = message.decode().strip()
+  if response.startswith("<?xml"):
+    return ET.fromstring(response).tag == 'livepackage'
+
+
+def fast_image(message: bytes):
+  message = message.strip()
+  if imageserver.classify_message(message) == imageserver.MESSAGE_IMAGE:
+    return imageserver.content_length(message), imageserver.current_timestamp(message)
+
+
+def fast_livepackage(message: bytes):
+  return imageserver.classify_message(message.strip()) == imageserver.MESSAGE_LIVEPACKAGE
+
+
+def measure(function, message, iterations):
+  return min(timeit.repeat(lambda: function(message), number=iterations, repeat=5)) / iterations * 1e9
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--iterations", type=int, default=100000)
+  args = parser.parse_args()
+
+  assert legacy_image(IMAGE_RESPONSE) == fast_image(IMAGE_RESPONSE)
+  assert legacy_livepackage(LIVEPACKAGE) == fast_livepackage(LIVEPACKAGE)
+
+  for name, legacy, fast, message in (("ImageResponse header", legacy_image, fast_image, IMAGE_RESPONSE),
+                                      ("livepackage", legacy_livepackage, fast_livepackage, LIVEPACKAGE)):
+    legacy_ns = measure(legacy, message, args.iterations)
+    fast_ns = measure(fast, message, args.iterations)
+    print("%-22s legacy %8.0f ns   bytes parser %8.0f ns   saved %8.0f ns/message (%.1fx)" %
+          (name, legacy_ns, fast_ns, legacy_ns - fast_ns, legacy_ns / fast_ns))
+
+
+if __name__ == "__main__":
+  main()
@@ -1,20 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from requests import auth, Session
-from requests_ntlm import HttpNtlmAuth
 from socket import *
 from urllib.parse import urlparse
+import argparse
+import csv
+import json
 import uuid
-import urllib3
 import logging
+import os
 import sys
+import threading
+import time
 from zeep import Client
-from zeep.cache import SqliteCache
 from zeep.transports import Transport
 
+# Pooled sessions and timeouts shared with the element, so one hung management server can't stall its worker forever
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gst", "milestonexprotect"))
+from xprotectlib.soap import HTTP_TIMEOUT, HttpSessions, WsdlCache
+
 # Logging
 formatter = logging.Formatter(
     '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler = logging.StreamHandler(sys.stdout)
+handler = logging.StreamHandler(sys.stderr) # stdout is for the results
 handler.setFormatter(formatter)
 
 logger = logging.getLogger()
@@ -29,24 +36,18 @@ class MilestoneDiscovery:
     self.user_pw = user_pw
     self.user_id = user_id
 
-    session = Session()
+    # Basic auth for BASIC, otherwise NTLM
+    session = HttpSessions.get(self.management_server, self.domain, self.user_id, self.user_pw)
     if self.domain == "BASIC":
       url = "https://" + self.management_server + "/ManagementServer/ServerCommandService.svc"
-      session.auth = auth.HTTPBasicAuth(username=self.user_id, password=self.user_pw)
-      session.verify = False # Highly unlikely we'll trust the Milestone cert, so just ignore errors
-      urllib3.disable_warnings()
       binding_override_namespace = "{http://tempuri.org/}BasicHttpBinding_IServerCommandService"
     else:
       # TODO: This endpoint is marked as deprecated, but testing against a 2020R3 release doesn't work with the new endpoint?
       url = "http://" + self.management_server + "/ServerAPI/ServerCommandService.asmx"
-      session.auth = HttpNtlmAuth(self.domain + "\\" + self.user_id, self.user_pw)
       binding_override_namespace = "{http://videoos.net/2/XProtectCSServerCommand}ServerCommandServiceSoap"
 
-    try:
-      logger.info("Instantiating SOAP Client")
-      self.client = Client(url + "?wsdl", transport=Transport(cache=SqliteCache(), session=session))
-    except:
-      return logger.error()
+    logger.info("Instantiating SOAP Client for %s" % self.management_server)
+    self.client = Client(url + "?wsdl", transport=Transport(cache=WsdlCache.sqlite_cache(), session=session, timeout=HTTP_TIMEOUT, operation_timeout=HTTP_TIMEOUT))
     self.instance_id = str(uuid.uuid4())
 
     if self.force_management_address:
@@ -65,25 +66,189 @@ class MilestoneDiscovery:
 
     camera_count = 0
     recorder_count = 0
-    for recorder in self.config.Recorders.RecorderInfo:
-      print(recorder)
+    for recorder, camera in self._cameras():
+      camera_count += 1
+    for recorder in self._recorders():
       recorder_count += 1
-      for camera in recorder.Cameras.CameraInfo:
-        camera_count += 1
 
-    logger.info("Found %d cameras across %d recorders" % (camera_count, recorder_count))
+    logger.info("Found %d cameras across %d recorders on %s" % (camera_count, recorder_count, self.management_server))
+
+  def _recorders(self):
+    recorders = self.config.Recorders
+    if recorders is None or recorders.RecorderInfo is None:
+      return []
+    return recorders.RecorderInfo
+
+  def _cameras(self):
+    """
+    Yields (recorder, camera) for every camera, skipping recorders without any
+    """
+    for recorder in self._recorders():
+      cameras = recorder.Cameras
+      if cameras is None or cameras.CameraInfo is None:
+        continue
+      for camera in cameras.CameraInfo:
+        yield recorder, camera
+
+  def cameras(self):
+    """
+    Yields a dict per camera - management server, recorder, camera and hardware IDs, and name
+    """
+    for recorder, camera in self._cameras():
+      yield {
+        "management_server": self.management_server,
+        "recorder_id": recorder.RecorderId,
+        "recorder": recorder.WebServerUri,
+        "camera_id": camera.DeviceId.lower(),
+        "hardware_id": camera.HardwareId.lower(),
+        "name": camera.Name,
+      }
 
   def get_camera_details(self):
     cameras = []
-    for recorder in self.config.Recorders.RecorderInfo:
-      for camera in recorder.Cameras.CameraInfo:
-        camera_info = {
-          "name": camera.Name,
-          "url": "milestone://" + self.domain + "\\" + self.user_id + ":" + self.user_pw + "@" + self.management_server + "/?cameraId=" + camera.DeviceId + "&hardwareId=" + camera.HardwareId,
-          "recorder": recorder.WebServerUri
-        }
-        cameras.append(camera_info)
-    print(cameras)
-
-milestone = MilestoneDiscovery(user_id="basic", user_pw="basic", domain="BASIC", management_server="192.168.1.100")
-milestone.get_camera_details()
+    for recorder, camera in self._cameras():
+      camera_info = {
+        "name": camera.Name,
+        "url": "milestone://" + self.domain + "\\" + self.user_id + ":" + self.user_pw + "@" + self.management_server + "/?cameraId=" + camera.DeviceId + "&hardwareId=" + camera.HardwareId,
+        "recorder": recorder.WebServerUri
+      }
+      cameras.append(camera_info)
+    return cameras
+
+FIELDS = ("change", "management_server", "recorder_id", "recorder", "camera_id", "hardware_id", "name", "reachable", "latency_ms")
+
+def probe_recorder(recorder_uri, timeout):
+  """
+  Times a TCP connect to the recorder's ImageServer port, returning (reachable, latency in ms)
+  """
+  parsed = urlparse(recorder_uri)
+  started = time.perf_counter()
+  try:
+    with create_connection((parsed.hostname, parsed.port or (443 if parsed.scheme == "https" else 80)), timeout):
+      return True, round((time.perf_counter() - started) * 1000, 1)
+  except OSError:
+    return False, None
+
+def parse_site(site, defaults):
+  """
+  Parses [DOMAIN\\user:password@]host, filling in anything missing from defaults (domain, user, password)
+  """
+  domain, user, password = defaults
+  if "@" in site:
+    credentials, site = site.rsplit("@", 1)
+    user, _, site_password = credentials.partition(":")
+    password = site_password or password
+    if "\\" in user:
+      domain, user = user.split("\\", 1)
+  return site, domain, user, password
+
+def discover(site, defaults, force_management_address):
+  management_server, domain, user, password = parse_site(site, defaults)
+  milestone = MilestoneDiscovery(user_id=user, user_pw=password, domain=domain, management_server=management_server, force_management_address=force_management_address)
+  return management_server, list(milestone.cameras())
+
+def load_snapshot(path):
+  """
+  Returns the cameras from the last run, keyed by (management server, camera ID)
+  """
+  if path is None or not os.path.exists(path):
+    return {}
+  with open(path) as snapshot:
+    return {(camera["management_server"], camera["camera_id"]): camera for camera in json.load(snapshot)}
+
+def save_snapshot(path, cameras):
+  # Write then rename, so an interrupted run leaves the last snapshot intact
+  with open(path + ".tmp", "w") as snapshot:
+    json.dump(list(cameras.values()), snapshot)
+  os.replace(path + ".tmp", path)
+
+def changes(management_server, cameras, previous):
+  """
+  Yields the cameras on management_server that were added or moved recorder since the last snapshot (with change
+  set), then the ones that were removed
+  """
+  seen = set()
+  for camera in cameras:
+    key = (management_server, camera["camera_id"])
+    seen.add(key)
+    old = previous.get(key)
+    if old is None:
+      yield dict(camera, change="added")
+    elif old["recorder_id"] != camera["recorder_id"] or old["recorder"] != camera["recorder"]:
+      yield dict(camera, change="moved")
+  for key, camera in previous.items():
+    if key[0] == management_server and key not in seen:
+      yield dict(camera, change="removed")
+
+class Writer:
+  """
+  Writes result rows to stdout as JSON Lines or CSV as they arrive, from any thread
+  """
+  def __init__(self, output_format):
+    self._lock = threading.Lock()
+    self._csv = None
+    if output_format == "csv":
+      self._csv = csv.DictWriter(sys.stdout, fieldnames=FIELDS, extrasaction="ignore")
+      self._csv.writeheader()
+
+  def write(self, row):
+    with self._lock:
+      if self._csv is not None:
+        self._csv.writerow(row)
+      else:
+        sys.stdout.write(json.dumps(row) + "\n")
+      sys.stdout.flush()
+
+def main():
+  parser = argparse.ArgumentParser(description="Discover the cameras on one or more Milestone XProtect management servers")
+  parser.add_argument("sites", nargs="+", metavar="SITE", help="Management server, as [DOMAIN\\user:password@]host")
+  parser.add_argument("--user-domain", default="BASIC", help="Domain for sites that don't give one, or BASIC to use basic auth (the default)")
+  parser.add_argument("--user-id", default="", help="User for sites that don't give one")
+  parser.add_argument("--user-pw", default=os.environ.get("MILESTONE_PASSWORD", ""), help="Password for sites that don't give one (defaults to $MILESTONE_PASSWORD)")
+  parser.add_argument("--force-management-address", action="store_true")
+  parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+  parser.add_argument("--concurrency", type=int, default=4, help="Management servers to query at once (default 4)")
+  parser.add_argument("--probe", action="store_true", help="Check each recorder's ImageServer port is reachable, and its connect latency")
+  parser.add_argument("--probe-timeout", type=float, default=2.0)
+  parser.add_argument("--snapshot", help="File to keep the cameras in between runs, so only added, removed or moved cameras are output")
+  args = parser.parse_args()
+
+  defaults = (args.user_domain, args.user_id, args.user_pw)
+  previous = load_snapshot(args.snapshot)
+  current = dict(previous)
+  writer = Writer(args.format)
+  failed = False
+
+  with ThreadPoolExecutor(max_workers=max(args.concurrency, 1)) as executor:
+    futures = {executor.submit(discover, site, defaults, args.force_management_address): site for site in args.sites}
+    for future in as_completed(futures):
+      try:
+        management_server, cameras = future.result()
+      except Exception as e:
+        # Leave this site's cameras in the snapshot, rather than reporting them all as removed
+        logger.error("Discovery failed for %s - %s" % (futures[future], str(e)))
+        failed = True
+        continue
+
+      if args.probe:
+        # On their own pool, so probes don't wait behind the other sites' discovery
+        recorders = list({camera["recorder"] for camera in cameras})
+        with ThreadPoolExecutor(max_workers=max(1, min(len(recorders), 32))) as probe_executor:
+          probes = dict(zip(recorders, probe_executor.map(lambda recorder: probe_recorder(recorder, args.probe_timeout), recorders)))
+        for camera in cameras:
+          camera["reachable"], camera["latency_ms"] = probes[camera["recorder"]]
+
+      rows = changes(management_server, cameras, previous) if args.snapshot else cameras
+      for row in rows:
+        writer.write(row)
+
+      for key in [key for key in current if key[0] == management_server]:
+        del current[key]
+      current.update({(management_server, camera["camera_id"]): camera for camera in cameras})
+
+  if args.snapshot:
+    save_snapshot(args.snapshot, current)
+  sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+Gst.init(None)
+
+# Export through the element itself, so it gets the same login, recorder resolution and playback handling
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gst", "milestonexprotect"))
+from milestonexprotect import MilestoneXprotectSrc
+
+# Logging
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler = logging.StreamHandler(sys.stderr)
+handler.setFormatter(formatter)
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+logger.addHandler(handler)
+
+if Gst.ElementFactory.find("milestonexprotectsrc") is None:
+  Gst.Element.register(None, "milestonexprotectsrc", Gst.Rank.NONE, MilestoneXprotectSrc)
+
+NTP_CAPS = Gst.Caps.from_string("timestamp/x-ntp")
+
+# Seconds between checking a segment's pipeline for errors (and the export for cancelling) while waiting for a frame
+POLL_INTERVAL = 0.1
+
+class ExportError(Exception):
+  pass
+
+class SegmentOutput:
+  """
+  Where one segment's frames go - spooled to a temporary file (created on the first frame) while an earlier segment
+  is still being written, then straight to the output once it's this segment's turn
+  """
+  def __init__(self, output):
+    self._output = output
+    self._spool = None
+    self._direct = False
+    self._lock = threading.Lock()
+
+  def write(self, data: bytes):
+    with self._lock:
+      if self._direct:
+        self._output.write(data)
+        return
+      if self._spool is None:
+        self._spool = tempfile.TemporaryFile()
+      self._spool.write(data)
+
+  def make_direct(self):
+    """
+    Writes out anything spooled so far, and sends the rest of the segment straight to the output
+    """
+    with self._lock:
+      if self._spool is not None:
+        self._spool.seek(0)
+        shutil.copyfileobj(self._spool, self._output)
+        self._spool.close()
+        self._spool = None
+      self._direct = True
+
+  def close(self):
+    with self._lock:
+      if self._spool is not None:
+        self._spool.close()
+        self._spool = None
+
+class SegmentedExport:
+  """
+  Exports recordings for a time range by splitting it into segments, playing each segment back on its own recorder
+  connection (at most concurrency at once), and writing the segments out in order as one stream.
+
+  Segments are half open - a frame belongs to the segment its timestamp falls in - so the output has every frame
+  exactly once, the same as one playback of the whole range would.
+  """
+  def __init__(self, properties, start_ms, end_ms, segment_ms=300000, concurrency=4, timeout=60):
+    self.properties = properties
+    self.start_ms = start_ms
+    self.end_ms = end_ms
+    self.segment_ms = segment_ms
+    self.concurrency = concurrency
+    self.timeout = timeout
+    self._cancelled = threading.Event()
+
+  def segments(self):
+    segments = []
+    start = self.start_ms
+    while start < self.end_ms:
+      end = min(start + self.segment_ms, self.end_ms)
+      segments.append((start, end))
+      start = end
+    return segments
+
+  def _pull(self, segment, sink, bus):
+    """
+    Returns the segment's next sample, or None at its end (or if the export was cancelled). Raises ExportError as soon
+    as the pipeline posts an error, as appsink isn't woken by one, or once timeout passes without a frame
+    """
+    start, end = segment
+    deadline = time.monotonic() + self.timeout
+    while not self._cancelled.is_set():
+      sample = sink.try_pull_sample(int(POLL_INTERVAL * Gst.SECOND))
+      if sample is not None:
+        return sample
+      message = bus.pop_filtered(Gst.MessageType.ERROR)
+      if message is not None:
+        error, debug = message.parse_error()
+        raise ExportError("Segment %d-%d failed: %s" % (start, end, error.message))
+      if sink.get_property("eos"):
+        return None
+      if time.monotonic() >= deadline:
+        raise ExportError("Segment %d-%d timed out" % (start, end))
+    return None
+
+  def _fetch(self, segment, output):
+    """
+    Plays back one segment into output (a SegmentOutput), returning the number of frames written
+    """
+    start, end = segment
+    pipeline = Gst.Pipeline.new("segment-%d" % start)
+    src = Gst.ElementFactory.make("milestonexprotectsrc")
+    for name, value in self.properties.items():
+      src.set_property(name, value)
+    src.set_property("mode", "playback")
+    src.set_property("playback-start", start)
+    src.set_property("playback-end", end)
+    # The PTS is clamped at the segment start, so use the camera timestamp to place frames in segments
+    src.set_property("write-camera-timestamp", True)
+    sink = Gst.ElementFactory.make("appsink")
+    sink.set_property("sync", False)
+    sink.set_property("max-buffers", 64)
+    pipeline.add(src)
+    pipeline.add(sink)
+    src.link(sink)
+
+    frames = 0
+    bus = pipeline.get_bus()
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+      while True:
+        sample = self._pull(segment, sink, bus)
+        if sample is None:
+          break
+
+        buf = sample.get_buffer()
+        meta = buf.get_reference_timestamp_meta(NTP_CAPS)
+        if meta is not None:
+          time_ms = meta.timestamp // Gst.MSECOND
+          # Frames outside [start, end) belong to the neighbouring segments
+          if time_ms < start or time_ms >= end:
+            continue
+        output.write(buf.extract_dup(0, buf.get_size()))
+        frames += 1
+    finally:
+      pipeline.set_state(Gst.State.NULL)
+    return frames
+
+  def _fetch_segment(self, segment, output):
+    try:
+      return self._fetch(segment, output)
+    except:
+      self._cancelled.set()
+      raise
+
+  def run(self, output):
+    """
+    Exports the range to output (a binary file object), returning the number of frames written
+    """
+    total = 0
+    outputs = [SegmentOutput(output) for segment in self.segments()]
+    try:
+      with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+        futures = [executor.submit(self._fetch_segment, segment, segment_output) for segment, segment_output in zip(self.segments(), outputs)]
+        try:
+          # Segments are written in order - each one streams straight to output once every segment before it is written
+          for segment, segment_output, future in zip(self.segments(), outputs, futures):
+            segment_output.make_direct()
+            frames = future.result()
+            total += frames
+            logger.info("Exported segment %d-%d (%d frames)" % (segment[0], segment[1], frames))
+        except:
+          self._cancelled.set()
+          for future in futures:
+            future.cancel()
+          raise
+    finally:
+      # Only after the executor has waited for every segment, so nothing is still writing to them
+      for segment_output in outputs:
+        segment_output.close()
+    return total
+
+def parse_time(value):
+  """
+  Parses a time as milliseconds since the epoch, or an ISO 8601 date (UTC if no timezone is given)
+  """
+  if value.isdigit():
+    return int(value)
+  time = datetime.fromisoformat(value)
+  if time.tzinfo is None:
+    time = time.replace(tzinfo=timezone.utc)
+  return int(time.timestamp() * 1000)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Export recordings from Milestone XProtect over parallel recorder connections")
+  parser.add_argument("--management-server", required=True)
+  parser.add_argument("--user-domain", required=True, help="Domain name to log in with, or BASIC to use basic auth")
+  parser.add_argument("--user-id", required=True)
+  parser.add_argument("--user-pw", required=True)
+  parser.add_argument("--camera-id", required=True)
+  parser.add_argument("--hardware-id", default="")
+  parser.add_argument("--force-management-address", action="store_true")
+  parser.add_argument("--resolution-cache-ttl", type=int, default=3600, help="Seconds to cache the camera's recorder, so only the first segment resolves it (default 3600)")
+  parser.add_argument("--resolution-cache", default="", help="Path of the resolution cache database (defaults to the element's)")
+  parser.add_argument("--start", required=True, type=parse_time, help="Milliseconds since the epoch, or an ISO 8601 date")
+  parser.add_argument("--end", required=True, type=parse_time, help="Milliseconds since the epoch, or an ISO 8601 date")
+  parser.add_argument("--segment", type=int, default=300, help="Segment length in seconds (default 300)")
+  parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of recorder connections at once (default 4)")
+  parser.add_argument("--output-mode", choices=("genericbytedata", "elementary"), default="genericbytedata")
+  parser.add_argument("--output", default="-", help="File to write to, or - for stdout")
+  args = parser.parse_args()
+
+  properties = {
+    "management-server": args.management_server,
+    "user-domain": args.user_domain,
+    "user-id": args.user_id,
+    "user-pw": args.user_pw,
+    "camera-id": args.camera_id,
+    "hardware-id": args.hardware_id,
+    "force-management-address": args.force_management_address,
+    # Without a hardware ID each segment's element would fetch the whole site configuration otherwise
+    "resolution-cache-ttl": args.resolution_cache_ttl,
+    "resolution-cache": args.resolution_cache,
+    "output-mode": args.output_mode,
+  }
+  export = SegmentedExport(properties, args.start, args.end, args.segment * 1000, args.concurrency)
+
+  if args.output == "-":
+    frames = export.run(sys.stdout.buffer)
+  else:
+    with open(args.output, "wb") as output:
+      frames = export.run(output)
+  logger.info("Exported %d frames" % frames)
@@ -1,54 +1,64 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import gi
-import re
+import hashlib
 from inspect import currentframe
-from pytz import UTC
-from requests import auth, Session
-from requests.adapters import HTTPAdapter
-from requests_ntlm import HttpNtlmAuth
+import os
+import random
 from socket import *
+import sqlite3
 import ssl
+import struct
+import threading
+import time
 from urllib.parse import urlparse
 import uuid
-import urllib3
-import xml.etree.ElementTree as ET
-from zeep import Client
-from zeep.exceptions import Fault
-from zeep.cache import SqliteCache
-from zeep.transports import Transport
-from zeep.wsdl import Document
+
+# The SOAP / HTTP stack (zeep, requests, requests_ntlm, urllib3) and ElementTree are imported by import_dependencies
+# on first use (and asyncio by IngestEngine), as gst-python imports this module on every registry scan and plugin load.
+# They're used through xprotectlib.soap, which sets them up
+UTC = timezone.utc
 
 gi.require_version('Gst', '1.0')
 gi.require_version('GstBase', '1.0')
 
-from gi.repository import Gst, GObject, GstBase
+from gi.repository import Gst, GLib, GObject, GstBase
+
+from xprotectlib import soap
+from xprotectlib.imageserver import (DEFAULT_QUEUE_SIZE, GBD_CODEC_JPEG, GBD_DATATYPE_VIDEO, GBD_FLAG_SYNC, GBD_HEADER_LENGTH,
+                                     MESSAGE_EMPTY, MESSAGE_IMAGE, MESSAGE_LIVEPACKAGE, MESSAGE_METHODRESPONSE, MESSAGE_UNKNOWN,
+                                     Buffer, FrameFilter, FrameQueue, ReaderSocket, classify_message, content_length,
+                                     current_timestamp, gbd_is_keyframe, parse_gbd_header, request_id)
+from xprotectlib.ptz import PtzWorker, ptz_command
+from xprotectlib.resolution import ResolutionCache
+from xprotectlib.soap import HTTP_TIMEOUT, HttpSessions, RecorderResolver, WsdlCache, etree_to_dict, get_oauth_token, get_ssl_context, import_dependencies
 
 OCAPS = Gst.Caps.from_string (
         'application/x-genericbytedata-octet-stream')
 
+# Caps for each GenericByteData codec when outputting the elementary stream
+GBD_CODEC_CAPS = {
+  0x0001: Gst.Caps.from_string('image/jpeg'),
+  0x000A: Gst.Caps.from_string('video/x-h264'),
+  0x000E: Gst.Caps.from_string('video/x-h265'),
+}
 
-def etree_to_dict(t):
-  """
-  Helper function to convert an XML element to a dict (for fault messages)
-  """
-  tree = {}
-  for child in t:
-    value = child.text
-    if value is None:
-      value = etree_to_dict(child)
-    tree[child.tag] = value
-  return tree
-
-# Global SSL context to use for requests library, and our own socket
-ssl_context = ssl._create_unverified_context()
-ssl_context.minimum_version = ssl.TLSVersion.TLSv1_1
-ssl_context.set_ciphers("DEFAULT:@SECLEVEL=0") # OpenSSL 3.0.1 moved TLS1.1 to SEC level 0
-
-# Class to take the SSL context and apply it for requests library
-class SSLAdapter(HTTPAdapter):
-  def init_poolmanager(self, *args, **kwargs):
-    kwargs["ssl_context"] = ssl_context
-    return super().init_poolmanager(*args, **kwargs)
+SRC_CAPS = Gst.Caps.from_string (
+        'application/x-genericbytedata-octet-stream; video/x-h264; video/x-h265; image/jpeg')
+
+OUTPUT_MODES = ("genericbytedata", "elementary")
+
+MODES = ("live", "playback")
+
+# How long before the token expires to renew it, plus up to RENEW_JITTER seconds so many sessions don't renew at once
+RENEW_MARGIN = timedelta(seconds=120)
+RENEW_JITTER = 30
+
+# Delay before the second reconnect attempt (the first is immediate), doubling up to RECONNECT_MAX_DELAY, plus up to the same again as jitter
+RECONNECT_INITIAL_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5.0
+
+# Seconds stopping the element waits for the PTZ worker to send a pending stop, before leaving it to finish in the background
+PTZ_CLOSE_TIMEOUT = 2.0
 
 # Function to add a message to the element
 def element_message(element, domain, code, message, debug=None, message_type="error"):
@@ -63,96 +73,417 @@ def element_message(element, domain, code, message, debug=None, message_type="er
     else:
       element.message_full(Gst.MessageType.WARNING, domain.quark(), code, message, debug, filename, function, line)
 
-"""
-  Gets an OAuth token for the given hostname, domain, username and password
-"""
-def get_oauth_token(hostname: str, domain: str, username: str, password: str) -> str | None:
-  session = Session()
-  session.mount("https://", SSLAdapter())
-  session.verify = False # Highly unlikely we'll trust the Milestone cert, so just ignore errors
-
-  # Check Oauth supported
-  r = session.get("https://" + hostname + "/idp/.well-known/openid-configuration")
-  if r.status_code != 200:
-    return None
-
-  body = r.json()
-
-  if "server_version" not in body:
-    return None
-
-  # Check server version supports OAuth
-  matches = re.search(r"(?P<major>\d+)\.(?P<minor>\d+)(?:\.(\d+))?", body["server_version"])
-  if matches is None or int(matches.group("major")) < 21:
-    return None
-
-  token_endpoint = body["token_endpoint"]
-  data = {
-    "client_id": "GrantValidatorClient"
-  }
-
-  auth = None
-  if domain == "BASIC":
-    data.update({
-      "grant_type": "password",
-      "username": username,
-      "password": password
-    })
-  else:
-    data.update({
-      "grant_type": "windows_credentials",
-    })
-    auth = HttpNtlmAuth(domain + "\\" + username, password)
-
-  r = session.post(token_endpoint, auth=auth, data=data, headers={"Accept": "application/json"})
-  if r.status_code != 200:
-    return None
-
-  return r.json()["access_token"]
-
-class Buffer:
-  def __init__(self,sock):
-    self.sock = sock
-    self.buffer = b''
-
-  def get_line(self):
+class ManagementSessionError(Exception):
+  pass
+
+class ManagementSession:
+  """
+  SOAP client and login for a management server, shared by every element in the process using the same
+  server, domain, user, password and force-management-address. The OAuth / WSDL / Login handshake happens once,
+  and the token is renewed ahead of expiry on a background thread and handed to every subscribed element
+  """
+  _sessions = {}
+  _lock = threading.Lock()
+
+  @classmethod
+  def acquire(cls, management_server: str, domain: str, username: str, password: str, force_management_address: bool = False) -> "ManagementSession":
+    """
+    Returns the logged in session for this server / domain / user (and password and force_management_address, so a
+    wrong or changed password never reuses another element's login), logging in if it's the first user.
+    Every acquire must be matched with a release
+    """
+    import_dependencies()
+    key = (management_server.lower(), domain.lower(), username.lower(), hashlib.sha256(password.encode()).hexdigest(), force_management_address)
+    with cls._lock:
+      session = cls._sessions.get(key)
+      if session is None:
+        session = cls(key, management_server, domain, username, password, force_management_address)
+        cls._sessions[key] = session
+      session._refs += 1
+
     try:
-      buf = self.get_buffer()
+      session._ensure_logged_in()
     except:
-     raise
-    if buf is None:
-      return buf
+      session.release()
+      raise
+    return session
+
+  def __init__(self, key, management_server: str, domain: str, username: str, password: str, force_management_address: bool):
+    self._key = key
+    self._refs = 0
+    self._lock = threading.RLock()
+    self._subscribers = []
+
+    self.management_server = management_server
+    self.domain = domain
+    self.username = username
+    self.password = password
+    self.force_management_address = force_management_address
+
+    self.client = None
+    self.service = None
+    self.resolver: RecorderResolver | None = None
+    self.instance_id = str(uuid.uuid4())
+    self.login_token: str | None = None
+    self.renew_time: datetime | None = None
+    self.expiry_time: datetime | None = None
+    self._stopped = threading.Event()
+
+    # Token renewal statistics, reported in each element's stats
+    self.renewals = 0
+    self.renewal_failures = 0
+    self.renewal_last_ms = 0.0
+    self.renewal_total_ms = 0.0
+
+  def release(self):
+    with ManagementSession._lock:
+      self._refs -= 1
+      if self._refs == 0 and ManagementSession._sessions.get(self._key) is self:
+        del ManagementSession._sessions[self._key]
+        self._stopped.set()
+
+  def subscribe(self, callback):
+    """
+    Registers callback(token) to be called (from the renewal thread) whenever the token is renewed,
+    or with None if the token expired before it could be renewed
+    """
+    with self._lock:
+      self._subscribers.append(callback)
+
+  def unsubscribe(self, callback):
+    with self._lock:
+      if callback in self._subscribers:
+        self._subscribers.remove(callback)
+
+  def _get_wsdl(self, bypass_oauth=False):
+    # Try OAuth first
+    oauth = get_oauth_token(self.management_server, self.domain, self.username, self.password) if not bypass_oauth else None
+
+    if oauth is not None:
+      Gst.info("Using OAuth token")
+      session = HttpSessions.get(self.management_server, self.domain, self.username, self.password, oauth=True)
+      session.headers.update({"Authorization": "Bearer " + oauth})
+      url = "https://" + self.management_server + "/ManagementServer/ServerCommandServiceOAuth.svc?singleWsdl"
+    else:
+      Gst.info("Using standard auth")
+      session = HttpSessions.get(self.management_server, self.domain, self.username, self.password)
+      if self.domain == "BASIC":
+        url = "https://" + self.management_server + "/ManagementServer/ServerCommandService.svc?wsdl"
+      else:
+        # TODO: This endpoint is marked as deprecated, but testing against a 2020R3 release doesn't work with the new endpoint?
+        url = "http://" + self.management_server + "/ServerAPI/ServerCommandService.asmx?wsdl"
 
-    # If we can't decode, just try again
     try:
-      decode = buf.decode().strip()
-      return decode
+      Gst.Info("Getting WSDL - bypass_oauth: %s" % bypass_oauth)
+      # WSDL is available over HTTP (without auth) but not HTTPS
+      wsdl = WsdlCache.get(url.replace("https:", "http:"))
     except:
-      return self.get_line()
-
-  def get_buffer(self):
-    while b'\r\n\r\n' not in self.buffer:
       try:
-        data = self.sock.recv(1024)
+        Gst.info("Getting WSDL - bypass_oath: %s (second attempt, with auth)" % bypass_oauth)
+        wsdl = WsdlCache.get(url, session)
       except:
-        raise
-      if not data: # socket closed
-        return None
-      self.buffer += data
-    buf,sep,self.buffer = self.buffer.partition(b'\r\n\r\n')
-    return buf
+        return (None, None)
+
+    return (wsdl, session)
+
+  def _ensure_logged_in(self):
+    with self._lock:
+      if self.login_token is not None:
+        return
+
+      wsdl, session = self._get_wsdl()
+
+      if wsdl is None:
+        wsdl, session = self._get_wsdl(bypass_oauth=True)
+
+      if wsdl is None:
+        raise ManagementSessionError("Error getting WSDL (via oauth or fallback) - likely an authentication failure")
 
-  def get_buffer_size(self, size: int):
-    while len(self.buffer) < size:
       try:
-        data = self.sock.recv(4096)
+        Gst.info("Instantiating SOAP Client")
+        self.client = soap.Client(wsdl, transport=soap.Transport(cache=WsdlCache.sqlite_cache(), session=session, timeout=HTTP_TIMEOUT, operation_timeout=HTTP_TIMEOUT))
       except:
-        raise
-      if not data: # socket closed
-        return None
-      self.buffer += data
-    buf,sep,self.buffer = self.buffer.partition(b'\r\n\r\n')
-    return buf
+        raise ManagementSessionError("Error getting WSDL - likely an authentication failure")
+
+      if self.force_management_address and "address" in self.client.service._binding_options:
+        # Replace the hostname in the WSDL with the one we're using
+        parsed = urlparse(self.client.service._binding_options["address"])
+        self.client.service._binding_options["address"] = parsed._replace(netloc=self.management_server).geturl()
+
+      self.service = self.client.service
+      self.resolver = RecorderResolver(self.service)
+
+      Gst.info("Performing login")
+      try:
+        login = self.service.Login(instanceId=self.instance_id)
+      except Exception as e:
+        raise ManagementSessionError("Error logging in to management server - %s" % str(e))
+      self._set_login(login)
+
+      threading.Thread(target=self._renew_loop, name="xprotect-renew", daemon=True).start()
+
+  def _set_login(self, login):
+    self.login_token = login.Token
+    self.expiry_time = login.RegistrationTime + timedelta(microseconds=login.TimeToLive.MicroSeconds)
+    self.renew_time = self.expiry_time - RENEW_MARGIN - timedelta(seconds=random.uniform(0, RENEW_JITTER))
+
+  def _notify(self, token: str | None):
+    with self._lock:
+      subscribers = list(self._subscribers)
+    for callback in subscribers:
+      callback(token)
+
+  def _renew_loop(self):
+    """
+    Renews the token shortly before it expires, retrying with exponential backoff (and jitter) on failure
+    """
+    retry_delay = 1.0
+    expired_notified = False
+    while not self._stopped.wait(max(0.0, (self.renew_time - datetime.now(UTC)).total_seconds())):
+      try:
+        Gst.info("Renewing management server token")
+        started = time.perf_counter()
+        login = self.service.Login(instanceId=self.instance_id, currentToken=self.login_token)
+      except Exception as e:
+        Gst.warning("Error renewing management server token - %s" % str(e))
+        self.renewal_failures += 1
+        if not expired_notified and datetime.now(UTC) >= self.expiry_time:
+          expired_notified = True
+          self._notify(None)
+        self.renew_time = datetime.now(UTC) + timedelta(seconds=retry_delay * random.uniform(0.5, 1.5))
+        retry_delay = min(retry_delay * 2, 60.0)
+        continue
+
+      with self._lock:
+        self._set_login(login)
+        self.renewals += 1
+        self.renewal_last_ms = (time.perf_counter() - started) * 1000
+        self.renewal_total_ms += self.renewal_last_ms
+      retry_delay = 1.0
+      expired_notified = False
+      self._notify(self.login_token)
+
+class StreamStats:
+  """
+  Counters and timings for one element's stream. Updated from the streaming thread (and the reader thread or ingest
+  engine for livepackages and sequence numbers) and read from any thread through the stats property
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.frames = 0
+      self.bytes = 0
+      self.livepackages = 0
+      self.sequence_gaps = 0
+      self.wait_ns = 0
+      self.wait_max_ns = 0
+      self.parse_ns = 0
+      self.overhead_ns = 0
+      self.pushed = 0
+      self._sequence = None
+
+  def livepackage(self):
+    with self._lock:
+      self.livepackages += 1
+
+  def restart_sequence(self):
+    """
+    Forgets the last GenericByteData sequence number, e.g. after a seek, so the jump isn't counted as lost frames
+    """
+    with self._lock:
+      self._sequence = None
+
+  def sequence(self, data):
+    """
+    Records the GenericByteData sequence number of a frame as it's read off the socket, before the queue policy can
+    drop it, so only frames the recorder never sent are counted as gaps
+    """
+    if len(data) < GBD_HEADER_LENGTH:
+      return
+    sequence = struct.unpack_from(">H", data, 8)[0]
+    with self._lock:
+      if self._sequence is not None:
+        # 16 bit sequence numbers, so allow for wrapping (and ignore anything that looks like it went backwards)
+        gap = (sequence - self._sequence - 1) & 0xFFFF
+        if gap < 0x8000:
+          self.sequence_gaps += gap
+      self._sequence = sequence
+
+  def frame(self, size: int, wait_ns: int, parse_ns: int):
+    """
+    Records a frame taken by the streaming thread, with the time spent waiting for it and parsing its header
+    """
+    with self._lock:
+      self.frames += 1
+      self.bytes += size
+      self.wait_ns += wait_ns
+      self.wait_max_ns = max(self.wait_max_ns, wait_ns)
+      self.parse_ns += parse_ns
+
+  def push(self, overhead_ns: int):
+    """
+    Records a buffer pushed downstream, with the time do_create spent on it other than waiting for the socket
+    """
+    with self._lock:
+      self.pushed += 1
+      self.overhead_ns += overhead_ns
+
+  def to_structure(self, name: str, extra: dict) -> Gst.Structure:
+    """
+    Returns the stats as a Gst.Structure, with extra ({field: (type, value)}, type guint64, double or string) added
+    """
+    with self._lock:
+      frames = max(1, self.frames)
+      fields = {
+        "frames": ("guint64", self.frames),
+        "bytes": ("guint64", self.bytes),
+        "livepackages": ("guint64", self.livepackages),
+        "sequence-gaps": ("guint64", self.sequence_gaps),
+        "socket-wait-avg-us": ("double", self.wait_ns / frames / 1000),
+        "socket-wait-max-us": ("double", self.wait_max_ns / 1000),
+        "parse-avg-us": ("double", self.parse_ns / frames / 1000),
+        "overhead-avg-us": ("double", self.overhead_ns / max(1, self.pushed) / 1000),
+      }
+    fields.update(extra)
+    structure = Gst.Structure.new_empty(name)
+    for field, (field_type, value) in fields.items():
+      if field_type == "guint64":
+        # Python ints would be set as gint64
+        structure.set_value(field, GObject.Value(GObject.TYPE_UINT64, value))
+      elif field_type == "double":
+        structure.set_value(field, float(value))
+      else:
+        structure.set_value(field, value)
+    return structure
+
+class IngestConnection:
+  """
+  A recorder connection running on one of the IngestEngine's event loops.
+
+  The reader task parses messages off the socket and queues them as (response, body) tuples for the
+  element's streaming thread, pausing when the queue is full with the block policy. None is queued when the socket closes
+  """
+  def __init__(self, loop, host: str, port: int, tls: bool, frames: FrameQueue, frame_filter: FrameFilter | None = None, stats: StreamStats | None = None):
+    self._loop = loop
+    self._host = host
+    self._port = port
+    self._tls = tls
+    self.frames = frames
+    self.frame_filter = frame_filter
+    self.stats = stats
+    self._space = None
+    self._waiting = False
+    self._writer = None
+    self._task = None
+
+  async def _open(self):
+    self._space = asyncio.Event()
+    reader, self._writer = await asyncio.open_connection(self._host, self._port, ssl=get_ssl_context() if self._tls else None)
+    self._task = asyncio.ensure_future(self._read_messages(reader))
+
+  async def _read_messages(self, reader):
+    try:
+      while True:
+        # Stop reading (leaving the data with the kernel / recorder) until the element catches up
+        while self.frames.policy == "block" and self.frames.full():
+          self._waiting = True
+          self._space.clear()
+          if self.frames.full():
+            await self._space.wait()
+          self._waiting = False
+
+        header = await reader.readuntil(b'\r\n\r\n')
+        response = header[:-4].strip()
+        message_type = classify_message(response)
+        if message_type == MESSAGE_LIVEPACKAGE and self.stats is not None:
+          self.stats.livepackage()
+        if message_type == MESSAGE_EMPTY or message_type == MESSAGE_LIVEPACKAGE:
+          continue
+
+        if message_type == MESSAGE_IMAGE:
+          body = await reader.readexactly(content_length(response))
+          if self.frame_filter is not None:
+            if not self.frame_filter.wanted(response, body):
+              continue
+          elif self.stats is not None:
+            # Frames skipped by the filter would look like lost frames
+            self.stats.sequence(body)
+          self.frames.put((response, body), gbd_is_keyframe(body))
+        else:
+          self.frames.put((response, None))
+    except asyncio.CancelledError:
+      raise
+    except asyncio.IncompleteReadError:
+      self.frames.put(None)
+    except Exception as e:
+      self.frames.put(e)
+
+  def get(self, timeout: float | None = None):
+    """
+    Blocks until the next message is available. Raises queue.Empty on timeout, or the reader's exception if it failed
+    """
+    message = self.frames.get(timeout)
+    if self._waiting:
+      self._loop.call_soon_threadsafe(self._space.set)
+    return message
+
+  def send(self, data: bytes):
+    self._loop.call_soon_threadsafe(self._writer.write, data)
+
+  def close(self):
+    self._loop.call_soon_threadsafe(self._close)
+
+  def _close(self):
+    if self._task is not None:
+      self._task.cancel()
+    if self._writer is not None:
+      self._writer.close()
+
+class IngestEngine:
+  """
+  Process-wide set of asyncio event loops (each on its own thread) that multiplex the recorder
+  connections of every element using shared-ingest, instead of each element blocking in its own recv
+  """
+  _instance = None
+  _lock = threading.Lock()
+
+  @classmethod
+  def get(cls, loop_count: int = 1) -> "IngestEngine":
+    """
+    Returns the process' engine, starting it with loop_count loops if this is the first use
+    """
+    # Only needed for shared ingest, so it's imported here rather than at module load
+    global asyncio
+    import asyncio
+    with cls._lock:
+      if cls._instance is None:
+        cls._instance = cls(loop_count)
+      return cls._instance
+
+  def __init__(self, loop_count: int):
+    self._loops = []
+    self._next_loop = 0
+    for i in range(max(1, loop_count)):
+      loop = asyncio.new_event_loop()
+      threading.Thread(target=loop.run_forever, name="xprotect-ingest-%d" % i, daemon=True).start()
+      self._loops.append(loop)
+
+  def open(self, host: str, port: int, tls: bool, frames: FrameQueue, timeout: float | None = None, frame_filter: FrameFilter | None = None,
+           stats: StreamStats | None = None) -> IngestConnection:
+    """
+    Connects to the recorder on the next loop (round robin), blocking until it is connected
+    """
+    with self._lock:
+      loop = self._loops[self._next_loop % len(self._loops)]
+      self._next_loop += 1
+
+    connection = IngestConnection(loop, host, port, tls, frames, frame_filter, stats)
+    future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(connection._open(), timeout), loop)
+    future.result()
+    return connection
 
 class XmlGenerator:
   def __init__(self, token, camera_id):
@@ -161,6 +492,58 @@ class XmlGenerator:
     self._camera_id = camera_id
     self._token = token
 
+    # Stream selection and server side transcoding, see set_stream
+    self._stream_id = ""
+    self._jpeg = False
+    self._jpeg_width = 0
+    self._jpeg_height = 0
+    self._jpeg_quality = 0
+    self._jpeg_requested = False # Once JPEG has been asked for, connectupdate has to say whether it still is
+
+  @property
+  def request_id(self) -> int:
+    """
+    The request ID of the last method call generated
+    """
+    return self._request_id
+
+  def set_token(self, token):
+    self._token = token
+
+  def set_stream(self, stream_id: str = "", jpeg: bool = False, width: int = 0, height: int = 0, quality: int = 0):
+    """
+    Sets the stream requested by connect and connectupdate - stream_id selects one of the camera's streams (blank for
+    the default), and jpeg has the recorder transcode to JPEG, scaled down to fit width x height if they're set, with
+    the given quality (1 - 100, 0 for the recorder's default)
+    """
+    self._stream_id = stream_id
+    self._jpeg = jpeg
+    self._jpeg_requested = self._jpeg_requested or jpeg
+    self._jpeg_width = width
+    self._jpeg_height = height
+    self._jpeg_quality = quality
+
+  def _connect_param(self):
+    param = "id={camera_id}".format(camera_id=self._camera_id)
+    if self._stream_id != "":
+      param += "&amp;streamid={stream_id}".format(stream_id=self._stream_id)
+    return param + "&amp;connectiontoken={token}".format(token=self._token)
+
+  def _transcode(self):
+    if not self._jpeg:
+      return ""
+    transcode = ""
+    if self._jpeg_width != 0 and self._jpeg_height != 0:
+      transcode += """<transcode>
+<width>{width}</width>
+<height>{height}</height>
+<keepaspectratio>yes</keepaspectratio>
+<allowupsizing>no</allowupsizing>
+</transcode>""".format(width=str(self._jpeg_width), height=str(self._jpeg_height))
+    if self._jpeg_quality != 0:
+      transcode += "<compressionrate>{quality}</compressionrate>".format(quality=str(self._jpeg_quality))
+    return transcode
+
   def connect(self):
     self._request_id += 1
     return """<?xml version="1.0" encoding="UTF-8"?>
@@ -170,9 +553,10 @@ class XmlGenerator:
 <username>a</username>
 <password>a</password>
 <cameraid>a</cameraid>
-<alwaysstdjpeg>no</alwaysstdjpeg>
-<connectparam>id={camera_id}&amp;connectiontoken={token}</connectparam>
-</methodcall>""".format(request_id=str(self._request_id), camera_id=self._camera_id, token=self._token).replace("\n", "")
+<alwaysstdjpeg>{jpeg}</alwaysstdjpeg>
+<connectparam>{connect_param}</connectparam>
+{transcode}
+</methodcall>""".format(request_id=str(self._request_id), jpeg="yes" if self._jpeg else "no", connect_param=self._connect_param(), transcode=self._transcode()).replace("\n", "")
 
   def connect_update(self):
     self._request_id += 1
@@ -180,8 +564,10 @@ class XmlGenerator:
 <methodcall>
 <requestid>{request_id}</requestid>
 <methodname>connectupdate</methodname>
-<connectparam>id={camera_id}&amp;connectiontoken={token}</connectparam>
-</methodcall>""".format(request_id=str(self._request_id), camera_id=self._camera_id, token=self._token).replace("\n", "")
+{jpeg}
+<connectparam>{connect_param}</connectparam>
+{transcode}
+</methodcall>""".format(request_id=str(self._request_id), jpeg=("<alwaysstdjpeg>%s</alwaysstdjpeg>" % ("yes" if self._jpeg else "no")) if self._jpeg_requested else "", connect_param=self._connect_param(), transcode=self._transcode()).replace("\n", "")
 
   def live(self):
     self._request_id += 1
@@ -191,6 +577,292 @@ class XmlGenerator:
 <methodname>live</methodname>
 </methodcall>""".format(request_id=str(self._request_id)).replace("\n", "")
 
+  def goto(self, time_ms: int):
+    self._request_id += 1
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<methodcall>
+<requestid>{request_id}</requestid>
+<methodname>goto</methodname>
+<time>{time}</time>
+</methodcall>""".format(request_id=str(self._request_id), time=str(time_ms)).replace("\n", "")
+
+  def next(self):
+    self._request_id += 1
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<methodcall>
+<requestid>{request_id}</requestid>
+<methodname>next</methodname>
+</methodcall>""".format(request_id=str(self._request_id)).replace("\n", "")
+
+
+class SharedStreamError(Exception):
+  pass
+
+class SharedStream:
+  """
+  One live recorder connection for a camera, shared by every element in the process with fan-out set that streams the
+  same camera and stream, with the same login. The first subscriber connects, each frame is read once into a Gst.Buffer,
+  and every subscriber is queued a copy sharing its memory (so timestamps, meta and stripping the header only affect
+  that subscriber's copy). The shared stream renews its own token, and closes when the last subscriber leaves. If the
+  connection fails every subscriber gets the failure, and the next subscribe connects again.
+
+  Frames are only read as fast as the slowest subscriber with the block queue policy takes them
+  """
+  _streams = {}
+  _lock = threading.Lock()
+
+  @classmethod
+  def subscribe(cls, session: ManagementSession, host: str, port: int, tls: bool, camera_id: str, stream: tuple,
+                timeout: float | None, frames: FrameQueue, frame_filter: FrameFilter | None = None, stats: StreamStats | None = None) -> "SharedStreamSubscription":
+    """
+    Subscribes frames to the shared stream, connecting to the recorder if this is the first subscriber (or the stream
+    has failed or closed). stream is the XmlGenerator.set_stream arguments. Raises SharedStreamError if the connection
+    couldn't be established
+    """
+    key = (session._key, host.lower(), port, camera_id.lower(), stream)
+    with cls._lock:
+      shared = cls._streams.get(key)
+      # Replace a stream that has failed, rather than join it after it's passed the failure on to its subscribers
+      if shared is None or shared._failed or shared._closed:
+        shared = cls(key, session, host, port, tls, camera_id, stream, timeout)
+        cls._streams[key] = shared
+      subscription = SharedStreamSubscription(shared, frames, frame_filter, stats)
+      shared._subscribers.append(subscription)
+
+    try:
+      shared._open()
+    except:
+      subscription.close()
+      raise
+    return subscription
+
+  def __init__(self, key, session: ManagementSession, host: str, port: int, tls: bool, camera_id: str, stream: tuple, timeout: float | None):
+    self._key = key
+    self._session = session
+    self._host = host
+    self._port = port
+    self._tls = tls
+    self._camera_id = camera_id
+    self._stream = stream
+    self._timeout = timeout
+    self._subscribers = []
+    self._open_lock = threading.Lock()
+    self._send_lock = threading.Lock()
+    self._socket = None
+    self._reader_socket: ReaderSocket | None = None
+    self._buffer: Buffer | None = None
+    self._xml: XmlGenerator | None = None
+    self._reader: threading.Thread | None = None
+    self._failed = False
+    self._closed = False
+
+  def _open(self):
+    """
+    Connects and starts the live feed, if another subscriber hasn't already
+    """
+    with self._open_lock:
+      if self._reader is not None:
+        return
+      if self._failed or self._closed:
+        raise SharedStreamError("Unable to connect to recording server")
+
+      try:
+        self._connect()
+      except:
+        self._mark_failed()
+        self._close_socket()
+        if self._reader_socket is not None:
+          self._reader_socket.close()
+        raise
+
+      self._reader = threading.Thread(target=self._read_frames, name="xprotect-shared-%s" % self._camera_id, daemon=True)
+      self._reader.start()
+
+  def _connect(self):
+    # Hold our own reference, as the session has to outlive the element that started the stream
+    self._session = ManagementSession.acquire(self._session.management_server, self._session.domain, self._session.username,
+                                              self._session.password, self._session.force_management_address)
+    self._xml = XmlGenerator(self._session.login_token, self._camera_id)
+    self._xml.set_stream(*self._stream)
+    self._session.subscribe(self._on_token_renewed)
+
+    plain_sock = socket()
+    self._socket = get_ssl_context().wrap_socket(plain_sock) if self._tls else plain_sock
+    if self._timeout is not None:
+      self._socket.settimeout(self._timeout)
+    try:
+      self._socket.connect((self._host, self._port))
+    except OSError:
+      raise SharedStreamError("Unable to connect to recording server")
+    # The renewal thread sends connectupdates while the reader receives
+    self._reader_socket = ReaderSocket(self._socket) if self._tls else None
+    self._buffer = Buffer(self._reader_socket if self._reader_socket is not None else self._socket)
+
+    try:
+      self._send(self._xml.connect())
+      response = self._buffer.get_line()
+    except OSError:
+      raise SharedStreamError("Error getting initial connect response")
+    if response is None:
+      raise SharedStreamError("Socket with recording server closed")
+    elem = soap.ET.fromstring(response).find('connected')
+    if elem is None or elem.text != 'yes':
+      raise SharedStreamError("Unable to send start command to recording server")
+    self._send(self._xml.live())
+
+  def _send(self, xml: str):
+    data = bytes(xml, 'UTF-8') + b'\r\n\r\n'
+    if self._reader_socket is not None:
+      self._reader_socket.send(data)
+      return
+    with self._send_lock:
+      self._socket.sendall(data)
+
+  def _on_token_renewed(self, token: str | None):
+    # Every subscriber finds out about an expired token from the session itself
+    if token is None or self._closed:
+      return
+    self._xml.set_token(token)
+    try:
+      self._send(self._xml.connect_update())
+    except OSError:
+      pass # The reader sees the socket fail too
+
+  def _current_subscribers(self):
+    with SharedStream._lock:
+      return list(self._subscribers)
+
+  def _read_frames(self):
+    """
+    Reader thread - reads messages from the recording server and queues them for every subscriber
+    """
+    while True:
+      try:
+        response = self._buffer.get_line()
+        if response is None:
+          self._fail(None)
+          return
+        message_type = classify_message(response)
+        if message_type == MESSAGE_LIVEPACKAGE:
+          for subscription in self._current_subscribers():
+            if subscription.stats is not None:
+              subscription.stats.livepackage()
+        if message_type == MESSAGE_EMPTY or message_type == MESSAGE_LIVEPACKAGE:
+          continue
+        if message_type != MESSAGE_IMAGE:
+          # e.g. connectupdate responses, which every subscriber checks
+          for subscription in self._current_subscribers():
+            subscription.frames.put((response, None))
+          continue
+
+        size = content_length(response)
+        buf = Gst.Buffer.new_allocate(None, size, None)
+        with buf.map(Gst.MapFlags.WRITE) as info:
+          received = self._buffer.get_buffer_into(info.data)
+          start = bytes(info.data[:GBD_HEADER_LENGTH])
+        if not received:
+          self._fail(None)
+          return
+        keyframe = gbd_is_keyframe(start)
+        for subscription in self._current_subscribers():
+          subscription._put(response, buf, start, keyframe)
+      except Exception as e:
+        self._fail(e)
+        return
+
+  def _mark_failed(self):
+    """
+    Marks the stream failed and removes it, under the registry lock so every subscriber either joined before (and is
+    returned) or starts a new stream. Returns the subscribers to pass the failure on to
+    """
+    with SharedStream._lock:
+      self._failed = True
+      if SharedStream._streams.get(self._key) is self:
+        del SharedStream._streams[self._key]
+      if self._closed:
+        return []
+      return list(self._subscribers)
+
+  def _fail(self, error: Exception | None):
+    """
+    Passes the connection failing (None if the socket closed) on to every subscriber, so they can reconnect
+    """
+    for subscription in self._mark_failed():
+      subscription.frames.put(error)
+
+  def _unsubscribe(self, subscription: "SharedStreamSubscription"):
+    with SharedStream._lock:
+      if subscription in self._subscribers:
+        self._subscribers.remove(subscription)
+      if len(self._subscribers) > 0:
+        return
+      if SharedStream._streams.get(self._key) is self:
+        del SharedStream._streams[self._key]
+      self._closed = True
+    self._close()
+
+  def _close_socket(self):
+    if self._socket is not None:
+      try:
+        self._socket.shutdown(SHUT_RDWR)
+      except OSError:
+        pass
+      self._socket.close()
+    if self._xml is not None:
+      self._session.unsubscribe(self._on_token_renewed)
+      self._session.release()
+      self._xml = None
+
+  def _close(self):
+    with self._open_lock:
+      self._close_socket()
+      if self._reader is not None and self._reader is not threading.current_thread():
+        self._reader.join(self._timeout)
+      if self._reader_socket is not None:
+        self._reader_socket.close()
+
+class SharedStreamSubscription:
+  """
+  An element's subscription to a SharedStream, used in place of its own connection. Frames are queued on the element's
+  own FrameQueue, with its queue policy and frame filter. A subscriber joining a stream that's already running starts
+  at the next keyframe
+  """
+  def __init__(self, stream: SharedStream, frames: FrameQueue, frame_filter: FrameFilter | None, stats: StreamStats | None):
+    self._stream = stream
+    self.frames = frames
+    self.frame_filter = frame_filter
+    self.stats = stats
+    self._waiting_keyframe = stream._reader is not None
+
+  def _put(self, response: bytes, buf: Gst.Buffer, start: bytes, keyframe: bool):
+    if self._waiting_keyframe:
+      if not keyframe:
+        return
+      self._waiting_keyframe = False
+    if self.frame_filter is not None:
+      if not self.frame_filter.wanted(response, start):
+        return
+    elif self.stats is not None:
+      # Frames skipped by the filter would look like lost frames
+      self.stats.sequence(start)
+    # A new buffer sharing the memory, so nothing this subscriber does to it affects the others
+    self.frames.put((response, buf.copy_region(Gst.BufferCopyFlags.ALL, 0, buf.get_size())), keyframe)
+
+  def get(self, timeout: float | None = None):
+    """
+    Blocks until the next message is available. Raises queue.Empty on timeout, or the reader's exception if it failed
+    """
+    return self.frames.get(timeout)
+
+  def send(self, data: bytes):
+    """
+    Method calls from subscribers are ignored - the shared stream sends live and renews the token itself, and one
+    subscriber mustn't change what the others receive
+    """
+    pass
+
+  def close(self):
+    self._stream._unsubscribe(self)
 
 class MilestoneXprotectSrc(GstBase.BaseSrc):
     __gstmetadata__ = ('MilestoneXprotectSrc','Src', \
@@ -262,6 +934,191 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
                  False,
                  GObject.ParamFlags.READWRITE
                 ),
+        "resolution-cache-ttl": (int,
+                 "Resolution cache TTL",
+                 "Seconds to cache the camera's hardware and recorder on disk (shared between processes), so restarts skip resolving them through the management server. 0 disables the cache",
+                 0,
+                 GLib.MAXINT,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "resolution-cache": (str,
+                 "Resolution cache",
+                 "Path of the SQLite resolution cache. Defaults to milestonexprotectsrc/resolution.db in the user's cache directory",
+                 "",
+                 GObject.ParamFlags.READWRITE
+                ),
+        "mode": (str,
+                 "Mode",
+                 "live to stream the live feed, or playback to stream recordings from playback-start (seekable, and as fast as downstream and the recording server allow)",
+                 "live",
+                 GObject.ParamFlags.READWRITE
+                ),
+        "playback-start": (GObject.TYPE_INT64,
+                 "Playback start",
+                 "Time to start playback from, in milliseconds since the epoch (UTC)",
+                 0,
+                 GLib.MAXINT64,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "playback-end": (GObject.TYPE_INT64,
+                 "Playback end",
+                 "Time to end playback at, in milliseconds since the epoch (UTC). 0 plays until the end of the recordings",
+                 0,
+                 GLib.MAXINT64,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "playback-window": (int,
+                 "Playback window",
+                 "Number of next requests kept in flight to the recording server during playback, to hide the round trip per frame",
+                 1,
+                 1000,
+                 8,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "output-mode": (str,
+                 "Output mode",
+                 "genericbytedata to output the GenericByteData frames (for fromxprotectconverter), or elementary to strip the header in this element and output H.264 / H.265 / JPEG directly",
+                 "genericbytedata",
+                 GObject.ParamFlags.READWRITE
+                ),
+        "reader-thread": (bool,
+                 "Reader thread",
+                 "Read frames from the recording server on a separate thread into a bounded queue, so a stalled downstream doesn't leave frames building up in the socket",
+                 False,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "queue-size": (int,
+                 "Queue size",
+                 "Maximum number of frames queued by the reader thread or shared ingest engine",
+                 1,
+                 10000,
+                 DEFAULT_QUEUE_SIZE,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "queue-policy": (str,
+                 "Queue policy",
+                 "What to do with a new frame when the queue is full: block (stop reading from the recording server), drop-oldest, or drop-until-keyframe",
+                 "block",
+                 GObject.ParamFlags.READWRITE
+                ),
+        "queue-depth": (int,
+                 "Queue depth",
+                 "Number of messages currently queued by the reader thread or shared ingest engine",
+                 0,
+                 GLib.MAXINT,
+                 0,
+                 GObject.ParamFlags.READABLE
+                ),
+        "queue-dropped": (int,
+                 "Queue dropped",
+                 "Number of frames dropped by the queue policy",
+                 0,
+                 GLib.MAXINT,
+                 0,
+                 GObject.ParamFlags.READABLE
+                ),
+        "shared-ingest": (bool,
+                 "Shared ingest",
+                 "Read from the recording server on the process-wide asyncio ingest engine, shared by all elements with this set, rather than blocking in this element's streaming thread",
+                 False,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "ingest-loops": (int,
+                 "Ingest loops",
+                 "Number of event loop threads in the shared ingest engine. Only the first element to start with shared-ingest sets this",
+                 1,
+                 64,
+                 1,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "fan-out": (bool,
+                 "Fan out",
+                 "In live mode, share one recording server connection with every other element in the process with this set that streams the same camera and stream with the same login. Takes precedence over shared-ingest and reader-thread",
+                 False,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "keyframes-only": (bool,
+                 "Keyframes only",
+                 "Only output keyframes in live mode. Other frames are dropped before their body is read",
+                 False,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "frame-interval": (int,
+                 "Frame interval",
+                 "Minimum milliseconds (camera time) between frames in live mode, e.g. 1000 for one frame a second. Only keyframes are output, so the stream stays decodable. 0 outputs every frame",
+                 0,
+                 GLib.MAXINT,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "stream-id": (str,
+                 "Stream ID",
+                 "GUID of the camera stream to request (blank for the camera's default stream). Can be changed while playing",
+                 "",
+                 GObject.ParamFlags.READWRITE
+                ),
+        "jpeg-transcode": (bool,
+                 "JPEG transcode",
+                 "Have the recording server transcode the stream to JPEG. Can be changed while playing",
+                 False,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "jpeg-width": (int,
+                 "JPEG width",
+                 "Width to scale transcoded JPEGs down to fit (with jpeg-height, keeping the aspect ratio). 0 keeps the camera resolution",
+                 0,
+                 65535,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "jpeg-height": (int,
+                 "JPEG height",
+                 "Height to scale transcoded JPEGs down to fit (with jpeg-width, keeping the aspect ratio). 0 keeps the camera resolution",
+                 0,
+                 65535,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "jpeg-quality": (int,
+                 "JPEG quality",
+                 "Quality of transcoded JPEGs, 1 - 100 (0 uses the recording server's default)",
+                 0,
+                 100,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "stats": (Gst.Structure,
+                 "Statistics",
+                 "Stream statistics - frames and bytes received, livepackages, socket wait, header parse and per frame overhead times, token renewals, reconnects, GenericByteData sequence gaps and dropped frames",
+                 GObject.ParamFlags.READABLE
+                ),
+        "stats-interval": (int,
+                 "Statistics interval",
+                 "Milliseconds between posting the stats as an element message on the bus. 0 disables the message",
+                 0,
+                 GLib.MAXINT,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "reconnect-attempts": (int,
+                 "Reconnect attempts",
+                 "Number of times to try reconnecting to the recording server (reusing the login and resolved recorder) when the connection drops, before erroring. 0 disables reconnecting",
+                 0,
+                 1000,
+                 0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "reconnects": (int,
+                 "Reconnects",
+                 "Number of times the connection to the recording server has been re-established",
+                 0,
+                 GLib.MAXINT,
+                 0,
+                 GObject.ParamFlags.READABLE
+                ),
     }
 
     __gsignals__ = {
@@ -271,7 +1128,7 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
     __gsttemplates__ = Gst.PadTemplate.new("src",
                                            Gst.PadDirection.SRC,
                                            Gst.PadPresence.ALWAYS,
-                                           OCAPS)
+                                           SRC_CAPS)
 
     def __init__(self):
         GstBase.BaseSrc.__init__(self)
@@ -286,6 +1143,29 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
         self.force_management_address: bool = False
         self.timeout: float = 2.0
         self.write_camera_timestamp: bool = False
+        self.resolution_cache_ttl: int = 0
+        self.resolution_cache: str = ""
+        self.mode: str = "live"
+        self.playback_start: int = 0
+        self.playback_end: int = 0
+        self.playback_window: int = 8
+        self.output_mode: str = "genericbytedata"
+        self.reader_thread: bool = False
+        self.queue_size: int = DEFAULT_QUEUE_SIZE
+        self.queue_policy: str = "block"
+        self.shared_ingest: bool = False
+        self.ingest_loops: int = 1
+        self.fan_out: bool = False
+        self.reconnect_attempts: int = 0
+        self.reconnects: int = 0
+        self.stats_interval: int = 0
+        self.keyframes_only: bool = False
+        self.frame_interval: int = 0
+        self.stream_id: str = ""
+        self.jpeg_transcode: bool = False
+        self.jpeg_width: int = 0
+        self.jpeg_height: int = 0
+        self.jpeg_quality: int = 0
 
         self.set_live(True)
         self.set_do_timestamp(True)
@@ -294,6 +1174,33 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
         self.ntp_caps = None
 
         self._recorder_service_client = None
+        self._ptz: PtzWorker | None = None
+        self._ptz_lock = threading.Lock()
+        self._ptz_stopped = True
+        self.socket = None
+        self._reader_socket: ReaderSocket | None = None
+        self._connection: IngestConnection | SharedStreamSubscription | None = None
+        self._frames: FrameQueue | None = None
+        self._reader: threading.Thread | None = None
+        self.session: ManagementSession | None = None
+        self._resolution_cache: ResolutionCache | None = None
+        self._token_renewed = False
+        self._token_expired = False
+        self._stream_changed = False
+        self.xmlGenerator: XmlGenerator | None = None
+        self._codec: int | None = None
+        self._frame_filter: FrameFilter | None = None
+        self._stats = StreamStats()
+        self._stats_posted = 0.0
+        self._tls_session: ssl.SSLSession | None = None
+        self._unlocked = threading.Event()
+
+        # Playback state
+        self._playback_goto: int | None = None  # Time to send a goto for, set by seeks
+        self._playback_request = 0              # Request ID of the last goto, responses to earlier requests are stale
+        self._playback_outstanding = 0          # Requests sent that haven't had a response yet
+        self._playback_position = 0             # Time of the last goto sent
+        self._playback_last: int | None = None  # Time of the last frame output
 
     def do_get_property(self, prop):
         if prop.name == 'management-server':
@@ -316,6 +1223,58 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
             return self.timeout
         elif prop.name == 'write-camera-timestamp':
             return self.write_camera_timestamp
+        elif prop.name == 'resolution-cache-ttl':
+            return self.resolution_cache_ttl
+        elif prop.name == 'resolution-cache':
+            return self.resolution_cache
+        elif prop.name == 'mode':
+            return self.mode
+        elif prop.name == 'playback-start':
+            return self.playback_start
+        elif prop.name == 'playback-end':
+            return self.playback_end
+        elif prop.name == 'playback-window':
+            return self.playback_window
+        elif prop.name == 'output-mode':
+            return self.output_mode
+        elif prop.name == 'reader-thread':
+            return self.reader_thread
+        elif prop.name == 'queue-size':
+            return self.queue_size
+        elif prop.name == 'queue-policy':
+            return self.queue_policy
+        elif prop.name == 'queue-depth':
+            return len(self._frames) if self._frames is not None else 0
+        elif prop.name == 'queue-dropped':
+            return self._frames.dropped if self._frames is not None else 0
+        elif prop.name == 'shared-ingest':
+            return self.shared_ingest
+        elif prop.name == 'ingest-loops':
+            return self.ingest_loops
+        elif prop.name == 'fan-out':
+            return self.fan_out
+        elif prop.name == 'stats':
+            return self._stats_structure()
+        elif prop.name == 'stats-interval':
+            return self.stats_interval
+        elif prop.name == 'reconnect-attempts':
+            return self.reconnect_attempts
+        elif prop.name == 'reconnects':
+            return self.reconnects
+        elif prop.name == 'keyframes-only':
+            return self.keyframes_only
+        elif prop.name == 'frame-interval':
+            return self.frame_interval
+        elif prop.name == 'stream-id':
+            return self.stream_id
+        elif prop.name == 'jpeg-transcode':
+            return self.jpeg_transcode
+        elif prop.name == 'jpeg-width':
+            return self.jpeg_width
+        elif prop.name == 'jpeg-height':
+            return self.jpeg_height
+        elif prop.name == 'jpeg-quality':
+            return self.jpeg_quality
         else:
             raise AttributeError('Unable to get property %s' % prop.name)
 
@@ -340,6 +1299,56 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
             self.timeout = value
         elif prop.name == 'write-camera-timestamp':
             self.write_camera_timestamp = value
+        elif prop.name == 'resolution-cache-ttl':
+            self.resolution_cache_ttl = value
+        elif prop.name == 'resolution-cache':
+            self.resolution_cache = value
+        elif prop.name == 'mode':
+            if value not in MODES:
+              raise ValueError('Invalid mode %s, must be one of %s' % (value, ", ".join(MODES)))
+            self.mode = value
+            # Playback is timestamped from the recordings, in TIME, rather than as live data arrives
+            self.set_live(value == "live")
+            self.set_do_timestamp(value == "live")
+            self.set_format(Gst.Format.TIME if value == "playback" else Gst.Format.BYTES)
+        elif prop.name == 'playback-start':
+            self.playback_start = value
+        elif prop.name == 'playback-end':
+            self.playback_end = value
+        elif prop.name == 'playback-window':
+            self.playback_window = value
+        elif prop.name == 'output-mode':
+            if value not in OUTPUT_MODES:
+              raise ValueError('Invalid output-mode %s, must be one of %s' % (value, ", ".join(OUTPUT_MODES)))
+            self.output_mode = value
+        elif prop.name == 'reader-thread':
+            self.reader_thread = value
+        elif prop.name == 'queue-size':
+            self.queue_size = value
+        elif prop.name == 'queue-policy':
+            if value not in FrameQueue.POLICIES:
+              raise ValueError('Invalid queue-policy %s, must be one of %s' % (value, ", ".join(FrameQueue.POLICIES)))
+            self.queue_policy = value
+        elif prop.name == 'shared-ingest':
+            self.shared_ingest = value
+        elif prop.name == 'ingest-loops':
+            self.ingest_loops = value
+        elif prop.name == 'fan-out':
+            self.fan_out = value
+        elif prop.name == 'stats-interval':
+            self.stats_interval = value
+        elif prop.name == 'reconnect-attempts':
+            self.reconnect_attempts = value
+        elif prop.name == 'keyframes-only':
+            self.keyframes_only = value
+        elif prop.name == 'frame-interval':
+            self.frame_interval = value
+        elif prop.name in ('stream-id', 'jpeg-transcode', 'jpeg-width', 'jpeg-height', 'jpeg-quality'):
+            setattr(self, prop.name.replace('-', '_'), value)
+            if self.xmlGenerator is not None:
+              # Already connected, so do_create sends a connectupdate with the new stream
+              self._set_stream()
+              self._stream_changed = True
         else:
             raise AttributeError('Unable to set property %s to %s' % (prop.name, value))
 
@@ -347,112 +1356,72 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
       if self.camera_id == "" and self.hardware_id != "":
         return False
 
-      def get_wsdl(bypass_oauth=False):
-        session = Session()
-        session.mount("https://", SSLAdapter())
-        session.verify = False # Highly unlikely we'll trust the Milestone cert, so just ignore errors
-        urllib3.disable_warnings()
-
-        # Try OAuth first
-        oauth = get_oauth_token(self.management_server, self.user_domain, self.user_id, self.user_pw) if not bypass_oauth else None
-
-        if oauth is not None:
-          Gst.info("Using OAuth token")
-          session.headers.update({"Authorization": "Bearer " + oauth})
-          url = "https://" + self.management_server + "/ManagementServer/ServerCommandServiceOAuth.svc?singleWsdl"
-        else:
-          Gst.info("Using standard auth")
-          if self.user_domain == "BASIC":
-            url = "https://" + self.management_server + "/ManagementServer/ServerCommandService.svc?wsdl"
-            session.auth = auth.HTTPBasicAuth(username=self.user_id, password=self.user_pw)
-          else:
-            # TODO: This endpoint is marked as deprecated, but testing against a 2020R3 release doesn't work with the new endpoint?
-            url = "http://" + self.management_server + "/ServerAPI/ServerCommandService.asmx?wsdl"
-            session.auth = HttpNtlmAuth(self.user_domain + "\\" + self.user_id, self.user_pw)
-
-        try:
-          Gst.Info("Getting WSDL - bypass_oauth: %s" % bypass_oauth)
-          # WSDL is available over HTTP (without auth) but not HTTPS
-          wsdl = Document(url.replace("https:", "http:"), transport=Transport())
-        except:
-          try:
-            Gst.info("Getting WSDL - bypass_oath: %s (second attempt, with auth)" % bypass_oauth)
-            wsdl = Document(url, transport=Transport(session=session))
-          except:
-            return (None, None)
-
-        return (wsdl, session)
-
-      wsdl, session = get_wsdl()
-
-      if wsdl is None:
-        wsdl, session = get_wsdl(bypass_oauth=True)
-
-      if wsdl is None:
-        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Error getting WSDL (via oauth or fallback) - likely an authentication failure")
+      if self.mode == "playback" and self.playback_start == 0:
+        element_message(self, Gst.LibraryError, Gst.LibraryError.SETTINGS, "playback-start must be set in playback mode")
         return False
 
       try:
-        Gst.info("Instantiating SOAP Client")
-        self.client = Client(wsdl, transport=Transport(cache=SqliteCache(), session=session))
-      except:
-        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Error getting WSDL - likely an authentication failure")
+        self.session = ManagementSession.acquire(self.management_server, self.user_domain, self.user_id, self.user_pw, self.force_management_address)
+      except ManagementSessionError as e:
+        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, str(e))
         return False
-      self.instance_id = str(uuid.uuid4())
 
-      if self.force_management_address and "address" in self.client.service._binding_options:
-        # Replace the hostname in the WSDL with the one we're using
-        parsed = urlparse(self.client.service._binding_options["address"])
-        self.client.service._binding_options["address"] = parsed._replace(netloc=self.management_server).geturl()
-
-      self.service = self.client.service
-
-      Gst.info("Performing login")
-      login = self.service.Login(instanceId=self.instance_id)
-      self.login_token: str = login.Token
-      self.renew_time: datetime = login.RegistrationTime + timedelta(microseconds=login.TimeToLive.MicroSeconds) - timedelta(seconds=120)
+      try:
+        started = self._start()
+      except Exception as e:
+        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Error starting - %s" % str(e))
+        started = False
+      if not started:
+        # basesrc doesn't call stop after a failed start, so undo everything here (including releasing the session)
+        self.do_stop()
+      return started
+
+    def _start(self):
+      """
+        Resolves the recorder and connects to it, once do_start has the management session.
+        Returns False (having posted an error) on failure, leaving do_start to clean up
+      """
+      self.service = self.session.service
+      self.login_token: str = self.session.login_token
 
       # If we've got the recorder host set, just use that
       if self.recorder_host != "":
         self.recorder_port = 7563
         self._recorder_tls = False
       else:
+        recorder_url = None
+        if self.resolution_cache_ttl > 0:
+          try:
+            self._resolution_cache = ResolutionCache(self.resolution_cache, Gst.warning)
+          except sqlite3.Error as e:
+            Gst.warning("Unable to use resolution cache - %s" % str(e))
+          cached = self._with_cache(lambda cache: cache.lookup(self.management_server, self.camera_id, self.resolution_cache_ttl))
+
+          if cached is not None and (self.hardware_id == "" or cached[0] == self.hardware_id.lower()):
+            Gst.info("Using cached recording server for camera")
+            recorder_url = cached[1]
+
         # Work out which way we should obtain the recorder configuration
         # If we have the hardware ID, get it directly (and then set the camera-id if it was blank)
-        if self.hardware_id != "":
+        if recorder_url is None and self.hardware_id != "":
           Gst.info("Have a hardware ID, so getting harware config directly")
-          # array_of_guid = self.client.get_type('ns0:ArrayOfGuid')
-          hardware_ids = {"guid": [self.hardware_id]}
-          hardware_info = self.service.GetConfigurationHardware(login.Token, hardware_ids)
-          if hardware_info is None or len(hardware_info) < 1:
+          # The resolver is shared by every element on this session, so this is only a SOAP call for new hardware / recorders
+          resolved = self.session.resolver.resolve(self.login_token, [self.hardware_id])
+          if self.hardware_id.lower() not in resolved:
             element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Hardware ID not found")
             return False
+          recorder_url, device_ids = resolved[self.hardware_id.lower()]
 
           # Check the cameraId is mapped to the hardwareId
           if self.camera_id != "":
-            if self.camera_id.lower() not in hardware_info[0].DeviceIds.guid:
+            if self.camera_id.lower() not in device_ids:
               element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Camera ID supplied not found for that Hardware ID")
               return False
 
-          Gst.info("Getting recording server information")
-          recorder_info = self.service.QueryRecorderInfo(login.Token, hardware_info[0].RecorderId)
-
-          recorder_url = recorder_info.WebServerUri
+          self._with_cache(lambda cache: cache.store(self.management_server, [(self.camera_id, self.hardware_id, recorder_url)]))
         # Fallback to trawling through the whole configuration
-        else:
-          Gst.info("No Hardware ID supplied, getting whole site configuration")
-          config = self.service.GetConfiguration(token=login.Token)
-          Gst.info("Got site config")
-          recorder_url = None
-          for recorder in config.Recorders.RecorderInfo:
-            cameras = recorder.Cameras
-            if cameras is None or cameras.CameraInfo is None:
-              continue
-            for camera in cameras.CameraInfo:
-              if camera.DeviceId.lower() == self.camera_id.lower():
-                recorder_url = recorder.WebServerUri
-                break
-
+        elif recorder_url is None:
+          recorder_url = self._resolve_from_configuration()
           if recorder_url is None:
             element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Recorder for camera not found")
             return False
@@ -463,150 +1432,632 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
         self.recorder_host = recorder_result.hostname
         self.recorder_port = recorder_result.port
 
-      plain_sock = socket()
-      if self._recorder_tls:
-        self.socket = ssl_context.wrap_socket(plain_sock)
-      else:
-        self.socket = plain_sock
+      self._stats.reset()
+      self._stats_posted = time.monotonic()
+      self.xmlGenerator = XmlGenerator(self.login_token, self.camera_id)
+      self._set_stream()
+      # Playback is paced by next requests, so only live is filtered
+      if self.mode == "live" and (self.keyframes_only or self.frame_interval > 0):
+        self._frame_filter = FrameFilter(self.keyframes_only, self.frame_interval)
+      self.session.subscribe(self._on_token_renewed)
+
+      error = self._connect()
+      if error is not None:
+        self._disconnect()
+        self._invalidate_resolution()
+        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, error)
+        return False
+
+      Gst.info("Recording server connected")
+      with self._ptz_lock:
+        self._ptz_stopped = False
+      return True
+
+    def _with_cache(self, call):
+      """
+        Returns call(resolution cache), or None without the cache (the cache returns None itself once its database fails)
+      """
+      if self._resolution_cache is None:
+        return None
+      return call(self._resolution_cache)
+
+    def _resolve_from_configuration(self):
+      """
+        Finds the camera's recorder URL in the whole site configuration, or returns None. With the resolution cache,
+        only one element / process fetches it at a time, while the rest wait (up to FETCH_LEASE) to find it in the cache
+      """
+      if self._with_cache(lambda cache: cache.claim_fetch(self.management_server)) is False:
+        Gst.info("Waiting for another element to fetch the site configuration")
+        deadline = time.monotonic() + ResolutionCache.FETCH_LEASE
+        while time.monotonic() < deadline:
+          time.sleep(0.5)
+          cached = self._with_cache(lambda cache: cache.lookup(self.management_server, self.camera_id, self.resolution_cache_ttl))
+          if cached is not None:
+            return cached[1]
+          # The other fetch finished without this camera (or the cache failed), so fetch it ourselves
+          if self._with_cache(lambda cache: cache.claim_fetch(self.management_server)) is not False:
+            break
 
-      if self.timeout != 0.0:
-        self.socket.settimeout(self.timeout)
       try:
-        Gst.info("Connecting to recording server (TLS: %s) %s:%d" % (self._recorder_tls, self.recorder_host, self.recorder_port))
-        self.socket.connect((self.recorder_host, self.recorder_port))
-      except:
-        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Unable to connect to recording server")
-        return False
+        Gst.info("No Hardware ID supplied, getting whole site configuration")
+        config = self.service.GetConfiguration(token=self.login_token)
+        Gst.info("Got site config")
+        recorder_url = None
+        entries = []
+        for recorder in config.Recorders.RecorderInfo:
+          cameras = recorder.Cameras
+          if cameras is None or cameras.CameraInfo is None:
+            continue
+          for camera in cameras.CameraInfo:
+            entries.append((camera.DeviceId, camera.HardwareId, recorder.WebServerUri))
+            if camera.DeviceId.lower() == self.camera_id.lower():
+              recorder_url = recorder.WebServerUri
 
-      self.buffer = Buffer(self.socket)
-      self.xmlGenerator = XmlGenerator(self.login_token, self.camera_id)
+        # Cache every camera, so other cameras on the site don't need to fetch it again either
+        self._with_cache(lambda cache: cache.store(self.management_server, entries))
+      finally:
+        self._with_cache(lambda cache: cache.release_fetch(self.management_server))
+      return recorder_url
 
-      # Send the initial connect to make sure we're good to go
-      self.socket.sendall(bytes(self.xmlGenerator.connect(), 'UTF-8'))
-      self.socket.sendall(b'\r\n\r\n')
+    def _set_stream(self):
+      self.xmlGenerator.set_stream(self.stream_id, self.jpeg_transcode, self.jpeg_width, self.jpeg_height, self.jpeg_quality)
 
+    def _connect(self):
+      """
+        Connects to the recording server (or subscribes to the shared stream with fan-out), sends the initial connect and
+        starts the reader thread if needed.
+        Returns None on success, otherwise the error (the caller cleans up with _disconnect)
+      """
+      Gst.info("Connecting to recording server (TLS: %s) %s:%d" % (self._recorder_tls, self.recorder_host, self.recorder_port))
+      fan_out = self.fan_out and self.mode == "live"
+      if self.shared_ingest or self.reader_thread or fan_out:
+        # Playback paces itself with next requests, so nothing may be dropped or the window would stall
+        policy = "block" if self.mode == "playback" else self.queue_policy
+        self._frames = FrameQueue(self.queue_size, policy)
+
+      if fan_out:
+        # The shared stream sends the connect and live itself
+        try:
+          stream = (self.stream_id, self.jpeg_transcode, self.jpeg_width, self.jpeg_height, self.jpeg_quality)
+          self._connection = SharedStream.subscribe(self.session, self.recorder_host, self.recorder_port, self._recorder_tls, self.camera_id, stream,
+                                                    self.timeout if self.timeout != 0.0 else None,
+                                                    self._frames, self._frame_filter, self._stats)
+        except SharedStreamError as e:
+          return str(e)
+        except:
+          return "Unable to connect to recording server"
+        return None
+      elif self.shared_ingest:
+        try:
+          engine = IngestEngine.get(self.ingest_loops)
+          self._connection = engine.open(self.recorder_host, self.recorder_port, self._recorder_tls, self._frames, self.timeout if self.timeout != 0.0 else None, self._frame_filter, self._stats)
+        except:
+          return "Unable to connect to recording server"
+      else:
+        plain_sock = socket()
+        if self._recorder_tls:
+          # Resume the previous TLS session when reconnecting, to skip the full handshake
+          self.socket = get_ssl_context().wrap_socket(plain_sock, session=self._tls_session)
+        else:
+          self.socket = plain_sock
+
+        if self.timeout != 0.0:
+          self.socket.settimeout(self.timeout)
+        try:
+          self.socket.connect((self.recorder_host, self.recorder_port))
+        except:
+          return "Unable to connect to recording server"
+        if self._recorder_tls:
+          self._tls_session = self.socket.session
+
+        if self.reader_thread and self._recorder_tls:
+          # The streaming thread sends method calls while the reader thread receives, so the reader does the sending
+          self._reader_socket = ReaderSocket(self.socket)
+          self.buffer = Buffer(self._reader_socket)
+        else:
+          self.buffer = Buffer(self.socket)
+
+      # Send the initial connect to make sure we're good to go
       try:
-        response = self.buffer.get_line()
+        self._send(self.xmlGenerator.connect())
+        response, _ = self._read_message()
       except:
-        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Error getting initial connect response")
-        return False
-      root = ET.fromstring(response)
+        return "Error getting initial connect response"
+      if response is None:
+        return "Socket with recording server closed"
+      root = soap.ET.fromstring(response)
       elem = root.find('connected')
       if elem is None or elem.text != 'yes':
-        element_message(self, Gst.CoreError, Gst.CoreError.STATE_CHANGE, "Unable to send start command to recording server")
+        return "Unable to send start command to recording server"
+
+      if self.reader_thread and not self.shared_ingest:
+        self._reader = threading.Thread(target=self._read_frames, name="xprotect-reader-%s" % self.camera_id, daemon=True)
+        self._reader.start()
+
+      return None
+
+    def _disconnect(self):
+      """
+        Closes the connection to the recording server, leaving the management session alone
+      """
+      if self._frames is not None:
+        self._frames.close()
+      if self._connection is not None:
+        self._connection.close()
+        self._connection = None
+      if self.socket is not None:
+        # TLS 1.3 session tickets arrive after the handshake, so take the session again before closing
+        if self._recorder_tls and self.socket.session is not None:
+          self._tls_session = self.socket.session
+        # Shutdown first to wake up the reader thread if it's blocked in recv
+        try:
+          self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+          pass
+        self.socket.close()
+        self.socket = None
+      if self._reader is not None:
+        self._reader.join(self.timeout if self.timeout != 0.0 else None)
+        self._reader = None
+      if self._reader_socket is not None:
+        self._reader_socket.close()
+        self._reader_socket = None
+      self._frames = None
+
+    def _reconnect(self):
+      """
+        Re-establishes the connection to the recording server after it dropped, reusing the session's login token, the
+        resolved recorder address and the TLS session, backing off exponentially (with jitter) between attempts.
+        Restarts the live feed, or playback from the last frame. Returns False once reconnect-attempts have failed
+      """
+      if self.reconnect_attempts == 0:
         return False
 
-      Gst.info("Recording server connected")
+      delay = RECONNECT_INITIAL_DELAY
+      for attempt in range(self.reconnect_attempts):
+        self._disconnect()
+        if attempt > 0:
+          if self._unlocked.wait(delay + random.uniform(0, delay)):
+            return False
+          delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+        self.xmlGenerator.set_token(self.session.login_token)
+        # The new connection's sequence numbers don't follow on from the old one's
+        self._stats.restart_sequence()
+        error = self._connect()
+        if error is None:
+          Gst.info("Reconnected to recording server after %d attempt(s)" % (attempt + 1))
+          self.reconnects += 1
+          # The connect used the current token and stream, so there's no need for a connectupdate
+          self._token_renewed = False
+          self._stream_changed = False
+          if self.mode == "live":
+            self._send(self.xmlGenerator.live())
+          elif self._playback_goto is None:
+            self._playback_goto = self._playback_last if self._playback_last is not None else self._playback_position
+          return True
+        Gst.warning("Reconnect attempt %d failed - %s" % (attempt + 1, error))
+
+      self._disconnect()
+      self._invalidate_resolution()
+      return False
+
+    def do_unlock(self):
+      self._unlocked.set()
+      return True
 
+    def do_unlock_stop(self):
+      self._unlocked.clear()
       return True
 
-    def renew_token(self):
-      try:
-        Gst.info("Renewing token")
-        login = self.service.Login(instanceId=self.instance_id, currentToken=self.login_token)
-        self.login_token = login.Token
-        self.renew_time: datetime = login.RegistrationTime + timedelta(microseconds=login.TimeToLive.MicroSeconds) - timedelta(seconds=60)
-        self.socket.sendall(bytes(self.xmlGenerator.connect_update(), 'UTF-8'))
-        self.socket.sendall(b'\r\n\r\n')
-      except:
-        raise
+    def _invalidate_resolution(self):
+      """
+        Drops the camera from the resolution cache, so the next start resolves the recorder again
+      """
+      self._with_cache(lambda cache: cache.invalidate(self.management_server, self.camera_id))
+
+    def do_stop(self):
+      with self._ptz_lock:
+        ptz = self._ptz
+        self._ptz = None
+        self._ptz_stopped = True
+      if ptz is not None:
+        ptz.close(PTZ_CLOSE_TIMEOUT)
+      self._recorder_service_client = None
+      if self._resolution_cache is not None:
+        self._resolution_cache.close()
+        self._resolution_cache = None
+      if self.session is not None:
+        self.session.unsubscribe(self._on_token_renewed)
+        self.session.release()
+        self.session = None
+      self._disconnect()
+      self.xmlGenerator = None
+      self._frame_filter = None
+      self._stream_changed = False
+      self._tls_session = None
+      self._codec = None
+      self.started = False
+      return True
+
+    def do_is_seekable(self):
+      return self.mode == "playback"
+
+    def do_do_seek(self, segment):
+      if self.mode != "playback":
+        return False
+      # Picked up by do_create, which sends the goto from the streaming thread
+      self._playback_goto = self.playback_start + segment.start // Gst.MSECOND
+      self._playback_last = None
+      return True
+
+    def do_query(self, query):
+      if query.type == Gst.QueryType.DURATION and self.mode == "playback" and self.playback_end > self.playback_start:
+        fmt = query.parse_duration()[0]
+        if fmt == Gst.Format.TIME:
+          query.set_duration(Gst.Format.TIME, (self.playback_end - self.playback_start) * Gst.MSECOND)
+          return True
+      return GstBase.BaseSrc.do_query(self, query)
+
+    def _fill_playback_window(self):
+      while self._playback_outstanding < self.playback_window:
+        self._send(self.xmlGenerator.next())
+        self._playback_outstanding += 1
+
+    def _playback_frame(self, response: bytes, buf: Gst.Buffer):
+      """
+        Handles a frame received in playback mode - skips responses to requests from before the last goto, sets the PTS
+        from the frame time, detects the end of playback, and keeps the window of next requests full.
+        Returns a FlowReturn, or None if the frame should be skipped
+      """
+      request = request_id(response)
+      if request is not None and request < self._playback_request:
+        return None
+      self._playback_outstanding = max(0, self._playback_outstanding - 1)
+
+      current = current_timestamp(response)
+      if current is None or buf.get_size() == 0:
+        return Gst.FlowReturn.EOS
+      # After reconnecting, the goto returns the last frame output again
+      if request == self._playback_request and self._playback_last is not None and current <= self._playback_last:
+        self._fill_playback_window()
+        return None
+      if self.playback_end != 0 and current > self.playback_end:
+        return Gst.FlowReturn.EOS
+      # next returns the same frame again once there are no more recordings
+      if self._playback_last is not None and current <= self._playback_last:
+        return Gst.FlowReturn.EOS
+      self._playback_last = current
+
+      buf.pts = max(0, current - self.playback_start) * Gst.MSECOND
+      self._fill_playback_window()
+      return Gst.FlowReturn.OK
+
+    def do_negotiate(self):
+      if self.output_mode == "elementary":
+        # The caps depend on the codec, so they're set from the first frame in do_create
+        return True
+      return self.set_caps(OCAPS)
+
+    def _to_elementary(self, buf: Gst.Buffer):
+      """
+        Strips the GenericByteData header from buf in place (without copying the body), marks delta frames,
+        and sets the caps when the codec changes. Returns a FlowReturn, or None if the frame should be skipped
+      """
+      with buf.map(Gst.MapFlags.READ) as info:
+        header = parse_gbd_header(info.data)
+
+      # Only video is output, the same as fromxprotectconverter
+      if header is None or header[0] != GBD_DATATYPE_VIDEO:
+        return None
+
+      codec = header[2]
+      if codec != self._codec:
+        caps = GBD_CODEC_CAPS.get(codec)
+        if caps is None:
+          element_message(self, Gst.StreamError, Gst.StreamError.CODEC_NOT_FOUND, "Unsupported GenericByteData codec 0x%04x" % codec)
+          return Gst.FlowReturn.NOT_SUPPORTED
+        Gst.info("Setting caps for codec 0x%04x - %s" % (codec, caps.to_string()))
+        if not self.set_caps(caps):
+          return Gst.FlowReturn.NOT_NEGOTIATED
+        self._codec = codec
+
+      if not header[4] & GBD_FLAG_SYNC and codec != GBD_CODEC_JPEG:
+        buf.set_flags(Gst.BufferFlags.DELTA_UNIT)
+      buf.resize(GBD_HEADER_LENGTH, -1)
+      return Gst.FlowReturn.OK
+
+    def _send(self, xml: str):
+      """
+        Sends an XML method call to the recording server
+      """
+      data = bytes(xml, 'UTF-8') + b'\r\n\r\n'
+      if self._connection is not None:
+        self._connection.send(data)
+      elif self._reader_socket is not None:
+        self._reader_socket.send(data)
+      else:
+        self.socket.sendall(data)
+
+    def _read_message(self):
+      """
+        Returns the next (response, body) from the recording server, with response None if the socket closed.
+        body is only set for ImageResponses received by the reader thread or shared stream (a Gst.Buffer) or shared ingest engine (bytes) -
+        otherwise the caller reads the body from self.buffer
+      """
+      if self._connection is not None:
+        message = self._connection.get(self.timeout if self.timeout != 0.0 else None)
+        return message if message is not None else (None, None)
+      if self._reader is not None:
+        message = self._frames.get(self.timeout if self.timeout != 0.0 else None)
+        return message if message is not None else (None, None)
+      return (self.buffer.get_line(), None)
+
+    def _stats_structure(self) -> Gst.Structure:
+      session = self.session
+      dropped = self._frames.dropped if self._frames is not None else 0
+      filtered = self._frame_filter.dropped if self._frame_filter is not None else 0
+      renewals = session.renewals if session is not None else 0
+      return self._stats.to_structure("milestonexprotectsrc-stats", {
+        "camera-id": ("string", self.camera_id),
+        "recorder-host": ("string", self.recorder_host),
+        "token-renewals": ("guint64", renewals),
+        "token-renewal-failures": ("guint64", session.renewal_failures if session is not None else 0),
+        "token-renewal-last-ms": ("double", session.renewal_last_ms if session is not None else 0.0),
+        "token-renewal-avg-ms": ("double", session.renewal_total_ms / renewals if renewals > 0 else 0.0),
+        "reconnects": ("guint64", self.reconnects),
+        "queue-dropped": ("guint64", dropped),
+        "filtered": ("guint64", filtered),
+      })
+
+    def _record_push(self, created: int, waited: int):
+      """
+        Updates the stats for a buffer being pushed, and posts them if stats-interval has passed
+      """
+      self._stats.push(time.perf_counter_ns() - created - waited)
+      if self.stats_interval > 0:
+        now = time.monotonic()
+        if (now - self._stats_posted) * 1000 >= self.stats_interval:
+          self._stats_posted = now
+          self.post_message(Gst.Message.new_element(self, self._stats_structure()))
+
+    def _drop_frame(self, response: bytes, size: int):
+      """
+        Applies the frame filter to the next frame before its body is read, discarding the body if it isn't wanted.
+        Returns True if the frame was dropped, False if it should be read, or None if the socket closed
+      """
+      if self._frame_filter is None:
+        return False
+      start = self.buffer.peek(min(size, GBD_HEADER_LENGTH))
+      if start is None:
+        return None
+      if self._frame_filter.wanted(response, start):
+        return False
+      return True if self.buffer.skip(size) else None
+
+    def _read_frames(self):
+      """
+        Reader thread - reads messages from the recording server into the frame queue until the socket closes or errors
+      """
+      while True:
+        try:
+          response = self.buffer.get_line()
+          if response is None:
+            self._frames.put(None)
+            return
+          message_type = classify_message(response)
+          if message_type == MESSAGE_LIVEPACKAGE:
+            self._stats.livepackage()
+          if message_type == MESSAGE_EMPTY or message_type == MESSAGE_LIVEPACKAGE:
+            continue
+          if message_type != MESSAGE_IMAGE:
+            self._frames.put((response, None))
+            continue
+
+          size = content_length(response)
+          dropped = self._drop_frame(response, size)
+          if dropped is None:
+            self._frames.put(None)
+            return
+          if dropped:
+            continue
+
+          buf = Gst.Buffer.new_allocate(None, size, None)
+          with buf.map(Gst.MapFlags.WRITE) as info:
+            received = self.buffer.get_buffer_into(info.data)
+            keyframe = gbd_is_keyframe(info.data)
+            if received and self._frame_filter is None:
+              self._stats.sequence(info.data)
+          if not received:
+            self._frames.put(None)
+            return
+          self._frames.put((response, buf), keyframe)
+        except Exception as e:
+          self._frames.put(e)
+          return
+
+    def _on_token_renewed(self, token: str | None):
+      """
+        Called by the management session's renewal thread with the new token, or None if it expired.
+        The connectupdate is sent from the streaming thread (by way of the reader thread's ReaderSocket on TLS), never
+        from the renewal thread
+      """
+      if token is None:
+        self._token_expired = True
+        return
+      self.login_token = token
+      self.xmlGenerator.set_token(token)
+      self._token_expired = False
+      self._token_renewed = True
 
     # This method is called by gstreamer to create a buffer
     # We don't use the args
     def do_create(self, *args):
+      created = time.perf_counter_ns()
+      waited = 0 # Time spent waiting for the recording server, excluded from the overhead
       if self.started == False:
-        Gst.info("Sending start live command")
-        self.socket.sendall(bytes(self.xmlGenerator.live(), 'UTF-8'))
-        self.socket.sendall(b'\r\n\r\n')
+        if self.mode == "live":
+          Gst.info("Sending start live command")
+          self._send(self.xmlGenerator.live())
+        elif self._playback_goto is None:
+          self._playback_goto = self.playback_start
+          self._playback_last = None
         self.started = True
 
       while True:
-        if self.renew_time < datetime.now(UTC):
-          Gst.info("Renewing token with management server")
-          try:
-            self.renew_token()
-          except:
-            element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "Error renewing token")
+        # The goto has to be resent if the connection was re-established
+        if self.mode == "playback" and self._playback_goto is not None:
+          Gst.info("Sending playback goto %d" % self._playback_goto)
+          self._send(self.xmlGenerator.goto(self._playback_goto))
+          self._playback_position = self._playback_goto
+          self._playback_goto = None
+          self._playback_request = self.xmlGenerator.request_id
+          self._playback_outstanding = 1
+          self._stats.restart_sequence()
+
+        if self._token_expired:
+          element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "Error renewing token")
+          break
+
+        if self._stream_changed and isinstance(self._connection, SharedStreamSubscription):
+          # Another stream is another shared connection (and the shared stream renews its own token)
+          self._token_renewed = False
+          self._stream_changed = False
+          self._disconnect()
+          error = self._connect()
+          if error is not None:
+            element_message(self, Gst.ResourceError, Gst.ResourceError.READ, error)
             break
+          continue
+
+        if self._token_renewed or self._stream_changed:
+          self._token_renewed = False
+          self._stream_changed = False
+          self._send(self.xmlGenerator.connect_update())
 
+        wait_start = time.perf_counter_ns()
         try:
-          response = self.buffer.get_line()
+          response, body = self._read_message()
         except Exception as inst:
+          if self._reconnect():
+            continue
           element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "Error getting data from recording server")
           return (Gst.FlowReturn.EOS, None)
         # Socket closed, return with an EOS
         if response is None:
+          if self._reconnect():
+            continue
           element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "Socket with recording server closed")
           return (Gst.FlowReturn.EOS, None)
+        waited += time.perf_counter_ns() - wait_start
         try:
-          if response.startswith("ImageResponse"):
-            lines = response.splitlines()
-            headers = {}
-            for i in range(1, len(lines)):
-              key, val = lines[i].split(": ")
-              headers[key.lower()] = val
-
-            size = int(headers["content-length"])
+          parse_start = time.perf_counter_ns()
+          message_type = classify_message(response)
+          if message_type == MESSAGE_IMAGE:
+            size = content_length(response)
+            parsed = time.perf_counter_ns() - parse_start
+            frame_wait = time.perf_counter_ns() - wait_start
+
+            if Gst.debug_is_active():
+              Gst.trace("ImageResponse received\n%s" % response.decode(errors="replace"))
+            if isinstance(body, Gst.Buffer):
+              buf = body
+            elif body is not None:
+              buf = Gst.Buffer.new_wrapped(body)
+            else:
+              # Receive the body straight into the GstMemory, rather than building it up in Python first
+              body_start = time.perf_counter_ns()
+              try:
+                dropped = self._drop_frame(response, size)
+                if dropped is False:
+                  buf = Gst.Buffer.new_allocate(None, size, None)
+                  with buf.map(Gst.MapFlags.WRITE) as info:
+                    received = self.buffer.get_buffer_into(info.data)
+                    if received and self._frame_filter is None:
+                      self._stats.sequence(info.data)
+                else:
+                  received = dropped is not None
+              except:
+                if self._reconnect():
+                  continue
+                element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "Error getting buffer of fixed size")
+                break
+              if not received:
+                if self._reconnect():
+                  continue
+                element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "Socket with recording server closed")
+                return (Gst.FlowReturn.EOS, None)
+              if dropped:
+                continue
+              waited += time.perf_counter_ns() - body_start
+              frame_wait += time.perf_counter_ns() - body_start
 
-            Gst.trace("ImageResponse received\n%s" % response)
-            try:
-              mbytes = self.buffer.get_buffer_size(size)
-            except:
-              element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "Error getting buffer of fixed size")
-              break
-            buf = Gst.Buffer.new_wrapped(mbytes)
+            self._stats.frame(size, frame_wait - parsed, parsed)
 
-            if self.write_camera_timestamp and 'current' in headers:
-              try:
-                timestamp_ms = int(headers['current'])
+            if self.write_camera_timestamp:
+              timestamp_ms = current_timestamp(response)
+              if timestamp_ms is not None:
                 timestamp_ns = timestamp_ms * 1000000
 
                 if self.ntp_caps is None:
                   self.ntp_caps = Gst.Caps.from_string("timestamp/x-ntp")
 
                 buf.add_reference_timestamp_meta(self.ntp_caps, timestamp_ns, Gst.CLOCK_TIME_NONE)
-              except ValueError:
-                Gst.warning("Could not parse timestamp from 'current' header: %s" % headers['current'])
-            return (Gst.FlowReturn.OK, buf)
 
-          elif response.startswith("<?xml"):
-            try:
-              root = ET.fromstring(response)
-              if root.tag == 'livepackage':
-                Gst.debug("livepackage received\n%s" % response)
+            if self.mode == "playback":
+              ret = self._playback_frame(response, buf)
+              if ret is None:
                 continue
+              if ret != Gst.FlowReturn.OK:
+                return (ret, None)
 
-              # this is a response to a connectupdate
-              if root.tag == 'methodresponse':
-                elem = root.find('methodname')
-                if elem is not None and elem.text == "connectupdate":
-                  elem = root.find("connected")
-                  if elem is not None and elem.text == 'yes':
-                    # Success on the connectupdate - just ignore
-                    continue
-                  else:
-                    # Error doing a connectupdate
-                    message = "connectupdate failed %s" % response
-                    element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, response)
-                    break
-
-                message = "Unknown methodresponse - %s" % response
-                element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, response, "warning")
+            if self.output_mode == "elementary":
+              ret = self._to_elementary(buf)
+              if ret is None:
                 continue
+              if ret != Gst.FlowReturn.OK:
+                return (ret, None)
+            self._record_push(created, waited)
+            return (Gst.FlowReturn.OK, buf)
 
-            except:
-              message = "Error decoding XML - %s" % response
-              element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, response)
-              break
+          elif message_type == MESSAGE_LIVEPACKAGE:
+            # Status updates only, so these aren't worth parsing
+            self._stats.livepackage()
+            continue
 
-          else:
-            if response == "":
+          elif message_type == MESSAGE_METHODRESPONSE:
+            text = response.decode(errors="replace")
+            try:
+              root = soap.ET.fromstring(response)
+              # this is a response to a connectupdate
+              elem = root.find('methodname')
+              if elem is not None and elem.text == "connectupdate":
+                elem = root.find("connected")
+                if elem is not None and elem.text == 'yes':
+                  # Success on the connectupdate - just ignore
+                  continue
+                else:
+                  # Error doing a connectupdate
+                  message = "connectupdate failed %s" % text
+                  element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, text)
+                  break
+
+              message = "Unknown methodresponse - %s" % text
+              element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, text, "warning")
               continue
 
-            message = "Unknown response %s" % str(response)
-            element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, response, "warning")
+            except soap.ET.ParseError:
+              message = "Error decoding XML - %s" % text
+              element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, text)
+              break
 
-            continue
+          elif message_type == MESSAGE_UNKNOWN:
+            text = response.decode(errors="replace")
+            message = "Unknown response %s" % text
+            element_message(self, Gst.ResourceError, Gst.ResourceError.READ, message, text, "warning")
+
+          # Empty messages (the separator after each frame) and other XML are ignored
+          continue
 
         except Exception as inst:
           message = "Unknown exception encountered - %s" % type(inst).__name__
@@ -618,7 +2069,7 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
     def do_ptz(self, data, promise: Gst.Promise):
       """
         Virtual method called by GObject action signal to send a PTZ command
-        Establishes the service channel with the recorder if it hasn't already been done
+        Queues it for the PTZ worker, starting it (and so the service channel with the recorder) on the first command
       """
 
       if not self.started:
@@ -632,67 +2083,32 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
       y = data.get_value("y")
       z = data.get_value("z")
 
-
-      try:
-        if self._recorder_service_client is None:
-          self._setup_recorder_service_client()
-
-        Gst.info("Sending PTZ command")
-        # Build PTZ Args
-        if x == 0 and y == 0 and z == 0:
-          self._recorder_service_client.service.PTZMoveStop(token=self.login_token, deviceId=self.camera_id)
+      with self._ptz_lock:
+        if self._ptz_stopped:
           promise.reply(None)
           return
+        if self._ptz is None:
+          self._ptz = PtzWorker("xprotect-ptz-%s" % self.camera_id, self._send_ptz)
+        ptz = self._ptz
 
-        if x != 0 or y != 0:
-          pan = 0
-          tilt = 0
-
-          if x > 0:
-            pan = 1
-          elif x < 0:
-            pan = -1
-
-          if y > 0:
-            tilt = 1
-          elif y < 0:
-            tilt = -1
-
-          ptz_args = {
-            "movement": [
-              {"name": "pan", "value": pan},
-              {"name": "tilt", "value": tilt},
-            ],
-            "speed": [
-              {"name": "pan", "value": abs(x)},
-              {"name": "tilt", "value": abs(y)}
-            ],
-            "Normalized": False
-          }
-          self._recorder_service_client.service.PTZMoveStart(token=self.login_token, deviceId=self.camera_id, ptzArgs=ptz_args)
-          promise.reply(None)
-          return
+      # Replied to from the worker thread once the command has been sent (or superseded)
+      ptz.submit(x, y, z, promise)
 
-        if z != 0:
-          zoom = 0
-          if z > 0:
-            zoom = 1
-          elif z < 0:
-            zoom = -1
-          ptz_args = {
-            "movement": [
-              {"name": "zoom", "value": zoom},
-            ],
-            "speed": [
-              {"name": "zoom", "value": abs(z)},
-            ],
-            "Normalized": False
-          }
-
-          self._recorder_service_client.service.PTZMoveStart(token=self.login_token, deviceId=self.camera_id, ptzArgs=ptz_args)
-          promise.reply(None)
-          return
-      except Fault as fault:
+    def _send_ptz(self, x: float, y: float, z: float):
+      """
+        Sends one PTZ command (on the PTZ worker thread), returning None or the PTZError structure to reply with
+      """
+      try:
+        client = self._setup_recorder_service_client()
+
+        Gst.info("Sending PTZ command")
+        method, ptz_args = ptz_command(x, y, z)
+        if ptz_args is None:
+          getattr(client.service, method)(token=self.login_token, deviceId=self.camera_id)
+        else:
+          getattr(client.service, method)(token=self.login_token, deviceId=self.camera_id, ptzArgs=ptz_args)
+        return None
+      except soap.Fault as fault:
         Gst.warning("Error sending PTZ command (Zeep exception) - %s" % fault.message)
         tree = etree_to_dict(fault.detail)
         error_struct = Gst.Structure("PTZError")
@@ -700,39 +2116,36 @@ This can help when servers return a different hostname (i.e DNS instead of an IP
           error_struct.set_value("code", 1)
         else:
           error_struct.set_value("code", 0)
-        promise.reply(error_struct)
-        return
+        return error_struct
 
       except Exception as e:
         Gst.warning("Error sending PTZ command (Unknown Exception) - %s" % str(e))
         error_struct = Gst.Structure("PTZError")
         error_struct.set_value("code", 0)
-        return
+        return error_struct
 
     def _setup_recorder_service_client(self):
       """
-        Sets up the SOAP client to talk to the recorder service
+        Sets up the SOAP client to talk to the recorder service (on the PTZ worker thread), returning it
       """
 
       if self._recorder_service_client is not None:
-        return
+        return self._recorder_service_client
 
-      session = Session()
-      session.mount("https://", SSLAdapter())
-      session.verify = False # Highly unlikely we'll trust the Milestone cert, so just ignore errors
-      urllib3.disable_warnings()
+      session = HttpSessions.get(self.recorder_host + ":" + str(self.recorder_port))
 
       if self._recorder_tls:
         url = "https://" + self.recorder_host + ":" + str(self.recorder_port) + "/RecorderCommandService/RecorderCommandService.asmx?wsdl"
       else:
         url = "http://" + self.recorder_host + ":" + str(self.recorder_port) + "/RecorderCommandService/RecorderCommandService.asmx?wsdl"
 
-      self._recorder_service_client = Client(url, transport=Transport(cache=SqliteCache(), session=session))
+      self._recorder_service_client = soap.Client(WsdlCache.get(url, session), transport=soap.Transport(cache=WsdlCache.sqlite_cache(), session=session, timeout=HTTP_TIMEOUT, operation_timeout=HTTP_TIMEOUT))
       # We have to tell zeep to strip the ns0 prefix from the SOAP Envelope, otherwise Milestone doesn't decode it properly
       for ns in self._recorder_service_client.namespaces:
         if "videoos" in self._recorder_service_client.namespaces[ns]:
           self._recorder_service_client.set_ns_prefix(None, self._recorder_service_client.namespaces[ns])
           break
+      return self._recorder_service_client
 
 
 __gstelementfactory__ = ("milestonexprotectsrc", Gst.Rank.NONE, MilestoneXprotectSrc)
@@ -0,0 +1,234 @@
+from inspect import currentframe
+import threading
+import time
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstBase', '1.0')
+
+from gi.repository import Gst, GLib, GObject, GstBase
+
+from xprotectlib.ring import ShmRingReader, ring_name
+
+# Kept to the standard library and gi, as consumers are meant to be cheap to start in every worker process
+
+OCAPS = Gst.Caps.from_string (
+        'application/x-genericbytedata-octet-stream')
+
+# Caps for each GenericByteData codec when the ring holds the elementary stream
+GBD_CODEC_CAPS = {
+  0x0001: Gst.Caps.from_string('image/jpeg'),
+  0x000A: Gst.Caps.from_string('video/x-h264'),
+  0x000E: Gst.Caps.from_string('video/x-h265'),
+}
+
+SRC_CAPS = Gst.Caps.from_string (
+        'application/x-genericbytedata-octet-stream; video/x-h264; video/x-h265; image/jpeg')
+
+# Function to add a message to the element
+def element_message(element, domain, code, message, debug=None):
+  cf = currentframe()
+  if cf and cf.f_back:
+    element.message_full(Gst.MessageType.ERROR, domain.quark(), code, message, debug,
+                         cf.f_back.f_code.co_filename, cf.f_back.f_code.co_name, cf.f_back.f_lineno)
+
+class MilestoneXprotectShmSrc(GstBase.BaseSrc):
+    __gstmetadata__ = ('MilestoneXprotectShmSrc','Src', \
+                      'Reads a camera published by the Milestone XProtect ingest daemon from shared memory', 'Chris Wiggins')
+
+    __gproperties__ = {
+        "camera-id": (str,
+                 "Camera ID",
+                 "Milestone GUID of the camera to read, as published by the ingest daemon",
+                 "",
+                 GObject.ParamFlags.READWRITE
+                ),
+        "shm-prefix": (str,
+                 "Shared memory prefix",
+                 "Prefix of the shared memory ring names, as passed to the ingest daemon",
+                 "xprotect",
+                 GObject.ParamFlags.READWRITE
+                ),
+        "timeout": (float,
+                 "Timeout",
+                 "Seconds without a new frame before erroring (after trying to reattach, in case the daemon restarted). 0 waits forever",
+                 0.0,
+                 GLib.MAXDOUBLE,
+                 10.0,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "poll-interval": (int,
+                 "Poll interval",
+                 "Milliseconds to wait between checking the ring for a new frame",
+                 1,
+                 1000,
+                 2,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "write-camera-timestamp": (bool,
+                 "Write camera timestamp",
+                 "Adds the camera timestamp to each buffer as a timestamp/x-ntp reference timestamp meta, as milestonexprotectsrc does",
+                 False,
+                 GObject.ParamFlags.READWRITE
+                ),
+        "overruns": (int,
+                 "Overruns",
+                 "Number of times this element fell a whole ring behind the daemon and skipped ahead to the latest keyframe",
+                 0,
+                 GLib.MAXINT,
+                 0,
+                 GObject.ParamFlags.READABLE
+                ),
+    }
+
+    __gsttemplates__ = Gst.PadTemplate.new("src",
+                                           Gst.PadDirection.SRC,
+                                           Gst.PadPresence.ALWAYS,
+                                           SRC_CAPS)
+
+    def __init__(self):
+        GstBase.BaseSrc.__init__(self)
+
+        self.camera_id: str = ""
+        self.shm_prefix: str = "xprotect"
+        self.timeout: float = 10.0
+        self.poll_interval: int = 2
+        self.write_camera_timestamp: bool = False
+
+        self.set_live(True)
+        self.set_do_timestamp(True)
+
+        self.ntp_caps = Gst.Caps.from_string("timestamp/x-ntp")
+        self._reader: ShmRingReader | None = None
+        self._overruns = 0
+        self._codec: int | None = None
+        self._unlocked = threading.Event()
+
+    def do_get_property(self, prop):
+        if prop.name == 'camera-id':
+            return self.camera_id
+        elif prop.name == 'shm-prefix':
+            return self.shm_prefix
+        elif prop.name == 'timeout':
+            return self.timeout
+        elif prop.name == 'poll-interval':
+            return self.poll_interval
+        elif prop.name == 'write-camera-timestamp':
+            return self.write_camera_timestamp
+        elif prop.name == 'overruns':
+            return self._overruns + (self._reader.overruns if self._reader is not None else 0)
+        else:
+            raise AttributeError('Unable to get property %s' % prop.name)
+
+    def do_set_property(self, prop, value):
+        if prop.name == 'camera-id':
+            self.camera_id = value
+        elif prop.name == 'shm-prefix':
+            self.shm_prefix = value
+        elif prop.name == 'timeout':
+            self.timeout = value
+        elif prop.name == 'poll-interval':
+            self.poll_interval = value
+        elif prop.name == 'write-camera-timestamp':
+            self.write_camera_timestamp = value
+        else:
+            raise AttributeError('Unable to set property %s to %s' % (prop.name, value))
+
+    def do_start(self):
+      name = ring_name(self.shm_prefix, self.camera_id)
+      try:
+        self._reader = ShmRingReader(name)
+      except (FileNotFoundError, ValueError) as e:
+        element_message(self, Gst.ResourceError, Gst.ResourceError.OPEN_READ, "Unable to open shared memory ring %s - is the ingest daemon publishing this camera?" % name, str(e))
+        return False
+      return True
+
+    def do_stop(self):
+      if self._reader is not None:
+        self._overruns += self._reader.overruns
+        self._reader.close()
+        self._reader = None
+      self._codec = None
+      return True
+
+    def do_unlock(self):
+      self._unlocked.set()
+      return True
+
+    def do_unlock_stop(self):
+      self._unlocked.clear()
+      return True
+
+    def do_negotiate(self):
+      if self._reader is not None and self._reader.mode == "elementary":
+        # The caps depend on the codec, so they're set from the first frame in do_create
+        return True
+      return self.set_caps(OCAPS)
+
+    def _reattach(self) -> bool:
+      """
+        Switches to a new ring with the same name, if the daemon restarted and created one
+      """
+      try:
+        reader = ShmRingReader(ring_name(self.shm_prefix, self.camera_id))
+      except (FileNotFoundError, ValueError):
+        return False
+      if reader.created == self._reader.created:
+        reader.close()
+        return False
+      Gst.info("Ingest daemon restarted, reattaching to its ring")
+      self._overruns += self._reader.overruns
+      self._reader.close()
+      self._reader = reader
+      return True
+
+    def _set_codec(self, codec: int):
+      """
+        Sets the caps for the codec of an elementary stream frame. Returns a FlowReturn
+      """
+      caps = GBD_CODEC_CAPS.get(codec)
+      if caps is None:
+        element_message(self, Gst.StreamError, Gst.StreamError.CODEC_NOT_FOUND, "Unsupported GenericByteData codec 0x%04x" % codec)
+        return Gst.FlowReturn.NOT_SUPPORTED
+      if not self.set_caps(caps):
+        return Gst.FlowReturn.NOT_NEGOTIATED
+      self._codec = codec
+      return Gst.FlowReturn.OK
+
+    def do_create(self, *args):
+      idle_since = time.monotonic()
+      while True:
+        frame = self._reader.peek()
+        if frame is None:
+          if self.timeout != 0.0 and time.monotonic() - idle_since >= self.timeout:
+            if self._reattach():
+              idle_since = time.monotonic()
+              continue
+            element_message(self, Gst.ResourceError, Gst.ResourceError.READ, "No frames from the ingest daemon for %.1f seconds" % self.timeout)
+            return (Gst.FlowReturn.ERROR, None)
+          if self._unlocked.wait(self.poll_interval / 1000):
+            return (Gst.FlowReturn.FLUSHING, None)
+          continue
+
+        _, keyframe, codec, timestamp_ms, data = frame
+        # Copied once, straight from the ring into the buffer's memory
+        buf = Gst.Buffer.new_allocate(None, len(data), None)
+        with buf.map(Gst.MapFlags.WRITE) as info:
+          info.data[:] = data
+        if not self._reader.consume(frame):
+          continue
+
+        if self._reader.mode == "elementary":
+          if codec != self._codec:
+            ret = self._set_codec(codec)
+            if ret != Gst.FlowReturn.OK:
+              return (ret, None)
+          if not keyframe:
+            buf.set_flags(Gst.BufferFlags.DELTA_UNIT)
+
+        if self.write_camera_timestamp and timestamp_ms != 0:
+          buf.add_reference_timestamp_meta(self.ntp_caps, timestamp_ms * 1000000, Gst.CLOCK_TIME_NONE)
+        return (Gst.FlowReturn.OK, buf)
+
+
+__gstelementfactory__ = ("milestonexprotectshmsrc", Gst.Rank.NONE, MilestoneXprotectShmSrc)
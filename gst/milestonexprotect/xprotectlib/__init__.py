@@ -0,0 +1,5 @@
+"""
+The parts of milestonexprotectsrc / milestonexprotectshmsrc that don't need GStreamer, so the scripts can use them (and
+they can be tested) without it. A package rather than modules beside the elements, as gst-python tries to load every
+module in its plugin directory as an element
+"""
@@ -0,0 +1,399 @@
+from collections import deque
+from socket import socketpair, timeout
+import queue
+import re
+import select
+import ssl
+import struct
+import threading
+import time
+
+# The recording server (ImageServer) connection - GenericByteData frames, receiving them, and queueing them for the
+# element's streaming thread
+
+# Default number of frames queued per camera by the reader thread / shared ingest engine
+DEFAULT_QUEUE_SIZE = 60
+
+# GenericByteData header fields (see gst/vpsxprotect/GenericByteData.h)
+# Data type, total length, codec, sequence number, flags, sync timestamp, timestamp - all big endian
+GBD_HEADER = struct.Struct(">HIHHHQQ")
+GBD_HEADER_LENGTH = 32
+GBD_DATATYPE_VIDEO = 0x0010
+GBD_FLAG_SYNC = 0x0001 # Keyframe
+GBD_CODEC_JPEG = 0x0001
+
+def parse_gbd_header(data):
+  """
+  Returns (data_type, length, codec, sequence_number, flags, sync_timestamp, timestamp) from a GenericByteData frame,
+  or None if it is too short to have a header
+  """
+  if len(data) < GBD_HEADER_LENGTH:
+    return None
+  return GBD_HEADER.unpack_from(data)
+
+def gbd_is_keyframe(data) -> bool:
+  """
+  Returns whether a GenericByteData frame can be decoded on its own - a video keyframe, or anything that isn't video
+  """
+  header = parse_gbd_header(data)
+  if header is None or header[0] != GBD_DATATYPE_VIDEO or header[2] == GBD_CODEC_JPEG:
+    return True
+  return bool(header[4] & GBD_FLAG_SYNC)
+
+# Message types returned by classify_message
+MESSAGE_EMPTY = 0
+MESSAGE_IMAGE = 1
+MESSAGE_LIVEPACKAGE = 2
+MESSAGE_METHODRESPONSE = 3
+MESSAGE_XML = 4
+MESSAGE_UNKNOWN = 5
+
+_CONTENT_LENGTH = re.compile(rb"\ncontent-length:[ \t]*(\d+)", re.IGNORECASE)
+_CURRENT = re.compile(rb"\ncurrent:[ \t]*(\d+)", re.IGNORECASE)
+_REQUEST_ID = re.compile(rb"\nrequestid:[ \t]*(\d+)", re.IGNORECASE)
+
+def classify_message(message: bytes) -> int:
+  """
+  Works out what an ImageServer message is from its prefix (and the XML root tag), without decoding or parsing it
+  """
+  if message.startswith(b"ImageResponse"):
+    return MESSAGE_IMAGE
+  if message.startswith(b"<?xml"):
+    root = message.find(b"<", message.find(b"?>") + 2)
+    if message.startswith(b"<livepackage", root):
+      return MESSAGE_LIVEPACKAGE
+    if message.startswith(b"<methodresponse", root):
+      return MESSAGE_METHODRESPONSE
+    return MESSAGE_XML
+  if message == b"":
+    return MESSAGE_EMPTY
+  return MESSAGE_UNKNOWN
+
+def content_length(message: bytes) -> int:
+  """
+  Returns the content-length of an ImageResponse header, raising ValueError if it doesn't have one
+  """
+  match = _CONTENT_LENGTH.search(message)
+  if match is None:
+    raise ValueError("ImageResponse without content-length")
+  return int(match.group(1))
+
+def current_timestamp(message: bytes) -> int | None:
+  """
+  Returns the 'current' timestamp (ms since the epoch) of an ImageResponse header, if it has one
+  """
+  match = _CURRENT.search(message)
+  if match is None:
+    return None
+  return int(match.group(1))
+
+def request_id(message: bytes) -> int | None:
+  """
+  Returns the RequestId of an ImageResponse header (the method call it answers), if it has one
+  """
+  match = _REQUEST_ID.search(message)
+  if match is None:
+    return None
+  return int(match.group(1))
+
+class Buffer:
+  """
+  Receive buffer for the ImageServer socket.
+
+  Data is read with recv_into into a preallocated bytearray which is only compacted or grown
+  when a header doesn't fit, rather than reallocating a bytes object on every recv.
+  Frame bodies are read straight into the caller's memory with get_buffer_into
+  """
+  INITIAL_SIZE = 64 * 1024
+
+  def __init__(self, sock, size: int = INITIAL_SIZE):
+    self.sock = sock
+    self._data = bytearray(size)
+    self._view = memoryview(self._data)
+    self._start = 0   # First unread byte
+    self._end = 0     # End of the received data
+    self._scanned = 0 # Offset we've already searched for the separator up to
+
+  def _fill(self) -> bool:
+    """
+    Reads whatever is available from the socket into the free space at the end of the buffer,
+    compacting or growing the buffer first if there isn't any. Returns False if the socket closed
+    """
+    if self._start == self._end:
+      self._start = self._end = self._scanned = 0
+    elif self._end == len(self._data):
+      pending = self._end - self._start
+      if self._start > 0:
+        # Only a partial header (or the peeked start of a body) is left here, so this copy is small
+        self._data[:pending] = self._view[self._start:self._end].tobytes()
+      else:
+        # A single header bigger than the whole buffer, so double it
+        data = bytearray(len(self._data) * 2)
+        data[:pending] = self._view[:pending]
+        self._view.release()
+        self._data = data
+        self._view = memoryview(self._data)
+      self._scanned -= self._start
+      self._start = 0
+      self._end = pending
+
+    received = self.sock.recv_into(self._view[self._end:])
+    if received == 0: # socket closed
+      return False
+    self._end += received
+    return True
+
+  def get_line(self):
+    """
+    Returns the next message (as bytes, with surrounding whitespace stripped), or None if the socket closed
+    """
+    buf = self.get_buffer()
+    if buf is None:
+      return None
+    return buf.strip()
+
+  def get_buffer(self):
+    """
+    Returns the bytes up to the next \\r\\n\\r\\n separator (without it), or None if the socket closed
+    """
+    while True:
+      index = self._data.find(b'\r\n\r\n', self._scanned, self._end)
+      if index != -1:
+        break
+      # Keep the last 3 bytes in the search window in case the separator is split across reads
+      self._scanned = max(self._start, self._end - 3)
+      if not self._fill():
+        return None
+
+    buf = bytes(self._view[self._start:index])
+    self._start = self._scanned = index + 4
+    return buf
+
+  def get_buffer_into(self, view: memoryview) -> bool:
+    """
+    Fills the writable view with exactly len(view) bytes, using up anything already buffered and then
+    receiving directly into the view. Returns False if the socket closed before it was filled
+    """
+    size = len(view)
+    buffered = min(self._end - self._start, size)
+    if buffered > 0:
+      view[:buffered] = self._view[self._start:self._start + buffered]
+      self._start += buffered
+      self._scanned = max(self._scanned, self._start)
+
+    offset = buffered
+    while offset < size:
+      received = self.sock.recv_into(view[offset:])
+      if received == 0: # socket closed
+        return False
+      offset += received
+    return True
+
+  def peek(self, size: int):
+    """
+    Returns the next size bytes without consuming them, or None if the socket closed
+    """
+    while self._end - self._start < size:
+      if not self._fill():
+        return None
+    return bytes(self._view[self._start:self._start + size])
+
+  def skip(self, size: int) -> bool:
+    """
+    Discards the next size bytes (e.g. the body of a dropped frame). Returns False if the socket closed first
+    """
+    buffered = min(self._end - self._start, size)
+    self._start += buffered
+    self._scanned = max(self._scanned, self._start)
+    remaining = size - buffered
+    while remaining > 0:
+      # Nothing is buffered at this point, so receive into the buffer itself and throw it away
+      self._start = self._end = self._scanned = 0
+      received = self.sock.recv_into(self._view, min(remaining, len(self._data)))
+      if received == 0: # socket closed
+        return False
+      remaining -= received
+    return True
+
+  def get_buffer_size(self, size: int):
+    """
+    Returns exactly size bytes as a bytearray, or None if the socket closed
+    """
+    buf = bytearray(size)
+    if not self.get_buffer_into(memoryview(buf)):
+      return None
+    return buf
+
+class ReaderSocket:
+  """
+  Wraps a TLS recording server socket that a reader thread receives on, so only the reader thread ever uses it, as
+  OpenSSL doesn't support one connection being used from two threads at once. Other threads queue data with send, which
+  the reader sends before its next receive, woken from waiting on the socket if need be.
+
+  Receives are non-blocking underneath, as the socket can be readable with only TLS records (e.g. session tickets) and
+  no data, and a blocking read would hold up the sends until the timeout
+  """
+  def __init__(self, sock):
+    self.sock = sock
+    self._timeout = sock.gettimeout()
+    self._outgoing = deque()
+    self._lock = threading.Lock()
+    self._wake_read, self._wake_write = socketpair()
+    self._wake_read.setblocking(False)
+    self._wake_write.setblocking(False)
+    sock.setblocking(False)
+
+  def send(self, data: bytes):
+    with self._lock:
+      self._outgoing.append(data)
+    try:
+      self._wake_write.send(b"\0")
+    except BlockingIOError:
+      pass # Already plenty of wake ups pending
+
+  def _flush(self):
+    while True:
+      with self._lock:
+        if len(self._outgoing) == 0:
+          return
+        data = self._outgoing.popleft()
+      # Blocking (with the socket's timeout) just while sending
+      self.sock.settimeout(self._timeout)
+      try:
+        self.sock.sendall(data)
+      finally:
+        self.sock.setblocking(False)
+
+  def recv_into(self, view, nbytes: int = 0) -> int:
+    deadline = time.monotonic() + self._timeout if self._timeout is not None else None
+    while True:
+      self._flush()
+      try:
+        return self.sock.recv_into(view, nbytes)
+      except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+        pass
+
+      remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+      readable, _, _ = select.select([self.sock, self._wake_read], [], [], remaining)
+      if len(readable) == 0:
+        raise timeout("timed out")
+      if self._wake_read in readable:
+        try:
+          while self._wake_read.recv(4096):
+            pass
+        except BlockingIOError:
+          pass
+
+  def close(self):
+    self._wake_read.close()
+    self._wake_write.close()
+
+class FrameQueue:
+  """
+  Bounded queue of (response, body) messages from a reader to the element's streaming thread.
+  When it is full, the policy decides what happens to a new frame:
+    block - the reader waits for space
+    drop-oldest - the oldest queued frame is dropped
+    drop-until-keyframe - frames are dropped until the next keyframe, which replaces any frames still queued
+  Anything that isn't a frame (XML, socket closed, reader errors) is never dropped
+  """
+  POLICIES = ("block", "drop-oldest", "drop-until-keyframe")
+
+  def __init__(self, size: int = DEFAULT_QUEUE_SIZE, policy: str = "block"):
+    self.size = size
+    self.policy = policy
+    self.dropped = 0
+    self._items = deque() # (message, is_frame)
+    self._cond = threading.Condition()
+    self._dropping = False
+    self._closed = False
+
+  def __len__(self):
+    return len(self._items)
+
+  def full(self) -> bool:
+    return len(self._items) >= self.size
+
+  def _drop_frames(self, count: int | None = None):
+    kept = deque()
+    for item in self._items:
+      if item[1] and (count is None or count > 0):
+        self.dropped += 1
+        if count is not None:
+          count -= 1
+      else:
+        kept.append(item)
+    self._items = kept
+
+  def put(self, message, keyframe: bool | None = None):
+    """
+    Queues a message - keyframe is None for messages that aren't frames
+    """
+    with self._cond:
+      if keyframe is not None and self.policy == "drop-until-keyframe":
+        if keyframe:
+          if self.full():
+            # Nothing queued is needed to decode from here on
+            self._drop_frames()
+          self._dropping = False
+        elif self._dropping or self.full():
+          self._dropping = True
+          self.dropped += 1
+          return
+      elif keyframe is not None and self.policy == "drop-oldest":
+        if self.full():
+          self._drop_frames(1)
+      elif keyframe is not None:
+        while self.full() and not self._closed:
+          self._cond.wait()
+
+      self._items.append((message, keyframe is not None))
+      self._cond.notify_all()
+
+  def get(self, timeout: float | None = None):
+    """
+    Blocks until the next message is available. Raises queue.Empty on timeout, or the queued exception if the reader failed
+    """
+    with self._cond:
+      if not self._cond.wait_for(lambda: len(self._items) > 0, timeout):
+        raise queue.Empty()
+      message, _ = self._items.popleft()
+      self._cond.notify_all()
+    if isinstance(message, Exception):
+      raise message
+    return message
+
+  def close(self):
+    """
+    Wakes up and releases a reader blocked on a full queue
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+
+class FrameFilter:
+  """
+  Client side keyframe only / frame interval filtering for live streams (the recorder is always asked for every frame).
+  Decided from the ImageResponse header and the start of the body, so dropped frames are never allocated a buffer.
+  With an interval, the first keyframe at least interval_ms (camera time) after the last one passed is kept
+  """
+  def __init__(self, keyframes_only: bool = False, interval_ms: int = 0):
+    self.keyframes_only = keyframes_only or interval_ms > 0
+    self.interval_ms = interval_ms
+    self.dropped = 0
+    self._last: int | None = None
+
+  def wanted(self, response: bytes, body_start) -> bool:
+    if self.keyframes_only and not gbd_is_keyframe(body_start):
+      self.dropped += 1
+      return False
+    if self.interval_ms > 0:
+      now = current_timestamp(response)
+      if now is None:
+        now = int(time.monotonic() * 1000)
+      # Also pass the frame if the clock went backwards
+      if self._last is not None and 0 <= now - self._last < self.interval_ms:
+        self.dropped += 1
+        return False
+      self._last = now
+    return True
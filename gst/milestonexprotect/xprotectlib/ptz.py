@@ -0,0 +1,128 @@
+import threading
+
+# PTZ commands for the recorder's command service, and the worker thread that sends an element's commands
+
+def ptz_command(x: float, y: float, z: float):
+  """
+  Returns the RecorderCommandService (method, ptzArgs) for a PTZ move at speeds x, y and z (-1 to 1).
+  All zero is a stop, and pan / tilt takes priority over zoom
+  """
+  if x == 0 and y == 0 and z == 0:
+    return ("PTZMoveStop", None)
+
+  if x != 0 or y != 0:
+    pan = 0
+    tilt = 0
+
+    if x > 0:
+      pan = 1
+    elif x < 0:
+      pan = -1
+
+    if y > 0:
+      tilt = 1
+    elif y < 0:
+      tilt = -1
+
+    return ("PTZMoveStart", {
+      "movement": [
+        {"name": "pan", "value": pan},
+        {"name": "tilt", "value": tilt},
+      ],
+      "speed": [
+        {"name": "pan", "value": abs(x)},
+        {"name": "tilt", "value": abs(y)}
+      ],
+      "Normalized": False
+    })
+
+  zoom = 0
+  if z > 0:
+    zoom = 1
+  elif z < 0:
+    zoom = -1
+  return ("PTZMoveStart", {
+    "movement": [
+      {"name": "zoom", "value": zoom},
+    ],
+    "speed": [
+      {"name": "zoom", "value": abs(z)},
+    ],
+    "Normalized": False
+  })
+
+class PtzWorker:
+  """
+  Sends an element's PTZ commands to the recorder on a background thread, so the ptz signal never blocks the caller.
+
+  The element starts the worker on its first command, so streams that never use PTZ make no calls to the recorder's command
+  service. Commands are coalesced while one is in flight - only the latest move is sent, but a stop is never dropped (and is
+  sent before any move that came after it, or after the worker is closed). Every promise is replied to, superseded
+  and dropped moves with nothing.
+
+  Commands are sent with send(x, y, z), which returns what to reply to their promises with
+  """
+  def __init__(self, name: str, send):
+    self._send = send
+    self._cond = threading.Condition()
+    self._stop_promises: list | None = None # Promises for the pending stop, None if there isn't one
+    self._move = None                       # Pending (x, y, z, promise)
+    self._closed = False
+    self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+    self._thread.start()
+
+  def submit(self, x: float, y: float, z: float, promise):
+    with self._cond:
+      if self._closed:
+        promise.reply(None)
+        return
+      superseded = self._move
+      if x == 0 and y == 0 and z == 0:
+        self._move = None
+        if self._stop_promises is None:
+          self._stop_promises = []
+        self._stop_promises.append(promise)
+      else:
+        self._move = (x, y, z, promise)
+      self._cond.notify()
+    if superseded is not None:
+      superseded[3].reply(None)
+
+  def close(self, timeout: float | None = None):
+    """
+    Stops the worker once any pending stop has been sent, waiting up to timeout for it. After that the stop is still
+    sent in the background, as the thread is a daemon
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._thread.join(timeout)
+
+  def _run(self):
+    while True:
+      dropped = None
+      with self._cond:
+        while not self._closed and self._stop_promises is None and self._move is None:
+          self._cond.wait()
+        if self._closed and self._move is not None:
+          # Moves pending at close are dropped, but a pending stop is still sent so the camera doesn't keep moving
+          dropped = self._move[3]
+          self._move = None
+        if self._stop_promises is not None:
+          x, y, z = (0, 0, 0)
+          promises = self._stop_promises
+          self._stop_promises = None
+        elif self._move is not None:
+          x, y, z, promise = self._move
+          promises = [promise]
+          self._move = None
+        else:
+          promises = None
+
+      if dropped is not None:
+        dropped.reply(None)
+      if promises is None:
+        return
+      error = self._send(x, y, z)
+      for promise in promises:
+        promise.reply(error)
@@ -0,0 +1,111 @@
+from urllib.parse import urlparse
+import os
+import sqlite3
+import time
+
+# The on-disk cache of where each camera is recorded, shared by the elements (and processes) on a host
+
+class ResolutionCache:
+  """
+  On-disk (SQLite) cache of camera -> hardware / recorder, shared between processes, so elements can
+  skip resolving the recorder through the management server on start. Entries older than the TTL
+  passed to lookup are ignored.
+
+  If the database fails, the error is passed to warn and the cache is disabled - every call then returns None, so the
+  element carries on resolving through the management server
+  """
+  # Seconds another element / process waits for a site configuration fetch claimed with claim_fetch
+  FETCH_LEASE = 60
+
+  DEFAULT_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "milestonexprotectsrc", "resolution.db")
+
+  def __init__(self, path: str = "", warn=None):
+    self._warn = warn # Callable taking the message for a database failure
+    path = path or self.DEFAULT_PATH
+    if os.path.dirname(path) != "":
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Autocommit, with the only transaction (in claim_fetch) kept short, so waiting for the lock is bounded
+    self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    self._db.execute("PRAGMA journal_mode=WAL")
+    self._db.execute("""CREATE TABLE IF NOT EXISTS cameras (
+      management_server TEXT NOT NULL,
+      camera_id TEXT NOT NULL,
+      hardware_id TEXT NOT NULL,
+      recorder_uri TEXT NOT NULL,
+      tls INTEGER NOT NULL,
+      updated REAL NOT NULL,
+      PRIMARY KEY (management_server, camera_id))""")
+    self._db.execute("""CREATE TABLE IF NOT EXISTS fetches (
+      management_server TEXT PRIMARY KEY,
+      started REAL NOT NULL)""")
+
+  def close(self):
+    if self._db is not None:
+      self._db.close()
+      self._db = None
+
+  def _use(self, call):
+    """
+    Returns call(database), or None if the cache has been disabled or the call fails (which disables it)
+    """
+    if self._db is None:
+      return None
+    try:
+      return call(self._db)
+    except sqlite3.Error as e:
+      if self._warn is not None:
+        self._warn("Unable to use resolution cache - %s" % str(e))
+      try:
+        self._db.close()
+      except sqlite3.Error:
+        pass
+      self._db = None
+      return None
+
+  def lookup(self, management_server: str, camera_id: str, ttl: float):
+    """
+    Returns (hardware_id, recorder_uri, tls) for the camera, or None if it isn't cached or has expired
+    """
+    row = self._use(lambda db: db.execute("SELECT hardware_id, recorder_uri, tls FROM cameras WHERE management_server = ? AND camera_id = ? AND updated > ?",
+                                          (management_server.lower(), camera_id.lower(), time.time() - ttl)).fetchone())
+    if row is None:
+      return None
+    return (row[0], row[1], bool(row[2]))
+
+  def store(self, management_server: str, entries):
+    """
+    Stores an iterable of (camera_id, hardware_id, recorder_uri)
+    """
+    now = time.time()
+    rows = [(management_server.lower(), camera_id.lower(), hardware_id.lower(), recorder_uri, urlparse(recorder_uri).scheme == "https", now)
+            for camera_id, hardware_id, recorder_uri in entries]
+    self._use(lambda db: db.executemany("INSERT OR REPLACE INTO cameras VALUES (?, ?, ?, ?, ?, ?)", rows))
+
+  def invalidate(self, management_server: str, camera_id: str):
+    self._use(lambda db: db.execute("DELETE FROM cameras WHERE management_server = ? AND camera_id = ?", (management_server.lower(), camera_id.lower())))
+
+  def claim_fetch(self, management_server: str) -> bool:
+    """
+    Claims fetching the site configuration, so other elements / processes wait for it to be stored rather than fetching
+    it too. Returns False if someone else claimed it less than FETCH_LEASE seconds ago (or None without the cache).
+    The database isn't locked during the fetch itself - release the claim with release_fetch once it's stored
+    """
+    return self._use(lambda db: self._claim_fetch(db, management_server))
+
+  def _claim_fetch(self, db, management_server: str) -> bool:
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      row = db.execute("SELECT started FROM fetches WHERE management_server = ?", (management_server.lower(),)).fetchone()
+      claimed = row is None or now - row[0] >= self.FETCH_LEASE
+      if claimed:
+        db.execute("INSERT OR REPLACE INTO fetches VALUES (?, ?)", (management_server.lower(), now))
+    except:
+      db.execute("ROLLBACK")
+      raise
+    db.execute("COMMIT")
+    return claimed
+
+  def release_fetch(self, management_server: str):
+    self._use(lambda db: db.execute("DELETE FROM fetches WHERE management_server = ?", (management_server.lower(),)))
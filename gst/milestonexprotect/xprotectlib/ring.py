@@ -0,0 +1,233 @@
+from multiprocessing import resource_tracker, shared_memory
+import os
+import struct
+import time
+
+# The shared memory ring the ingest daemon publishes each camera to, and milestonexprotectshmsrc reads
+
+OUTPUT_MODES = ("genericbytedata", "elementary")
+
+# Shared memory ring layout - a 64 byte header, then the records. All little endian.
+#   magic, version, output mode (index into OUTPUT_MODES), capacity (bytes of records),
+#   reserve - the writer has claimed (and may be overwriting) everything before this
+#   commit - everything before this is complete
+#   keyframe - start of the latest keyframe record
+#   frames - number of records written
+#   created - time.time_ns() the ring was created, so readers can tell when the daemon restarted
+#   pid - the writer's process id, so a ring left behind by a daemon that died can be told from one still in use
+# Positions only ever increase, the offset in the ring is position % capacity
+RING_MAGIC = b"XPRB"
+RING_VERSION = 1
+RING_HEADER = struct.Struct("<4sIII")
+RING_HEADER_SIZE = 64
+RING_RESERVE = 16
+RING_COMMIT = 24
+RING_KEYFRAME = 32
+RING_FRAMES = 40
+RING_CREATED = 48
+RING_PID = 56
+RING_POSITION = struct.Struct("<Q")
+
+# Each record is its header (payload length, flags, codec, frame number, camera timestamp in ms or 0), then the payload,
+# padded to 8 bytes. A record never wraps - if it doesn't fit before the end, the length there is RECORD_WRAP and it
+# starts at the beginning
+RECORD_HEADER = struct.Struct("<IHHQQ")
+RECORD_WRAP = 0xFFFFFFFF
+RECORD_FLAG_KEYFRAME = 0x0001
+
+DEFAULT_RING_SIZE = 32 * 1024 * 1024
+
+def ring_name(prefix: str, camera_id: str) -> str:
+  """
+  Returns the shared memory name of the ring for a camera
+  """
+  return "%s-%s" % (prefix, camera_id.lower())
+
+# Names of the rings this process is writing, which the resource tracker removes if it exits without closing them
+_writing = set()
+
+def _record_size(length: int) -> int:
+  return (RECORD_HEADER.size + length + 7) & ~7
+
+class ShmRingWriter:
+  """
+  The single writer of a camera's ring, created by the ingest daemon. Never waits for readers - any reader that falls
+  a whole ring behind has its frames overwritten and skips ahead
+  """
+  def __init__(self, name: str, capacity: int = DEFAULT_RING_SIZE, mode: str = "genericbytedata"):
+    self.capacity = (capacity + 7) & ~7
+    _remove_stale(name)
+    self._shm = shared_memory.SharedMemory(name, create=True, size=RING_HEADER_SIZE + self.capacity)
+    _writing.add(self._shm.name)
+    self._buf = self._shm.buf
+    self._commit = 0
+    self._frames = 0
+    RING_HEADER.pack_into(self._buf, 0, RING_MAGIC, RING_VERSION, OUTPUT_MODES.index(mode), 0)
+    for offset in (RING_RESERVE, RING_COMMIT, RING_KEYFRAME, RING_FRAMES):
+      RING_POSITION.pack_into(self._buf, offset, 0)
+    RING_POSITION.pack_into(self._buf, RING_CREATED, time.time_ns())
+    RING_POSITION.pack_into(self._buf, RING_PID, os.getpid())
+
+  @property
+  def name(self) -> str:
+    return self._shm.name
+
+  def write(self, data, keyframe: bool, codec: int = 0, timestamp_ms: int = 0) -> bool:
+    """
+    Appends a frame. Returns False if it's too big to ever fit in the ring
+    """
+    size = _record_size(len(data))
+    if size > self.capacity:
+      return False
+
+    start = self._commit
+    offset = start % self.capacity
+    if offset + size > self.capacity:
+      # There's always room for the marker, as records are 8 byte aligned
+      start += self.capacity - offset
+    end = start + size
+
+    # Claim the space before overwriting it, so readers still copying from it know to throw their copy away
+    RING_POSITION.pack_into(self._buf, RING_RESERVE, end)
+    if start != self._commit:
+      struct.pack_into("<I", self._buf, RING_HEADER_SIZE + offset, RECORD_WRAP)
+    record = RING_HEADER_SIZE + start % self.capacity
+    RECORD_HEADER.pack_into(self._buf, record, len(data), RECORD_FLAG_KEYFRAME if keyframe else 0, codec, self._frames, timestamp_ms)
+    self._buf[record + RECORD_HEADER.size:record + RECORD_HEADER.size + len(data)] = data
+
+    self._frames += 1
+    if keyframe:
+      RING_POSITION.pack_into(self._buf, RING_KEYFRAME, start)
+    RING_POSITION.pack_into(self._buf, RING_FRAMES, self._frames)
+    RING_POSITION.pack_into(self._buf, RING_COMMIT, end)
+    self._commit = end
+    return True
+
+  def close(self):
+    """
+    Removes the ring. Readers that have it open keep their mapping, and see no more frames
+    """
+    self._buf.release()
+    self._shm.close()
+    self._shm.unlink()
+    _writing.discard(self._shm.name)
+
+def _attach(name: str):
+  try:
+    return shared_memory.SharedMemory(name, track=False)
+  except TypeError:
+    # Before Python 3.13, attaching registers the segment to be removed when this process exits. The tracker keeps
+    # one registration per name, so a ring this process writes keeps it (or the writer's would be lost)
+    shm = shared_memory.SharedMemory(name)
+    if shm.name not in _writing:
+      resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def _process_running(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    # Running as another user
+    return True
+  return True
+
+def _remove_stale(name: str):
+  """
+  Removes a ring left behind by a daemon that didn't shut down cleanly. Raises FileExistsError if the shared memory
+  is a ring another writer is still publishing to, or isn't a ring at all
+  """
+  try:
+    shm = _attach(name)
+  except FileNotFoundError:
+    return
+  try:
+    if len(shm.buf) < RING_HEADER_SIZE or RING_HEADER.unpack_from(shm.buf, 0)[0] != RING_MAGIC:
+      raise FileExistsError("Shared memory %s already exists and isn't a milestonexprotect ring" % name)
+    pid = RING_POSITION.unpack_from(shm.buf, RING_PID)[0]
+    if pid != 0 and _process_running(pid):
+      raise FileExistsError("Ring %s is already being published by process %d" % (name, pid))
+  finally:
+    shm.close()
+  # Opened again as the writer would, so unlinking it leaves the resource tracker balanced
+  stale = shared_memory.SharedMemory(name)
+  stale.close()
+  stale.unlink()
+
+class ShmRingReader:
+  """
+  One reader of a camera's ring. Starts from the latest keyframe, and skips ahead to the latest keyframe again if the
+  writer laps it. Frames are read with peek, copied out, then checked with consume
+  """
+  def __init__(self, name: str):
+    self._shm = _attach(name)
+    self._buf = self._shm.buf
+    magic, version, mode, _ = RING_HEADER.unpack_from(self._buf, 0)
+    if magic != RING_MAGIC or version != RING_VERSION:
+      self.close()
+      raise ValueError("%s isn't a milestonexprotect ring" % name)
+    self.mode = OUTPUT_MODES[mode]
+    self.capacity = len(self._buf) - RING_HEADER_SIZE
+    self.created = self._get(RING_CREATED)
+    self.overruns = 0
+    self._position: int | None = None
+
+  def _get(self, offset: int) -> int:
+    return RING_POSITION.unpack_from(self._buf, offset)[0]
+
+  def _resync(self, commit: int):
+    keyframe = self._get(RING_KEYFRAME)
+    if self._get(RING_FRAMES) > 0 and keyframe < commit and commit - keyframe <= self.capacity:
+      self._position = keyframe
+    else:
+      self._position = commit
+
+  def peek(self):
+    """
+    Returns the next frame as (position, keyframe, codec, timestamp_ms, data), or None if there isn't one yet.
+    data is a view of the ring, only valid until the writer laps it - copy it, then check the copy with consume
+    """
+    commit = self._get(RING_COMMIT)
+    if self._position is None:
+      self._resync(commit)
+    while self._position < commit:
+      if commit - self._position > self.capacity:
+        self.overruns += 1
+        self._resync(commit)
+        continue
+      offset = self._position % self.capacity
+      record = RING_HEADER_SIZE + offset
+      length = struct.unpack_from("<I", self._buf, record)[0]
+      if length == RECORD_WRAP:
+        self._position += self.capacity - offset
+        continue
+      if offset + _record_size(length) > self.capacity:
+        # Only possible if it was overwritten while we read it
+        self.overruns += 1
+        commit = self._get(RING_COMMIT)
+        self._resync(commit)
+        continue
+      _, flags, codec, _, timestamp = RECORD_HEADER.unpack_from(self._buf, record)
+      data = self._buf[record + RECORD_HEADER.size:record + RECORD_HEADER.size + length]
+      return (self._position, bool(flags & RECORD_FLAG_KEYFRAME), codec, timestamp, data)
+    return None
+
+  def consume(self, frame) -> bool:
+    """
+    Moves past a frame from peek. Returns False if the writer overwrote it while it was being copied, in which case
+    the copy should be thrown away (and the next peek starts from the latest keyframe)
+    """
+    position, _, _, _, data = frame
+    size = _record_size(len(data))
+    data.release()
+    if self._get(RING_RESERVE) > position + self.capacity:
+      self.overruns += 1
+      self._position = None
+      return False
+    self._position = position + size
+    return True
+
+  def close(self):
+    self._buf.release()
+    self._shm.close()
@@ -0,0 +1,245 @@
+from urllib.parse import urlparse
+import re
+import ssl
+import threading
+
+# The SOAP / HTTP stack shared by milestonexprotectsrc and the scripts. zeep, requests, requests_ntlm, urllib3 and
+# ElementTree are imported by import_dependencies on first use, as gst-python imports the element on every registry scan
+
+# Timeout in seconds for SOAP calls to the management server and recorders
+SOAP_TIMEOUT = 30
+
+# Connect timeout in seconds for HTTP connections (reads use SOAP_TIMEOUT), and the most kept alive per host by each pooled session
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, SOAP_TIMEOUT)
+HTTP_POOL_SIZE = 4
+
+def etree_to_dict(t):
+  """
+  Helper function to convert an XML element to a dict (for fault messages)
+  """
+  tree = {}
+  for child in t:
+    value = child.text
+    if value is None:
+      value = etree_to_dict(child)
+    tree[child.tag] = value
+  return tree
+
+_dependencies_lock = threading.Lock()
+_dependencies_imported = False
+
+def import_dependencies():
+  """
+  Imports the SOAP / HTTP stack and ElementTree into this module, the first time it's called
+  """
+  global _dependencies_imported, auth, Session, HTTPAdapter, HttpNtlmAuth, urllib3, ET, Client, Fault, SqliteCache, Transport, Document, SSLAdapter
+  with _dependencies_lock:
+    if _dependencies_imported:
+      return
+    from requests import auth, Session
+    from requests.adapters import HTTPAdapter
+    from requests_ntlm import HttpNtlmAuth
+    import urllib3
+    import xml.etree.ElementTree as ET
+    from zeep import Client
+    from zeep.exceptions import Fault
+    from zeep.cache import SqliteCache
+    from zeep.transports import Transport
+    from zeep.wsdl import Document
+
+    # Class to take the SSL context and apply it for requests library
+    class SSLAdapter(HTTPAdapter):
+      def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = get_ssl_context()
+        return super().init_poolmanager(*args, **kwargs)
+
+      def send(self, request, timeout=None, **kwargs):
+        # requests has no session wide timeout, so apply ours to any call that doesn't set one
+        return super().send(request, timeout=timeout if timeout is not None else HTTP_TIMEOUT, **kwargs)
+
+    _dependencies_imported = True
+
+_ssl_context = None
+
+def get_ssl_context() -> ssl.SSLContext:
+  """
+  Returns the global SSL context to use for requests library, and our own socket (created on first use)
+  """
+  global _ssl_context
+  with _dependencies_lock:
+    if _ssl_context is None:
+      context = ssl._create_unverified_context()
+      context.minimum_version = ssl.TLSVersion.TLSv1_1
+      context.set_ciphers("DEFAULT:@SECLEVEL=0") # OpenSSL 3.0.1 moved TLS1.1 to SEC level 0
+      _ssl_context = context
+    return _ssl_context
+
+class HttpSessions:
+  """
+  Process-wide pooled requests sessions, one per host and credentials, shared by the OAuth, WSDL and SOAP calls
+  of every element. Connections are kept alive between calls, so they skip the TCP / TLS handshake and (as NTLM
+  authenticates the connection) the NTLM handshake. At most HTTP_POOL_SIZE connections are open to each host,
+  further calls wait for one to be free
+  """
+  _sessions = {}
+  _lock = threading.Lock()
+
+  @classmethod
+  def get(cls, host: str, domain: str = "", username: str = "", password: str = "", oauth: bool = False) -> "Session":
+    """
+    Returns the session for host (hostname[:port]) and credentials. Domain BASIC uses basic auth, any other domain NTLM,
+    and no domain no auth. With oauth the credentials only pick the session, and the caller sets the bearer token on it
+    """
+    import_dependencies()
+    key = (host.lower(), domain.lower(), username.lower(), password, oauth)
+    with cls._lock:
+      session = cls._sessions.get(key)
+      if session is None:
+        session = Session()
+        adapter = SSLAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.verify = False # Highly unlikely we'll trust the Milestone cert, so just ignore errors
+        urllib3.disable_warnings()
+        if not oauth and domain == "BASIC":
+          session.auth = auth.HTTPBasicAuth(username=username, password=password)
+        elif not oauth and domain != "":
+          session.auth = HttpNtlmAuth(domain + "\\" + username, password)
+        cls._sessions[key] = session
+      return session
+
+"""
+  Gets an OAuth token for the given hostname, domain, username and password
+"""
+def get_oauth_token(hostname: str, domain: str, username: str, password: str) -> str | None:
+  # Unauthenticated, the token request brings its own credentials
+  session = HttpSessions.get(hostname)
+
+  # Check Oauth supported
+  r = session.get("https://" + hostname + "/idp/.well-known/openid-configuration")
+  if r.status_code != 200:
+    return None
+
+  body = r.json()
+
+  if "server_version" not in body:
+    return None
+
+  # Check server version supports OAuth
+  matches = re.search(r"(?P<major>\d+)\.(?P<minor>\d+)(?:\.(\d+))?", body["server_version"])
+  if matches is None or int(matches.group("major")) < 21:
+    return None
+
+  token_endpoint = body["token_endpoint"]
+  data = {
+    "client_id": "GrantValidatorClient"
+  }
+
+  auth = None
+  if domain == "BASIC":
+    data.update({
+      "grant_type": "password",
+      "username": username,
+      "password": password
+    })
+  else:
+    data.update({
+      "grant_type": "windows_credentials",
+    })
+    auth = HttpNtlmAuth(domain + "\\" + username, password)
+
+  r = session.post(token_endpoint, auth=auth, data=data, headers={"Accept": "application/json"})
+  if r.status_code != 200:
+    return None
+
+  return r.json()["access_token"]
+
+class WsdlCache:
+  """
+  Process-wide cache of parsed WSDL documents, keyed by URL, so new clients reuse the parsed types and
+  bindings instead of downloading and parsing the WSDL again. The raw documents are also persisted
+  across processes by a single shared zeep SqliteCache
+  """
+  _documents = {}
+  _url_locks = {}
+  _lock = threading.Lock()
+  _sqlite_cache = None
+
+  @classmethod
+  def sqlite_cache(cls) -> "SqliteCache":
+    import_dependencies()
+    with cls._lock:
+      if cls._sqlite_cache is None:
+        cls._sqlite_cache = SqliteCache()
+      return cls._sqlite_cache
+
+  @classmethod
+  def get(cls, url: str, session: "Session | None" = None) -> "Document":
+    """
+    Returns the parsed WSDL at url, fetching it with session if it hasn't been parsed in this process yet
+    """
+    import_dependencies()
+    with cls._lock:
+      document = cls._documents.get(url)
+      if document is not None:
+        return document
+      url_lock = cls._url_locks.setdefault(url, threading.Lock())
+
+    # Only one thread parses each URL, the rest wait for it
+    with url_lock:
+      document = cls._documents.get(url)
+      if document is None:
+        if session is None:
+          session = HttpSessions.get(urlparse(url).netloc)
+        transport = Transport(cache=cls.sqlite_cache(), session=session, timeout=HTTP_TIMEOUT)
+        document = Document(url, transport=transport)
+        with cls._lock:
+          cls._documents[url] = document
+      return document
+
+class RecorderResolver:
+  """
+  Resolves hardware to recording servers in batches - one GetConfigurationHardware call for any number of
+  hardware IDs, and one QueryRecorderInfo per distinct recorder. Results are kept in an in-memory index,
+  so resolving the same hardware (or other hardware on a known recorder) again needs no SOAP calls
+  """
+  def __init__(self, service):
+    self._service = service
+    self._lock = threading.Lock()
+    self._hardware = {}  # hardware id -> (recorder uri, [device ids])
+    self._cameras = {}   # device id -> hardware id
+    self._recorders = {} # recorder id -> recorder uri
+
+  def resolve(self, token: str, hardware_ids) -> dict:
+    """
+    Returns {hardware_id: (recorder_uri, device_ids)} for the given hardware IDs, with IDs lowercased.
+    Hardware that the management server doesn't know about is left out
+    """
+    wanted = {hardware_id.lower() for hardware_id in hardware_ids}
+    with self._lock:
+      missing = [hardware_id for hardware_id in wanted if hardware_id not in self._hardware]
+      if len(missing) > 0:
+        hardware_info = self._service.GetConfigurationHardware(token, {"guid": missing})
+        for hardware in hardware_info or []:
+          recorder_id = hardware.RecorderId
+          if recorder_id not in self._recorders:
+            self._recorders[recorder_id] = self._service.QueryRecorderInfo(token, recorder_id).WebServerUri
+
+          hardware_id = hardware.HardwareId.lower()
+          device_ids = [device_id.lower() for device_id in hardware.DeviceIds.guid] if hardware.DeviceIds is not None else []
+          self._hardware[hardware_id] = (self._recorders[recorder_id], device_ids)
+          for device_id in device_ids:
+            self._cameras[device_id] = hardware_id
+
+      return {hardware_id: self._hardware[hardware_id] for hardware_id in wanted if hardware_id in self._hardware}
+
+  def camera(self, camera_id: str):
+    """
+    Returns (hardware_id, recorder_uri) for a camera on hardware that has already been resolved, otherwise None
+    """
+    with self._lock:
+      hardware_id = self._cameras.get(camera_id.lower())
+      if hardware_id is None:
+        return None
+      return (hardware_id, self._hardware[hardware_id][0])
@@ -15,6 +15,8 @@ namespace VpsUtilities
   const unsigned int TIMESTAMP_SYNC_POS = 12; // Byte position of the sync timestamp
   const unsigned int TIMESTAMP_POS = 20;      // Byte position of the timestamp
   const unsigned int RESERVED_POS = 28;       // Byte position of the reserved bytes
+
+  const uint16_t FLAG_SYNC = 0x0001;          // Flag set on key frames (frames that can be decoded on their own)
   
   enum class Codec : uint16_t
   {
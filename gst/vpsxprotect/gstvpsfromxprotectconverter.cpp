@@ -33,8 +33,13 @@ enum
 enum
 {
   PROP_0,
+  PROP_WAIT_FOR_KEYFRAME,
+  PROP_FRAME_TIMESTAMPS,
 };
 
+#define DEFAULT_WAIT_FOR_KEYFRAME FALSE
+#define DEFAULT_FRAME_TIMESTAMPS FALSE
+
 /* the capabilities of the inputs and outputs.
  *
  * describe the real formats here.
@@ -58,6 +63,8 @@ static GstStaticPadTemplate src_template =
 #define gst_fromxprotectconverter_parent_class parent_class
 G_DEFINE_TYPE(GstFromXprotectConverter, gst_fromxprotectconverter, GST_TYPE_BIN);
 
+static void gst_fromxprotectconverter_set_property(GObject * object, guint prop_id, const GValue * value, GParamSpec * pspec);
+static void gst_fromxprotectconverter_get_property(GObject * object, guint prop_id, GValue * value, GParamSpec * pspec);
 static gboolean gst_fromxprotectconverter_sink_event(GstPad * pad, GstObject * parent, GstEvent * event);
 static GstFlowReturn gst_fromxprotectconverter_chain(GstPad * pad, GstObject * parent, GstBuffer * buf);
 
@@ -69,9 +76,24 @@ gst_fromxprotectconverter_class_init(GstFromXprotectConverterClass * klass)
 {
   GST_DEBUG_CATEGORY_INIT(gst_xprotect_debug, "xprotect",
     0, "Template fromxprotectconverter");
+  GObjectClass *gobject_class;
   GstElementClass *gstelement_class;
+  gobject_class = (GObjectClass *)klass;
   gstelement_class = (GstElementClass *)klass;
 
+  gobject_class->set_property = gst_fromxprotectconverter_set_property;
+  gobject_class->get_property = gst_fromxprotectconverter_get_property;
+
+  g_object_class_install_property(gobject_class, PROP_WAIT_FOR_KEYFRAME,
+    g_param_spec_boolean("wait-for-keyframe", "Wait for keyframe",
+      "Drop frames until the first keyframe (and again after a flush), so downstream decoders start on a decodable frame",
+      DEFAULT_WAIT_FOR_KEYFRAME, (GParamFlags)(G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS)));
+
+  g_object_class_install_property(gobject_class, PROP_FRAME_TIMESTAMPS,
+    g_param_spec_boolean("frame-timestamps", "Frame timestamps",
+      "Derive the PTS from the Generic Byte Data timestamp (relative to the first frame) instead of the arrival time",
+      DEFAULT_FRAME_TIMESTAMPS, (GParamFlags)(G_PARAM_READWRITE | G_PARAM_STATIC_STRINGS)));
+
   gst_element_class_set_details_simple(gstelement_class,
     "fromxprotectconverter",
     "VPS/test",
@@ -108,6 +130,68 @@ static void gst_fromxprotectconverter_init(GstFromXprotectConverter * filter)
   gst_element_add_pad(GST_ELEMENT(filter), filter->sinkpad);
 
   filter->firstrun = TRUE;
+
+  filter->wait_for_keyframe = DEFAULT_WAIT_FOR_KEYFRAME;
+  filter->frame_timestamps = DEFAULT_FRAME_TIMESTAMPS;
+
+  filter->codec = 0;
+  filter->waiting_for_keyframe = TRUE;
+  filter->base_pts = GST_CLOCK_TIME_NONE;
+  filter->base_timestamp = 0;
+}
+
+static void
+gst_fromxprotectconverter_set_property(GObject * object, guint prop_id,
+  const GValue * value, GParamSpec * pspec)
+{
+  GstFromXprotectConverter *filter = GST_FROMXPROTECTCONVERTER(object);
+
+  switch (prop_id) {
+  case PROP_WAIT_FOR_KEYFRAME:
+    filter->wait_for_keyframe = g_value_get_boolean(value);
+    break;
+  case PROP_FRAME_TIMESTAMPS:
+    filter->frame_timestamps = g_value_get_boolean(value);
+    break;
+  default:
+    G_OBJECT_WARN_INVALID_PROPERTY_ID(object, prop_id, pspec);
+    break;
+  }
+}
+
+static void
+gst_fromxprotectconverter_get_property(GObject * object, guint prop_id,
+  GValue * value, GParamSpec * pspec)
+{
+  GstFromXprotectConverter *filter = GST_FROMXPROTECTCONVERTER(object);
+
+  switch (prop_id) {
+  case PROP_WAIT_FOR_KEYFRAME:
+    g_value_set_boolean(value, filter->wait_for_keyframe);
+    break;
+  case PROP_FRAME_TIMESTAMPS:
+    g_value_set_boolean(value, filter->frame_timestamps);
+    break;
+  default:
+    G_OBJECT_WARN_INVALID_PROPERTY_ID(object, prop_id, pspec);
+    break;
+  }
+}
+
+/* returns the output caps for a Generic Byte Data codec, or NULL if it isn't supported */
+static GstCaps *
+gst_fromxprotectconverter_caps_for_codec(VpsUtilities::Codec codec)
+{
+  switch(codec) {
+    case VpsUtilities::Codec::H264:
+      return gst_caps_new_empty_simple ("video/x-h264");
+    case VpsUtilities::Codec::H265:
+      return gst_caps_new_empty_simple ("video/x-h265");
+    case VpsUtilities::Codec::JPEG:
+      return gst_caps_new_empty_simple ("image/jpeg");
+    default:
+      return NULL;
+  }
 }
 
 /* this function handles sink events */
@@ -142,6 +226,14 @@ gst_fromxprotectconverter_sink_event(GstPad * pad, GstObject * parent, GstEvent
     ret = TRUE;
     break;
   }
+  case GST_EVENT_FLUSH_STOP:
+  {
+    // Whatever arrives after a flush needs a new keyframe (and timestamp base) before it can be decoded
+    filter->waiting_for_keyframe = TRUE;
+    filter->base_pts = GST_CLOCK_TIME_NONE;
+    ret = gst_pad_event_default(pad, parent, event);
+    break;
+  }
   default:
     ret = gst_pad_event_default(pad, parent, event);
     break;
@@ -160,36 +252,55 @@ static GstFlowReturn gst_fromxprotectconverter_chain(GstPad * pad, GstObject * p
   filter = GST_FROMXPROTECTCONVERTER(parent);
 
   GstMapInfo info;
-  gst_buffer_map(buf, &info, GST_MAP_READ);
+  if (!gst_buffer_map(buf, &info, GST_MAP_READ)) {
+    GST_ERROR_OBJECT(filter, "Unable to map buffer");
+    gst_buffer_unref(buf);
+    return GST_FLOW_ERROR;
+  }
 
-  VpsUtilities::GenericByteData * gbd = new VpsUtilities::GenericByteData((unsigned char*)info.data, (unsigned int) info.size, false, false);
+  if (info.size < VpsUtilities::HEADER_LENGTH) {
+    GST_WARNING_OBJECT(filter, "Dropping buffer too small for a Generic Byte Data header (%" G_GSIZE_FORMAT " bytes)", info.size);
+    gst_buffer_unmap(buf, &info);
+    gst_buffer_unref(buf);
+    return GST_FLOW_OK;
+  }
+
+  // Only reads the header in place, so it can live on the stack
+  VpsUtilities::GenericByteData gbd((unsigned char*)info.data, (unsigned int) info.size, false, false);
+  VpsUtilities::DataType dataType = gbd.GetDataType();
+  VpsUtilities::Codec codec = gbd.GetCodec();
+  // Every JPEG frame stands on its own
+  gboolean keyframe = (gbd.GetFlags() & VpsUtilities::FLAG_SYNC) != 0 || codec == VpsUtilities::Codec::JPEG;
+  guint64 timestamp = gbd.GetTimeStamp();
+
+  GST_TRACE_OBJECT(filter, "FROM seq no: %u", gbd.GetSequenceNumber());
+  GST_TRACE_OBJECT(filter, "FROM Sync ts no: %" PRIu64, gbd.GetSyncTimeStamp());
+  GST_TRACE_OBJECT(filter, "FROM ts no: %" PRIu64, gbd.GetTimeStamp());
+
+  gst_buffer_unmap(buf, &info);
 
   // TODO: Not sure how we should skip pushing a buffer?
-  if (gbd->GetDataType() != VpsUtilities::DataType::VIDEO) {
-    gst_buffer_unmap(buf, &info);
+  if (dataType != VpsUtilities::DataType::VIDEO) {
     gst_buffer_unref(buf);
-    delete gbd;
     return GST_FLOW_OK;
   }
 
+  if (filter->wait_for_keyframe && filter->waiting_for_keyframe) {
+    if (!keyframe) {
+      GST_DEBUG_OBJECT(filter, "Dropping delta frame while waiting for a keyframe");
+      gst_buffer_unref(buf);
+      return GST_FLOW_OK;
+    }
+    filter->waiting_for_keyframe = FALSE;
+  }
+
   if (filter->firstrun) {
     GstSegment segment;
 
-    switch(gbd->GetCodec()) {
-      case VpsUtilities::Codec::H264:
-        caps = gst_caps_new_empty_simple ("video/x-h264");
-        break;
-      case VpsUtilities::Codec::H265:
-        caps = gst_caps_new_empty_simple ("video/x-h265");
-        break;
-      case VpsUtilities::Codec::JPEG:
-        caps = gst_caps_new_empty_simple ("image/jpeg");
-        break;
-      default:
-        gst_buffer_unmap(buf, &info);
-        gst_buffer_unref(buf);
-        delete gbd;
-        return GST_FLOW_NOT_SUPPORTED;
+    caps = gst_fromxprotectconverter_caps_for_codec(codec);
+    if (caps == NULL) {
+      gst_buffer_unref(buf);
+      return GST_FLOW_NOT_SUPPORTED;
     }
 
     gst_pad_use_fixed_caps (filter->srcpad_video);
@@ -208,44 +319,47 @@ static GstFlowReturn gst_fromxprotectconverter_chain(GstPad * pad, GstObject * p
     gst_element_add_pad(GST_ELEMENT(filter), filter->srcpad_video);
 
     filter->firstrun = FALSE;
+    filter->codec = (guint16) codec;
 
     GST_DEBUG_OBJECT (filter, "emitting no more pads");
     gst_element_no_more_pads (GST_ELEMENT (filter));
 
     if (caps)
       gst_caps_unref (caps);
+  } else if ((guint16) codec != filter->codec) {
+    // The camera's codec changed mid-stream, so renegotiate
+    caps = gst_fromxprotectconverter_caps_for_codec(codec);
+    if (caps == NULL) {
+      gst_buffer_unref(buf);
+      return GST_FLOW_NOT_SUPPORTED;
+    }
+    GST_INFO_OBJECT(filter, "Codec changed, setting caps %" GST_PTR_FORMAT, caps);
+    gst_pad_set_caps(filter->srcpad_video, caps);
+    gst_caps_unref(caps);
+    filter->codec = (guint16) codec;
   }
 
-  GstBuffer * outputBuffer = gst_buffer_new();
-  GstMemory * mem = gst_allocator_alloc(NULL, gbd->GetBodyLength(), NULL);
-  gst_buffer_append_memory(outputBuffer, mem);
-  GstMapInfo info2;
-  gst_buffer_map(outputBuffer, &info2, GST_MAP_WRITE);
-
-  GST_TRACE_OBJECT(gst_xprotect_debug, "FROM seq no: %u\n", gbd->GetSequenceNumber());
-  GST_TRACE_OBJECT(gst_xprotect_debug, "FROM Sync ts no: %" PRIu64 "\n", gbd->GetSyncTimeStamp());
-  GST_TRACE_OBJECT(gst_xprotect_debug, "FROM ts no: %" PRIu64 "\n", gbd->GetTimeStamp());
-
-  GST_BUFFER_DTS(outputBuffer) = GST_BUFFER_DTS(buf);
-  GST_BUFFER_PTS(outputBuffer) = GST_BUFFER_PTS(buf);
-  GST_BUFFER_OFFSET(outputBuffer) = GST_BUFFER_OFFSET(buf);
-
-  // Copy reference timestamp metadata if present
-  GstReferenceTimestampMeta *meta = gst_buffer_get_reference_timestamp_meta(buf, NULL);
-  if (meta) {
-    gst_buffer_add_reference_timestamp_meta(outputBuffer, meta->reference, meta->timestamp, meta->duration);
+  // Strip the header by moving the start of the buffer past it. This shares the input memory rather
+  // than copying the body - if anything else holds a ref to the buffer, make_writable only copies the
+  // GstBuffer itself (timestamps, flags and metas come along with it)
+  buf = gst_buffer_make_writable(buf);
+  gst_buffer_resize(buf, VpsUtilities::HEADER_LENGTH, -1);
+
+  if (keyframe)
+    GST_BUFFER_FLAG_UNSET(buf, GST_BUFFER_FLAG_DELTA_UNIT);
+  else
+    GST_BUFFER_FLAG_SET(buf, GST_BUFFER_FLAG_DELTA_UNIT);
+
+  if (filter->frame_timestamps && GST_BUFFER_PTS_IS_VALID(buf)) {
+    // Keep the first frame's PTS as the base (so running time is unchanged), but space frames by
+    // the camera's own timestamps (ms) instead of when they happened to arrive
+    if (!GST_CLOCK_TIME_IS_VALID(filter->base_pts) || timestamp < filter->base_timestamp) {
+      filter->base_pts = GST_BUFFER_PTS(buf);
+      filter->base_timestamp = timestamp;
+    }
+    GST_BUFFER_PTS(buf) = filter->base_pts + (timestamp - filter->base_timestamp) * GST_MSECOND;
+    GST_BUFFER_DTS(buf) = GST_CLOCK_TIME_NONE;
   }
 
-  // Theoretically, we can just modify the buffer in-place
-  // TODO: Look into this
-  memcpy(info2.data, gbd->GetBody(), gbd->GetBodyLength());
-
-  delete gbd;
-
-  gst_buffer_unmap(outputBuffer, &info2);
-
-  gst_buffer_unmap(buf, &info);
-  gst_buffer_unref(buf);
-  
-  return gst_pad_push(filter->srcpad_video, outputBuffer);
+  return gst_pad_push(filter->srcpad_video, buf);
 }
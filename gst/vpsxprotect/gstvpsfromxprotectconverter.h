@@ -29,6 +29,16 @@ struct _GstFromXprotectConverter
   GstBin bin;
   gboolean firstrun;
   GstPad *sinkpad, *srcpad_video, *srcpad_metadata;
+
+  /* properties */
+  gboolean wait_for_keyframe;
+  gboolean frame_timestamps;
+
+  /* stream state */
+  guint16 codec;
+  gboolean waiting_for_keyframe;
+  GstClockTime base_pts;
+  guint64 base_timestamp;
 };
 
 struct _GstFromXprotectConverterClass
@@ -0,0 +1,188 @@
+import argparse
+import logging
+import os
+import signal
+import sys
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst, GLib
+Gst.init(None)
+
+# Ingest through the element itself, so it gets the same login, recorder resolution, reconnects and parsing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gst", "milestonexprotect"))
+from milestonexprotect import MilestoneXprotectSrc, gbd_is_keyframe, parse_gbd_header
+from xprotectlib.ring import DEFAULT_RING_SIZE, ShmRingWriter, ring_name
+
+# Logging
+formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+handler = logging.StreamHandler(sys.stderr)
+handler.setFormatter(formatter)
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+logger.addHandler(handler)
+
+if Gst.ElementFactory.find("milestonexprotectsrc") is None:
+  Gst.Element.register(None, "milestonexprotectsrc", Gst.Rank.NONE, MilestoneXprotectSrc)
+
+NTP_CAPS = Gst.Caps.from_string("timestamp/x-ntp")
+
+# Caps name to GenericByteData codec, for elementary output
+CAPS_CODECS = {
+  "image/jpeg": 0x0001,
+  "video/x-h264": 0x000A,
+  "video/x-h265": 0x000E,
+}
+
+# Seconds to wait before restarting a camera's pipeline after it errors
+RESTART_DELAY = 5
+
+class CameraPublisher:
+  """
+  Streams one camera with milestonexprotectsrc into an appsink, and writes every frame into the camera's
+  shared memory ring. The ring outlives the pipeline, so readers carry on when it's restarted after an error
+  """
+  def __init__(self, properties, camera_id, hardware_id, ring_size, shm_prefix):
+    self.properties = properties
+    self.camera_id = camera_id
+    self.hardware_id = hardware_id
+    self.output_mode = properties.get("output-mode", "genericbytedata")
+    self.ring = ShmRingWriter(ring_name(shm_prefix, camera_id), ring_size, self.output_mode)
+    self.pipeline = None
+    self.frames = 0
+    self.oversized = 0
+    self._codec = 0
+
+  def start(self):
+    self.pipeline = Gst.Pipeline.new("camera-%s" % self.camera_id)
+    src = Gst.ElementFactory.make("milestonexprotectsrc")
+    for name, value in self.properties.items():
+      src.set_property(name, value)
+    src.set_property("camera-id", self.camera_id)
+    src.set_property("hardware-id", self.hardware_id)
+    src.set_property("write-camera-timestamp", True)
+    sink = Gst.ElementFactory.make("appsink")
+    sink.set_property("sync", False)
+    sink.set_property("emit-signals", True)
+    sink.connect("new-sample", self._on_sample)
+    self.pipeline.add(src)
+    self.pipeline.add(sink)
+    src.link(sink)
+
+    bus = self.pipeline.get_bus()
+    bus.add_signal_watch()
+    bus.connect("message::error", self._on_error)
+    bus.connect("message::eos", self._on_error)
+    self.pipeline.set_state(Gst.State.PLAYING)
+
+  def stop(self):
+    if self.pipeline is not None:
+      self.pipeline.get_bus().remove_signal_watch()
+      self.pipeline.set_state(Gst.State.NULL)
+      self.pipeline = None
+
+  def close(self):
+    self.stop()
+    self.ring.close()
+
+  def _restart(self):
+    logger.info("Restarting camera %s" % self.camera_id)
+    self.start()
+    return GLib.SOURCE_REMOVE
+
+  def _on_error(self, bus, message):
+    if message.type == Gst.MessageType.ERROR:
+      error, debug = message.parse_error()
+      logger.error("Camera %s failed: %s" % (self.camera_id, error.message))
+    else:
+      logger.error("Camera %s stream ended" % self.camera_id)
+    self.stop()
+    GLib.timeout_add_seconds(RESTART_DELAY, self._restart)
+
+  def _on_sample(self, sink):
+    sample = sink.emit("pull-sample")
+    buf = sample.get_buffer()
+    meta = buf.get_reference_timestamp_meta(NTP_CAPS)
+    timestamp_ms = meta.timestamp // Gst.MSECOND if meta is not None else 0
+
+    with buf.map(Gst.MapFlags.READ) as info:
+      if self.output_mode == "elementary":
+        caps = sample.get_caps()
+        if caps is not None:
+          self._codec = CAPS_CODECS.get(caps.get_structure(0).get_name(), 0)
+        keyframe = not buf.has_flags(Gst.BufferFlags.DELTA_UNIT)
+      else:
+        header = parse_gbd_header(info.data)
+        self._codec = header[2] if header is not None else 0
+        keyframe = gbd_is_keyframe(info.data)
+      if self.ring.write(info.data, keyframe, self._codec, timestamp_ms):
+        self.frames += 1
+      else:
+        self.oversized += 1
+    return Gst.FlowReturn.OK
+
+def parse_camera(value):
+  """
+  Parses CAMERA_ID or CAMERA_ID:HARDWARE_ID
+  """
+  camera_id, _, hardware_id = value.partition(":")
+  return (camera_id, hardware_id)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Hold Milestone XProtect recorder connections and publish each camera to a shared memory ring for milestonexprotectshmsrc")
+  parser.add_argument("--management-server", required=True)
+  parser.add_argument("--user-domain", required=True, help="Domain name to log in with, or BASIC to use basic auth")
+  parser.add_argument("--user-id", required=True)
+  parser.add_argument("--user-pw", required=True)
+  parser.add_argument("--camera", required=True, action="append", type=parse_camera, metavar="CAMERA_ID[:HARDWARE_ID]", help="Camera to publish, may be repeated")
+  parser.add_argument("--force-management-address", action="store_true")
+  parser.add_argument("--output-mode", choices=("genericbytedata", "elementary"), default="genericbytedata")
+  parser.add_argument("--ring-size", type=int, default=DEFAULT_RING_SIZE // (1024 * 1024), help="Shared memory per camera in MiB (default %d)" % (DEFAULT_RING_SIZE // (1024 * 1024)))
+  parser.add_argument("--shm-prefix", default="xprotect", help="Prefix for the shared memory names (default xprotect)")
+  parser.add_argument("--shared-ingest", action="store_true", help="Read every camera on the shared asyncio ingest engine rather than a thread each")
+  parser.add_argument("--reconnect-attempts", type=int, default=10, help="Reconnect attempts before a camera's pipeline is restarted (default 10)")
+  parser.add_argument("--stats-interval", type=int, default=60, help="Seconds between logging frame counts (0 to disable, default 60)")
+  args = parser.parse_args()
+
+  properties = {
+    "management-server": args.management_server,
+    "user-domain": args.user_domain,
+    "user-id": args.user_id,
+    "user-pw": args.user_pw,
+    "force-management-address": args.force_management_address,
+    "output-mode": args.output_mode,
+    "shared-ingest": args.shared_ingest,
+    "reader-thread": not args.shared_ingest,
+    "reconnect-attempts": args.reconnect_attempts,
+  }
+
+  loop = GLib.MainLoop()
+  publishers = []
+  try:
+    for camera_id, hardware_id in args.camera:
+      try:
+        publisher = CameraPublisher(properties, camera_id, hardware_id, args.ring_size * 1024 * 1024, args.shm_prefix)
+      except FileExistsError as e:
+        # e.g. another daemon with the same --shm-prefix, whose readers would be cut off if the ring was replaced
+        logger.error("Unable to publish camera %s - %s" % (camera_id, e))
+        sys.exit(1)
+      publishers.append(publisher)
+      publisher.start()
+      logger.info("Publishing camera %s to %s" % (camera_id, publisher.ring.name))
+
+    def log_stats():
+      for publisher in publishers:
+        logger.info("Camera %s: %d frames published, %d too big for the ring" % (publisher.camera_id, publisher.frames, publisher.oversized))
+      return GLib.SOURCE_CONTINUE
+
+    if args.stats_interval > 0:
+      GLib.timeout_add_seconds(args.stats_interval, log_stats)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+      GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, loop.quit)
+    loop.run()
+  finally:
+    # Removes the rings from shared memory, readers then time out (or reattach when the daemon is started again)
+    for publisher in publishers:
+      publisher.close()
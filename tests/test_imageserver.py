@@ -0,0 +1,311 @@
+"""
+Tests for the recording server connection pieces of milestonexprotectsrc that don't need GStreamer or a server:
+
+  python3 -m pytest tests
+"""
+import os
+import queue
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gst", "milestonexprotect"))
+from xprotectlib.imageserver import (GBD_CODEC_JPEG, GBD_DATATYPE_VIDEO, GBD_FLAG_SYNC, GBD_HEADER, GBD_HEADER_LENGTH,
+                                     MESSAGE_EMPTY, MESSAGE_IMAGE, MESSAGE_LIVEPACKAGE, MESSAGE_METHODRESPONSE, MESSAGE_UNKNOWN,
+                                     MESSAGE_XML, Buffer, FrameFilter, FrameQueue, ReaderSocket, classify_message, content_length,
+                                     current_timestamp, gbd_is_keyframe, parse_gbd_header, request_id)
+
+H264 = 0x000A
+
+def gbd_frame(codec: int = H264, flags: int = 0, data_type: int = GBD_DATATYPE_VIDEO, sequence: int = 0, payload: bytes = b"") -> bytes:
+  header = GBD_HEADER.pack(data_type, GBD_HEADER_LENGTH + len(payload), codec, sequence, flags, 0, 0)
+  return header + bytes(GBD_HEADER_LENGTH - len(header)) + payload
+
+class KeyframeTest(unittest.TestCase):
+  def test_video_keyframes_have_the_sync_flag(self):
+    self.assertTrue(gbd_is_keyframe(gbd_frame(flags=GBD_FLAG_SYNC)))
+    self.assertFalse(gbd_is_keyframe(gbd_frame()))
+
+  def test_jpeg_and_other_data_are_always_keyframes(self):
+    self.assertTrue(gbd_is_keyframe(gbd_frame(codec=GBD_CODEC_JPEG)))
+    self.assertTrue(gbd_is_keyframe(gbd_frame(data_type=0x0020)))
+
+  def test_short_frames_are_passed_as_keyframes(self):
+    self.assertIsNone(parse_gbd_header(bytes(GBD_HEADER_LENGTH - 1)))
+    self.assertTrue(gbd_is_keyframe(bytes(GBD_HEADER_LENGTH - 1)))
+
+  def test_parses_the_header(self):
+    self.assertEqual(parse_gbd_header(gbd_frame(flags=GBD_FLAG_SYNC, sequence=7, payload=b"abc")),
+                     (GBD_DATATYPE_VIDEO, GBD_HEADER_LENGTH + 3, H264, 7, GBD_FLAG_SYNC, 0, 0))
+
+# A frame whose body contains the message separator, which only content-length can get past
+BODY = gbd_frame(flags=GBD_FLAG_SYNC, payload=b"\x00\x01\r\n\r\n\xff" * 50)
+
+IMAGE_RESPONSE = (b"ImageResponse\r\n"
+                  b"RequestId: 12\r\n"
+                  b"Content-type: application/x-genericbytedata-octet-stream\r\n"
+                  b"Content-length: %d\r\n"
+                  b"Current: 1700000000123\r\n"
+                  b"Next: 1700000000163" % len(BODY))
+
+LIVEPACKAGE = (b'<?xml version="1.0" encoding="UTF-8"?><livepackage><status>'
+               b'<statustime>1700000000123</statustime><statusitem id="1" value="live"/></status></livepackage>')
+
+METHODRESPONSE = (b'<?xml version="1.0" encoding="UTF-8"?><methodresponse><requestid>3</requestid>'
+                  b'<methodname>connectupdate</methodname><connected>yes</connected></methodresponse>')
+
+# As the recording server sends them - each frame is followed by an empty message
+STREAM = (IMAGE_RESPONSE + b"\r\n\r\n" + BODY + b"\r\n\r\n" +
+          b"\r\n" + LIVEPACKAGE + b"\r\n\r\n" +
+          METHODRESPONSE + b"\r\n\r\n")
+
+class ChunkedSocket:
+  """
+  Receives data a few bytes at a time, as a socket might, in chunks of the given sizes (repeated)
+  """
+  def __init__(self, data: bytes, sizes):
+    self._data = data
+    self._sizes = sizes
+    self._offset = 0
+    self._reads = 0
+
+  def recv_into(self, view, nbytes: int = 0) -> int:
+    size = min(self._sizes[self._reads % len(self._sizes)], nbytes or len(view), len(self._data) - self._offset)
+    self._reads += 1
+    view[:size] = self._data[self._offset:self._offset + size]
+    self._offset += size
+    return size
+
+# Chunk sizes to split STREAM at - single bytes, splitting the separators, and bigger than any message
+SPLITS = ([1], [2], [3], [5, 1, 7], [64], [1000], [len(STREAM)])
+
+class ParserTest(unittest.TestCase):
+  def test_classifies_messages(self):
+    self.assertEqual(classify_message(IMAGE_RESPONSE), MESSAGE_IMAGE)
+    self.assertEqual(classify_message(LIVEPACKAGE), MESSAGE_LIVEPACKAGE)
+    self.assertEqual(classify_message(METHODRESPONSE), MESSAGE_METHODRESPONSE)
+    self.assertEqual(classify_message(b'<?xml version="1.0"?><other/>'), MESSAGE_XML)
+    self.assertEqual(classify_message(b""), MESSAGE_EMPTY)
+    self.assertEqual(classify_message(b"HTTP/1.1 400 Bad Request"), MESSAGE_UNKNOWN)
+
+  def test_extracts_image_response_fields(self):
+    self.assertEqual(content_length(IMAGE_RESPONSE), len(BODY))
+    self.assertEqual(current_timestamp(IMAGE_RESPONSE), 1700000000123)
+    self.assertEqual(request_id(IMAGE_RESPONSE), 12)
+    # Header names are case insensitive
+    self.assertEqual(content_length(b"ImageResponse\r\nCONTENT-LENGTH:42"), 42)
+
+  def test_missing_fields(self):
+    with self.assertRaises(ValueError):
+      content_length(b"ImageResponse\r\nCurrent: 1")
+    self.assertIsNone(current_timestamp(b"ImageResponse\r\nContent-length: 1"))
+    self.assertIsNone(request_id(b"ImageResponse\r\nContent-length: 1"))
+
+  def read_stream(self, buffer: Buffer):
+    """
+    Reads STREAM as the element does, checking each message
+    """
+    response = buffer.get_line()
+    self.assertEqual(classify_message(response), MESSAGE_IMAGE)
+    self.assertEqual(current_timestamp(response), 1700000000123)
+    body = bytearray(content_length(response))
+    self.assertTrue(buffer.get_buffer_into(memoryview(body)))
+    self.assertEqual(body, BODY)
+
+    self.assertEqual(classify_message(buffer.get_line()), MESSAGE_EMPTY)
+    self.assertEqual(buffer.get_line(), LIVEPACKAGE)
+    self.assertEqual(buffer.get_line(), METHODRESPONSE)
+    self.assertIsNone(buffer.get_line())
+
+  def test_reads_messages_split_anywhere(self):
+    for sizes in SPLITS:
+      with self.subTest(sizes=sizes):
+        self.read_stream(Buffer(ChunkedSocket(STREAM, sizes)))
+
+  def test_grows_and_compacts_a_small_buffer(self):
+    for sizes in SPLITS:
+      with self.subTest(sizes=sizes):
+        self.read_stream(Buffer(ChunkedSocket(STREAM, sizes), 16))
+
+  def test_peek_and_skip_a_body(self):
+    for sizes in SPLITS:
+      with self.subTest(sizes=sizes):
+        buffer = Buffer(ChunkedSocket(STREAM, sizes), 64)
+        response = buffer.get_line()
+        self.assertEqual(buffer.peek(GBD_HEADER_LENGTH), BODY[:GBD_HEADER_LENGTH])
+        self.assertTrue(buffer.skip(content_length(response)))
+        self.assertEqual(buffer.get_line(), b"")
+        self.assertEqual(buffer.get_line(), LIVEPACKAGE)
+
+  def test_socket_closing_mid_body(self):
+    buffer = Buffer(ChunkedSocket(IMAGE_RESPONSE + b"\r\n\r\n" + BODY[:40], [7]))
+    response = buffer.get_line()
+    self.assertFalse(buffer.get_buffer_into(memoryview(bytearray(content_length(response)))))
+    self.assertIsNone(Buffer(ChunkedSocket(BODY[:10], [3])).peek(GBD_HEADER_LENGTH))
+
+class FrameQueueTest(unittest.TestCase):
+  def drain(self, frames: FrameQueue) -> list:
+    messages = []
+    while len(frames) > 0:
+      messages.append(frames.get(0))
+    return messages
+
+  def test_block_waits_for_space(self):
+    frames = FrameQueue(2, "block")
+    frames.put("f1", True)
+    frames.put("f2", False)
+    put = threading.Thread(target=frames.put, args=("f3", False))
+    put.start()
+    put.join(0.1)
+    self.assertTrue(put.is_alive())
+
+    self.assertEqual(frames.get(1), "f1")
+    put.join(1)
+    self.assertFalse(put.is_alive())
+    self.assertEqual(self.drain(frames), ["f2", "f3"])
+    self.assertEqual(frames.dropped, 0)
+
+  def test_close_releases_a_blocked_reader(self):
+    frames = FrameQueue(1, "block")
+    frames.put("f1", True)
+    put = threading.Thread(target=frames.put, args=("f2", False))
+    put.start()
+    frames.close()
+    put.join(1)
+    self.assertFalse(put.is_alive())
+
+  def test_drop_oldest_drops_the_oldest_frame(self):
+    frames = FrameQueue(3, "drop-oldest")
+    frames.put("f1", True)
+    frames.put("xml")
+    frames.put("f2", False)
+    frames.put("f3", False)
+    self.assertEqual(self.drain(frames), ["xml", "f2", "f3"])
+    self.assertEqual(frames.dropped, 1)
+
+  def test_drop_until_keyframe(self):
+    frames = FrameQueue(2, "drop-until-keyframe")
+    frames.put("k1", True)
+    frames.put("d1", False)
+    # Full, so frames are dropped until the next keyframe, even once there's space
+    frames.put("d2", False)
+    self.assertEqual(frames.get(0), "k1")
+    frames.put("d3", False)
+    self.assertEqual(frames.dropped, 2)
+
+    frames.put("k2", True)
+    self.assertEqual(frames.get(0), "d1")
+    frames.put("d4", False)
+    self.assertEqual(self.drain(frames), ["k2", "d4"])
+    self.assertEqual(frames.dropped, 2)
+
+  def test_keyframe_replaces_queued_frames_when_full(self):
+    frames = FrameQueue(2, "drop-until-keyframe")
+    frames.put("k1", True)
+    frames.put("d1", False)
+    frames.put("k2", True)
+    self.assertEqual(self.drain(frames), ["k2"])
+    self.assertEqual(frames.dropped, 2)
+
+  def test_messages_that_arent_frames_are_never_dropped(self):
+    for policy in ("drop-oldest", "drop-until-keyframe"):
+      frames = FrameQueue(2, policy)
+      frames.put("xml1")
+      frames.put("xml2")
+      frames.put(None)
+      frames.put("k1", True)
+      self.assertEqual(self.drain(frames), ["xml1", "xml2", None, "k1"], policy)
+      self.assertEqual(frames.dropped, 0, policy)
+
+  def test_get_times_out_and_raises_reader_errors(self):
+    frames = FrameQueue(2)
+    with self.assertRaises(queue.Empty):
+      frames.get(0.01)
+    frames.put(ConnectionResetError("reset"))
+    with self.assertRaises(ConnectionResetError):
+      frames.get(0)
+
+class ReaderSocketTest(unittest.TestCase):
+  def setUp(self):
+    self.sock, self.peer = socket.socketpair()
+    self.peer.settimeout(2)
+
+  def tearDown(self):
+    self.sock.close()
+    self.peer.close()
+
+  def test_sends_from_other_threads_while_the_reader_waits(self):
+    self.sock.settimeout(2)
+    reader_socket = ReaderSocket(self.sock)
+    received = bytearray(5)
+    reader = threading.Thread(target=reader_socket.recv_into, args=(memoryview(received),))
+    reader.start()
+
+    # Sent by the reader thread, which is woken from waiting on the socket to send it
+    reader_socket.send(b"connectupdate")
+    self.assertEqual(self.peer.recv(100), b"connectupdate")
+    self.assertTrue(reader.is_alive())
+
+    self.peer.sendall(b"frame")
+    reader.join(2)
+    self.assertFalse(reader.is_alive())
+    self.assertEqual(received, b"frame")
+    reader_socket.close()
+
+  def test_receive_times_out(self):
+    self.sock.settimeout(0.05)
+    reader_socket = ReaderSocket(self.sock)
+    with self.assertRaises(socket.timeout):
+      reader_socket.recv_into(memoryview(bytearray(5)))
+    reader_socket.close()
+
+  def test_closed_socket_receives_nothing(self):
+    self.sock.settimeout(2)
+    reader_socket = ReaderSocket(self.sock)
+    self.peer.close()
+    self.assertEqual(reader_socket.recv_into(memoryview(bytearray(5))), 0)
+    reader_socket.close()
+
+def frame_response(current_ms: int | None) -> bytes:
+  return b"ImageResponse\r\nRequestId: 1\r\n" + (b"Current: %d\r\n" % current_ms if current_ms is not None else b"") + b"Content-length: 32"
+
+class FrameFilterTest(unittest.TestCase):
+  KEYFRAME = gbd_frame(flags=GBD_FLAG_SYNC)[:GBD_HEADER_LENGTH]
+  DELTA = gbd_frame()[:GBD_HEADER_LENGTH]
+
+  def test_keyframes_only(self):
+    frame_filter = FrameFilter(keyframes_only=True)
+    self.assertTrue(frame_filter.wanted(frame_response(0), self.KEYFRAME))
+    self.assertFalse(frame_filter.wanted(frame_response(40), self.DELTA))
+    self.assertTrue(frame_filter.wanted(frame_response(80), gbd_frame(codec=GBD_CODEC_JPEG)[:GBD_HEADER_LENGTH]))
+    self.assertTrue(frame_filter.wanted(frame_response(120), self.KEYFRAME))
+    self.assertEqual(frame_filter.dropped, 1)
+
+  def test_without_filtering_every_frame_is_wanted(self):
+    frame_filter = FrameFilter()
+    self.assertTrue(frame_filter.wanted(frame_response(0), self.DELTA))
+    self.assertTrue(frame_filter.wanted(frame_response(0), self.DELTA))
+    self.assertEqual(frame_filter.dropped, 0)
+
+  def test_interval_keeps_the_first_keyframe_after_it(self):
+    frame_filter = FrameFilter(interval_ms=1000)
+    decisions = [frame_filter.wanted(frame_response(current), body_start) for current, body_start in [
+      (1000, self.KEYFRAME),
+      (1500, self.KEYFRAME), # Too soon
+      (2100, self.DELTA),    # Only keyframes, so the stream stays decodable
+      (2200, self.KEYFRAME),
+      (3199, self.KEYFRAME),
+      (3200, self.KEYFRAME), # Exactly the interval
+      (100, self.KEYFRAME),  # The camera's clock went backwards
+    ]]
+    self.assertEqual(decisions, [True, False, False, True, False, True, True])
+    self.assertEqual(frame_filter.dropped, 3)
+
+  def test_interval_without_a_timestamp_uses_the_local_clock(self):
+    frame_filter = FrameFilter(interval_ms=60000)
+    self.assertTrue(frame_filter.wanted(frame_response(None), self.KEYFRAME))
+    self.assertFalse(frame_filter.wanted(frame_response(None), self.KEYFRAME))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,143 @@
+"""
+Tests for the PTZ commands and the worker that sends them. Needs no GStreamer:
+
+  python3 -m pytest tests
+"""
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gst", "milestonexprotect"))
+from xprotectlib.ptz import PtzWorker, ptz_command
+
+TIMEOUT = 5
+
+class FakePromise:
+  def __init__(self):
+    self.replied = threading.Event()
+    self.replies = []
+
+  def reply(self, value):
+    self.replies.append(value)
+    self.replied.set()
+
+  def wait(self):
+    if not self.replied.wait(TIMEOUT):
+      raise AssertionError("promise wasn't replied to")
+    return self.replies
+
+class FakeRecorder:
+  """
+  Records the commands sent, holding each one in flight until it's released
+  """
+  def __init__(self):
+    self.sent = []
+    self._cond = threading.Condition()
+    self._released = 0
+
+  def send(self, x: float, y: float, z: float):
+    with self._cond:
+      self.sent.append((x, y, z))
+      self._cond.notify_all()
+      if not self._cond.wait_for(lambda: self._released >= len(self.sent), TIMEOUT):
+        raise AssertionError("command wasn't released")
+    return ("sent", x, y, z)
+
+  def in_flight(self, count: int):
+    with self._cond:
+      if not self._cond.wait_for(lambda: len(self.sent) >= count, TIMEOUT):
+        raise AssertionError("command wasn't sent")
+
+  def release(self, count: int = 1):
+    with self._cond:
+      self._released += count
+      self._cond.notify_all()
+
+class PtzWorkerTest(unittest.TestCase):
+  def setUp(self):
+    self.recorder = FakeRecorder()
+    self.worker = PtzWorker("test-ptz", self.recorder.send)
+    self.addCleanup(self.worker.close, TIMEOUT)
+    self.addCleanup(self.recorder.release, 100)
+
+  def submit(self, x: float, y: float, z: float) -> FakePromise:
+    promise = FakePromise()
+    self.worker.submit(x, y, z, promise)
+    return promise
+
+  def test_sends_a_command_and_replies(self):
+    self.recorder.release()
+    self.assertEqual(self.submit(0.5, 0, 0).wait(), [("sent", 0.5, 0, 0)])
+    self.assertEqual(self.recorder.sent, [(0.5, 0, 0)])
+
+  def test_newer_moves_replace_pending_ones(self):
+    first = self.submit(1, 0, 0)
+    self.recorder.in_flight(1)
+    second = self.submit(0, 1, 0)
+    third = self.submit(0, 0, 1)
+    self.assertEqual(second.wait(), [None])
+    self.recorder.release(2)
+    self.assertEqual(first.wait(), [("sent", 1, 0, 0)])
+    self.assertEqual(third.wait(), [("sent", 0, 0, 1)])
+    self.assertEqual(self.recorder.sent, [(1, 0, 0), (0, 0, 1)])
+
+  def test_stops_are_kept_and_sent_before_later_moves(self):
+    first = self.submit(1, 0, 0)
+    self.recorder.in_flight(1)
+    replaced = self.submit(0, 1, 0)
+    stops = [self.submit(0, 0, 0), self.submit(0, 0, 0)]
+    move = self.submit(-1, 0, 0)
+    self.recorder.release(3)
+    self.assertEqual(first.wait(), [("sent", 1, 0, 0)])
+    self.assertEqual(replaced.wait(), [None])
+    # Both stops are replied to by the one stop sent
+    for stop in stops:
+      self.assertEqual(stop.wait(), [("sent", 0, 0, 0)])
+    self.assertEqual(move.wait(), [("sent", -1, 0, 0)])
+    self.assertEqual(self.recorder.sent, [(1, 0, 0), (0, 0, 0), (-1, 0, 0)])
+
+  def test_close_sends_the_pending_stop(self):
+    first = self.submit(1, 0, 0)
+    self.recorder.in_flight(1)
+    stop = self.submit(0, 0, 0)
+    dropped = self.submit(0, -1, 0)
+    closing = threading.Thread(target=self.worker.close, args=(TIMEOUT,))
+    closing.start()
+    self.recorder.release(2)
+    closing.join(TIMEOUT)
+    self.assertFalse(closing.is_alive())
+    self.assertEqual(first.wait(), [("sent", 1, 0, 0)])
+    self.assertEqual(stop.wait(), [("sent", 0, 0, 0)])
+    self.assertEqual(dropped.wait(), [None])
+    self.assertEqual(self.recorder.sent, [(1, 0, 0), (0, 0, 0)])
+    # Commands after close are replied to without being sent
+    self.assertEqual(self.submit(0, 0, 0).wait(), [None])
+    self.assertEqual(len(self.recorder.sent), 2)
+
+  def test_close_times_out_on_a_stuck_command(self):
+    command = self.submit(1, 0, 0)
+    self.recorder.in_flight(1)
+    self.worker.close(0.05)
+    self.assertFalse(command.replied.is_set())
+    self.recorder.release()
+    self.assertEqual(command.wait(), [("sent", 1, 0, 0)])
+
+class PtzCommandTest(unittest.TestCase):
+  def test_stop(self):
+    self.assertEqual(ptz_command(0, 0, 0), ("PTZMoveStop", None))
+
+  def test_pan_tilt_takes_priority_over_zoom(self):
+    method, args = ptz_command(-0.5, 0.25, 1)
+    self.assertEqual(method, "PTZMoveStart")
+    self.assertEqual(args["movement"], [{"name": "pan", "value": -1}, {"name": "tilt", "value": 1}])
+    self.assertEqual(args["speed"], [{"name": "pan", "value": 0.5}, {"name": "tilt", "value": 0.25}])
+
+  def test_zoom(self):
+    method, args = ptz_command(0, 0, -0.75)
+    self.assertEqual(method, "PTZMoveStart")
+    self.assertEqual(args["movement"], [{"name": "zoom", "value": -1}])
+    self.assertEqual(args["speed"], [{"name": "zoom", "value": 0.75}])
+
+if __name__ == "__main__":
+  unittest.main()
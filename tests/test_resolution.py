@@ -0,0 +1,90 @@
+"""
+Tests for the camera -> recorder resolution cache. Needs no GStreamer:
+
+  python3 -m pytest tests
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gst", "milestonexprotect"))
+from xprotectlib.resolution import ResolutionCache
+
+SERVER = "https://Management.example"
+CAMERA = "6C9F1A2B-0000-4000-8000-000000000001"
+HARDWARE = "6c9f1a2b-0000-4000-8000-000000000002"
+
+class ResolutionCacheTest(unittest.TestCase):
+  def setUp(self):
+    directory = tempfile.TemporaryDirectory()
+    self.addCleanup(directory.cleanup)
+    self.path = os.path.join(directory.name, "cache", "resolution.db")
+    self.warnings = []
+    self.cache = self.open()
+
+  def open(self) -> ResolutionCache:
+    cache = ResolutionCache(self.path, self.warnings.append)
+    self.addCleanup(cache.close)
+    return cache
+
+  def age(self, table: str, column: str, seconds: float):
+    self.cache._db.execute("UPDATE %s SET %s = %s - ?" % (table, column, column), (seconds,))
+
+  def test_store_lookup(self):
+    self.assertIsNone(self.cache.lookup(SERVER, CAMERA, 60))
+    self.cache.store(SERVER, [(CAMERA, HARDWARE, "https://recorder.example:7563/")])
+    # Case-insensitive on both keys, and visible to another connection
+    self.assertEqual(self.open().lookup(SERVER.lower(), CAMERA.lower(), 60), (HARDWARE, "https://recorder.example:7563/", True))
+    self.cache.store(SERVER, [(CAMERA, HARDWARE, "http://recorder.example:7563/")])
+    self.assertEqual(self.cache.lookup(SERVER, CAMERA, 60), (HARDWARE, "http://recorder.example:7563/", False))
+    self.assertIsNone(self.cache.lookup("https://other.example", CAMERA, 60))
+
+  def test_expiry(self):
+    self.cache.store(SERVER, [(CAMERA, HARDWARE, "https://recorder.example:7563/")])
+    self.age("cameras", "updated", 100)
+    self.assertIsNone(self.cache.lookup(SERVER, CAMERA, 50))
+    self.assertIsNotNone(self.cache.lookup(SERVER, CAMERA, 150))
+
+  def test_invalidate(self):
+    self.cache.store(SERVER, [(CAMERA, HARDWARE, "https://recorder.example:7563/")])
+    self.cache.invalidate(SERVER, CAMERA.lower())
+    self.assertIsNone(self.cache.lookup(SERVER, CAMERA, 60))
+
+  def test_fetch_lease(self):
+    other = self.open()
+    self.assertTrue(self.cache.claim_fetch(SERVER))
+    self.assertFalse(other.claim_fetch(SERVER.lower()))
+    self.assertTrue(other.claim_fetch("https://other.example"))
+    self.cache.release_fetch(SERVER)
+    self.assertTrue(other.claim_fetch(SERVER))
+
+  def test_fetch_lease_expired(self):
+    self.assertTrue(self.cache.claim_fetch(SERVER))
+    self.age("fetches", "started", ResolutionCache.FETCH_LEASE - 5)
+    self.assertFalse(self.open().claim_fetch(SERVER))
+    self.age("fetches", "started", 10)
+    self.assertTrue(self.open().claim_fetch(SERVER))
+
+  def test_database_error_disables(self):
+    self.cache.store(SERVER, [(CAMERA, HARDWARE, "https://recorder.example:7563/")])
+    self.cache._db.execute("DROP TABLE cameras")
+    self.assertIsNone(self.cache.lookup(SERVER, CAMERA, 60))
+    self.assertEqual(len(self.warnings), 1)
+    # Disabled from then on, without touching the database or warning again
+    self.assertIsNone(self.cache._db)
+    self.assertIsNone(self.cache.claim_fetch(SERVER))
+    self.cache.store(SERVER, [(CAMERA, HARDWARE, "https://recorder.example:7563/")])
+    self.cache.release_fetch(SERVER)
+    self.assertEqual(len(self.warnings), 1)
+    self.cache.close()
+
+  def test_unusable_path(self):
+    os.makedirs(self.path + ".d")
+    # The element carries on without the cache when it can't be opened
+    with self.assertRaises(sqlite3.Error):
+      ResolutionCache(self.path + ".d")
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,157 @@
+"""
+Tests for the shared memory ring between the ingest daemon and milestonexprotectshmsrc. Needs no GStreamer:
+
+  python3 -m pytest tests
+"""
+import os
+import subprocess
+import sys
+import unittest
+import uuid
+from multiprocessing import shared_memory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gst", "milestonexprotect"))
+from xprotectlib.ring import RECORD_HEADER, RING_PID, RING_POSITION, ShmRingReader, ShmRingWriter, _record_size
+
+def frame(number: int, size: int = 40) -> bytes:
+  return bytes([number & 0xFF]) * size
+
+class RingTestCase(unittest.TestCase):
+  def setUp(self):
+    self.name = "xprotect-test-%s" % uuid.uuid4().hex[:12]
+    self.closers = []
+
+  def tearDown(self):
+    for close in reversed(self.closers):
+      close()
+
+  def writer(self, capacity: int) -> ShmRingWriter:
+    writer = ShmRingWriter(self.name, capacity)
+    self.closers.append(writer.close)
+    return writer
+
+  def reader(self) -> ShmRingReader:
+    reader = ShmRingReader(self.name)
+    self.closers.append(reader.close)
+    return reader
+
+  def read(self, reader: ShmRingReader):
+    """
+    Reads a frame the way milestonexprotectshmsrc does, returning (keyframe, data), or None if there isn't one
+    """
+    while True:
+      peeked = reader.peek()
+      if peeked is None:
+        return None
+      data = bytes(peeked[4])
+      if reader.consume(peeked):
+        return (peeked[1], data)
+
+class ShmRingTest(RingTestCase):
+  def test_reads_frames_in_order(self):
+    writer = self.writer(4096)
+    reader = self.reader()
+    self.assertIsNone(self.read(reader))
+    writer.write(frame(1), True, 0x000A, 1234)
+    writer.write(frame(2, 17), False)
+
+    peeked = reader.peek()
+    self.assertEqual(peeked[1:4], (True, 0x000A, 1234))
+    self.assertTrue(reader.consume(peeked))
+    self.assertEqual(self.read(reader), (False, frame(2, 17)))
+    self.assertIsNone(self.read(reader))
+    self.assertEqual(reader.overruns, 0)
+
+  def test_starts_at_latest_keyframe(self):
+    writer = self.writer(4096)
+    for number in range(5):
+      writer.write(frame(number), number == 2)
+    reader = self.reader()
+    self.assertEqual([self.read(reader) for _ in range(3)], [(True, frame(2)), (False, frame(3)), (False, frame(4))])
+
+  def test_wraps_records_that_dont_fit_before_the_end(self):
+    # Each record is 64 bytes, so the fourth of every pass wraps to the start
+    size = _record_size(40)
+    writer = self.writer(size * 3 + size // 2)
+    reader = self.reader()
+    for number in range(20):
+      self.assertTrue(writer.write(frame(number), number == 0))
+      self.assertEqual(self.read(reader), (number == 0, frame(number)))
+    self.assertEqual(reader.overruns, 0)
+
+  def test_lapped_reader_skips_to_latest_keyframe(self):
+    writer = self.writer(_record_size(40) * 4)
+    reader = self.reader()
+    writer.write(frame(0), True)
+    self.assertEqual(self.read(reader), (True, frame(0)))
+    for number in range(1, 10):
+      writer.write(frame(number), number % 3 == 0)
+
+    self.assertEqual(self.read(reader), (True, frame(9)))
+    self.assertEqual(reader.overruns, 1)
+    self.assertIsNone(self.read(reader))
+
+  def test_lapped_without_a_keyframe_in_the_ring_skips_to_the_end(self):
+    writer = self.writer(_record_size(40) * 4)
+    reader = self.reader()
+    writer.write(frame(0), True)
+    self.assertEqual(self.read(reader), (True, frame(0)))
+    for number in range(1, 10):
+      writer.write(frame(number), False)
+
+    self.assertIsNone(self.read(reader))
+    self.assertEqual(reader.overruns, 1)
+    writer.write(frame(10), False)
+    self.assertEqual(self.read(reader), (False, frame(10)))
+
+  def test_frame_overwritten_while_copied_is_discarded(self):
+    writer = self.writer(_record_size(40) * 4)
+    reader = self.reader()
+    writer.write(frame(0), True)
+    peeked = reader.peek()
+    for number in range(1, 5):
+      writer.write(frame(number), number == 3)
+
+    self.assertFalse(reader.consume(peeked))
+    self.assertEqual(reader.overruns, 1)
+    self.assertEqual(self.read(reader), (True, frame(3)))
+    self.assertEqual(self.read(reader), (False, frame(4)))
+
+  def test_rejects_frames_bigger_than_the_ring(self):
+    writer = self.writer(256)
+    self.assertFalse(writer.write(bytes(256), True))
+    self.assertTrue(writer.write(bytes(256 - RECORD_HEADER.size), True))
+
+class ShmRingWriterStartTest(RingTestCase):
+  def test_refuses_a_ring_still_being_published(self):
+    self.writer(4096)
+    with self.assertRaises(FileExistsError):
+      ShmRingWriter(self.name, 4096)
+
+  def test_refuses_shared_memory_that_isnt_a_ring(self):
+    # Created by another process, as it would be
+    subprocess.run([sys.executable, "-c", "from multiprocessing import resource_tracker, shared_memory; "
+                    "other = shared_memory.SharedMemory(%r, create=True, size=4096); "
+                    "resource_tracker.unregister(other._name, 'shared_memory')" % self.name], check=True)
+    self.closers.append(lambda: shared_memory.SharedMemory(self.name).unlink())
+    with self.assertRaises(FileExistsError):
+      ShmRingWriter(self.name, 4096)
+
+  def test_replaces_a_ring_left_by_a_writer_that_died(self):
+    stale = ShmRingWriter(self.name, 4096)
+    stale.write(frame(1), True)
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    RING_POSITION.pack_into(stale._buf, RING_PID, process.pid)
+    # As if the process had been killed - the ring is left behind
+    stale._buf.release()
+    stale._shm.close()
+
+    writer = self.writer(4096)
+    reader = self.reader()
+    self.assertIsNone(self.read(reader))
+    writer.write(frame(2), True)
+    self.assertEqual(self.read(reader), (True, frame(2)))
+
+if __name__ == "__main__":
+  unittest.main()